@@ -1,13 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import StreamingResponse
-from typing import Dict
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.orm import Session
-import json
-import time
+from typing import List, Optional
 from db.session import get_db
-import asyncio
-from schemas.sandbox.chatbot import ChatRequest, ChatResponse
+from schemas.sandbox.chatbot import ChatRequest, ChatResponse, ChatBatchRequest, ChatSessionCreate, ChatSessionOut, ChatMessageOut
+from crud.chat import create_session, get_session_by_id, get_sessions, get_messages, delete_session_by_id
+from core.config import BATCH_MAX_REQUESTS
 from services.sandbox.chatbot.llm_service import MockLLMService, LLMService
+from services.sandbox.chatbot.sessions import chat_sessions, ChatSessionNotFound
+from services.sandbox.chatbot.streaming import ChunkEncoder, EventStreamResponse, ClientDisconnected, unless_disconnected, SSE_DONE, dumps
+from contextlib import aclosing
+from services.llms.tokenizer import ContextWindowExceeded
+from services.llms.ratelimit import RateLimitQueueFull
 
 router = APIRouter(prefix="/playground/chatbot", tags=["Chatbot"])
 
@@ -26,24 +30,33 @@ async def chat(
         raise HTTPException(status_code=400, detail="Messages cannot be empty")
     
     # In a real implementation, validate the model against available models
-    if not request.model:
+    if not request.model and request.llm_type != "router":
         raise HTTPException(status_code=400, detail="Model must be specified")
     
     # Get the response from the LLM service
     response = None
-    async for chunk in llm_service.generate_chat_completion(
-        messages=request.messages,
-        model=request.model,
-        llm_alias=request.llm_alias,
-        llm_type=request.llm_type,
-        temperature=request.temperature,
-        max_tokens=request.max_tokens,
-        top_p=request.top_p,
-        frequency_penalty=request.frequency_penalty,
-        presence_penalty=request.presence_penalty,
-        stream=False
-    ):
-        response = chunk
+    try:
+        async for chunk in llm_service.generate_chat_completion(
+            messages=request.messages,
+            model=request.model,
+            llm_alias=request.llm_alias,
+            llm_type=request.llm_type,
+            temperature=request.temperature,
+            max_tokens=request.max_tokens,
+            top_p=request.top_p,
+            frequency_penalty=request.frequency_penalty,
+            presence_penalty=request.presence_penalty,
+            conversation_id=request.conversation_id,
+            stream=False,
+            session_id=request.session_id,
+        ):
+            response = chunk
+    except ContextWindowExceeded as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RateLimitQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except ChatSessionNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
     
     if not response:
         raise HTTPException(status_code=500, detail="Failed to generate response")
@@ -53,51 +66,108 @@ async def chat(
 @router.post("/chat/stream")
 async def chat_stream(
     request: ChatRequest,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
     """
     Stream chat responses from the selected LLM model.
+    When the client disconnects, the LLM stream is closed: the provider request is dropped and a local generation
+    stops at its next token.
     """
     if not request.messages:
         raise HTTPException(status_code=400, detail="Messages cannot be empty")
     
-    if not request.model:
+    if not request.model and request.llm_type != "router":
         raise HTTPException(status_code=400, detail="Model must be specified")
         
+    chunks = llm_service.generate_chat_completion(
+        messages=request.messages,
+        model=request.model,
+        llm_alias=request.llm_alias,
+        llm_type=request.llm_type,
+        temperature=request.temperature,
+        max_tokens=request.max_tokens,
+        top_p=request.top_p,
+        frequency_penalty=request.frequency_penalty,
+        presence_penalty=request.presence_penalty,
+        conversation_id=request.conversation_id,
+        stream=True,
+        session_id=request.session_id,
+    )
+    # the context window is checked before the first chunk, so a chat that does not fit fails before the stream starts
+    try:
+        first = await unless_disconnected(http_request, anext(chunks))
+    except ContextWindowExceeded as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RateLimitQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except ChatSessionNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ClientDisconnected:
+        await chunks.aclose()
+        return Response(status_code=499)  # nobody reads it, the client is gone
+
+    encoder = ChunkEncoder()
+
     async def event_generator():
-        async for chunk in llm_service.generate_chat_completion(
-            messages=request.messages,
-            model=request.model,
-            llm_alias=request.llm_alias,
-            llm_type=request.llm_type,
-            temperature=request.temperature,
-            max_tokens=request.max_tokens,
-            top_p=request.top_p,
-            frequency_penalty=request.frequency_penalty,
-            presence_penalty=request.presence_penalty,
-            stream=True
-        ):
-            yield f"data: {json.dumps(chat_completion_chunk_to_dict(chunk))}\n\n"
-            await asyncio.sleep(0.01)
-        
-        yield 'data: [DONE]\n\n'
-    
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
-
-
-def chat_completion_chunk_to_dict(chunk: Dict) -> Dict:
-    """Convert a chat completion chunk to a dictionary."""
-    return {
-        "id": chunk.get("id", ""),
-        "object": chunk.get("object", "chat.completion.chunk"),
-        "created": chunk.get("created", int(time.time())),
-        "model": chunk.get("model", ""),
-        "choices": [
-            {
-                "delta": choice.get("delta", {}),
-                "index": choice.get("index", 0),
-                "finish_reason": choice.get("finish_reason")
-            }
-            for choice in chunk.get("choices", [])
-        ]
-    }
+        async with aclosing(chunks):
+            yield encoder.encode(first)
+            async for chunk in chunks:
+                yield encoder.encode(chunk)
+        yield SSE_DONE
+
+    return EventStreamResponse(event_generator())
+
+
+@router.post("/chat/batch")
+async def chat_batch(
+    request: ChatBatchRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Run many chat requests concurrently, at most BATCH_ALIAS_CONCURRENCY at once per alias.
+    Results are streamed as NDJSON in completion order, one {"index", "response"} or {"index", "error"} per line.
+    """
+    if len(request.requests) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"A batch holds at most {BATCH_MAX_REQUESTS} requests")
+
+    async def result_generator():
+        async for result in llm_service.generate_batch(request.requests):
+            yield dumps(result) + b"\n"
+
+    return StreamingResponse(result_generator(), media_type="application/x-ndjson")
+
+
+
+@router.post("/sessions", description="Create a chat session, whose history is kept server side", response_model=ChatSessionOut)
+def add_session(request: ChatSessionCreate, db: Session = Depends(get_db)):
+    return create_session(db, request.title)
+
+
+@router.get("/sessions", description="List the chat sessions, most recently active first", response_model=List[ChatSessionOut])
+def list_sessions(limit: Optional[int] = None, db: Session = Depends(get_db)):
+    return get_sessions(db, limit)
+
+
+@router.get("/sessions/{id}", description="Get a chat session and the running summary of its older turns", response_model=ChatSessionOut)
+def get_session(id: str, db: Session = Depends(get_db)):
+    session = get_session_by_id(db, id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return session
+
+
+@router.get("/sessions/{id}/messages", description="Get the messages of a chat session, oldest first", response_model=List[ChatMessageOut])
+def get_session_messages(id: str, start: int = 0, limit: Optional[int] = None, db: Session = Depends(get_db)):
+    if not get_session_by_id(db, id):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return get_messages(db, id, start, limit=limit)
+
+
+@router.delete("/sessions/{id}", description="Delete a chat session and its messages")
+async def delete_session(id: str, db: Session = Depends(get_db)):
+    if not get_session_by_id(db, id):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    await chat_sessions.stop(id)
+    delete_session_by_id(db, id)
+    return {"detail": "Chat session deleted"}
@@ -0,0 +1,127 @@
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
+from fastapi.responses import StreamingResponse
+from typing import List, Literal, Optional
+from sqlalchemy.orm import Session
+from pydantic import ValidationError
+import json
+import asyncio
+from db.session import get_db, SessionLocal
+from schemas.jobs import BulkJobOut
+from schemas.sandbox.chatbot import ChatRequest
+from crud.jobs import create_job, get_job_by_id, get_jobs, update_job_status, delete_job_by_id, iter_item_results
+from services.jobs.bulk import bulk_job_runner
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["Jobs"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+def parse_job_lines(lines, defaults: dict):
+    """
+    Yield the (custom_id, request) of every non-empty JSONL line, each validated as a chat request on top of the
+    defaults of the upload. Raises HTTPException with the line number of the first invalid line.
+    """
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            body = json.loads(line)
+            custom_id = body.pop("custom_id", None)
+            request = ChatRequest.model_validate({**defaults, **body})
+        except (json.JSONDecodeError, AttributeError, ValidationError) as e:
+            raise HTTPException(status_code=400, detail=f"Line {number} is not a valid chat request: {e}")
+        if not request.model and request.llm_type != "router":
+            raise HTTPException(status_code=400, detail=f"Line {number}: model must be specified")
+        yield custom_id, request.model_dump(exclude_none=True)
+
+
+@router.post("/", description="Create a bulk completion job from a JSONL file of chat requests", response_model=BulkJobOut)
+async def add_job(
+    file: UploadFile = File(..., description="One chat request per line, optionally with a custom_id"),
+    llm_alias: Optional[str] = Form(None),
+    llm_type: Optional[Literal['remote', 'local', 'router']] = Form(None),
+    model: Optional[str] = Form(None),
+    temperature: Optional[float] = Form(None),
+    max_tokens: Optional[int] = Form(None),
+    db: Session = Depends(get_db)
+):
+    defaults = {
+        key: value for key, value in
+        {"llm_alias": llm_alias, "llm_type": llm_type, "model": model, "temperature": temperature, "max_tokens": max_tokens}.items()
+        if value is not None
+    }
+    lines = (line.decode("utf-8") for line in file.file)
+    # large uploads are parsed and inserted off the event loop
+    job = await asyncio.to_thread(create_job, db, parse_job_lines(lines, defaults))
+    if not job.total_items:
+        delete_job_by_id(db, job.id)
+        raise HTTPException(status_code=400, detail="The file holds no chat request")
+    bulk_job_runner.submit(job.id)
+    return job
+
+
+@router.get("/", description="List the bulk completion jobs", response_model=List[BulkJobOut])
+def list_jobs(limit: Optional[int] = None, db: Session = Depends(get_db)):
+    return get_jobs(db, limit)
+
+
+@router.get("/{id}", description="Get the progress of a bulk completion job", response_model=BulkJobOut)
+def get_job(id: str, db: Session = Depends(get_db)):
+    job = get_job_by_id(db, id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/{id}/cancel", description="Cancel a bulk completion job, the results of its finished items are kept", response_model=BulkJobOut)
+async def cancel_job(id: str, db: Session = Depends(get_db)):
+    if not get_job_by_id(db, id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    await bulk_job_runner.cancel(id)
+    db.expire_all()
+    return get_job_by_id(db, id)
+
+
+@router.post("/{id}/resume", description="Resume a cancelled or interrupted job, optionally retrying its failed items", response_model=BulkJobOut)
+async def resume_job(id: str, retry_failed: bool = False, db: Session = Depends(get_db)):
+    job = get_job_by_id(db, id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if bulk_job_runner.is_running(id):
+        raise HTTPException(status_code=409, detail="Job is already running")
+    job = update_job_status(db, id, "pending", retry_failed=retry_failed)
+    bulk_job_runner.submit(id)
+    return job
+
+
+@router.delete("/{id}", description="Delete a bulk completion job and its results")
+async def delete_job(id: str, db: Session = Depends(get_db)):
+    if not get_job_by_id(db, id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    if bulk_job_runner.is_running(id):
+        await bulk_job_runner.cancel(id)
+    delete_job_by_id(db, id)
+    return {"detail": "Job deleted"}
+
+
+@router.get("/{id}/results", description="Download the results of a job as JSONL, in the order of the uploaded requests")
+def get_job_results(id: str, db: Session = Depends(get_db)):
+    if not get_job_by_id(db, id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    def result_generator():
+        # its own session, the one of the request is closed once the response starts
+        with SessionLocal() as session:
+            for item in iter_item_results(session, id):
+                yield json.dumps({
+                    "index": item.index,
+                    "custom_id": item.custom_id,
+                    "status": item.status,
+                    "response": item.response,
+                    "error": item.error,
+                }) + "\n"
+
+    return StreamingResponse(result_generator(), media_type="application/x-ndjson", headers={"Content-Disposition": f'attachment; filename="{id}.jsonl"'})
@@ -1,10 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, Path, Query
-from schemas.llms import RemoteLLM, LocalLLM, ListLLMs, RemoteLLMOut, LocalLLMOut, LLMValidationRequest, LLMValidationResponse, RemoteLLMUpdate, ListModels, ListEmbeddingsModels, LLMTunableParameters
-from crud.llms import get_remote_llms, create_remote_llm, update_remote_llm_by_alias, get_remote_llm_by_alias, delete_remote_llm_by_alias, create_local_llm, get_local_llms, get_local_llm_by_alias, update_local_llm_by_alias, delete_local_llm_by_alias
+from fastapi import APIRouter, Body, Depends, HTTPException, Path, Query
+from schemas.llms import RemoteLLM, LocalLLM, ListLLMs, RemoteLLMOut, LocalLLMOut, LLMValidationRequest, LLMValidationResponse, RemoteLLMUpdate, ListModels, ListEmbeddingsModels, LLMTunableParameters, LoadedLocalModel, UnloadedLocalModels, ResponseCacheSettings, ResponseCacheStats, ClearedResponseCache, SemanticCacheSettings, SemanticCacheStats, RouterLLM, RouterTargetStats, RateLimitSettings, RateLimitStats, HedgingSettings, HedgingStats, EmbeddingsRequest, EmbeddingsResponse, SpeculativeSettings, LocalBenchmarkRequest, LocalBenchmarkResult, ListLocalModels
+from crud.llms import get_remote_llms, create_remote_llm, update_remote_llm_by_alias, get_remote_llm_by_alias, delete_remote_llm_by_alias, create_local_llm, get_local_llms, get_local_llm_by_alias, update_local_llm_by_alias, delete_local_llm_by_alias, update_llm_settings, get_router_llms, get_router_llm_by_alias, create_router_llm, update_router_llm_by_alias, delete_router_llm_by_alias
 from typing import Optional
+import asyncio
+import time
 from sqlalchemy.orm import Session
 from db.session import get_db
-from services.llms.factory import get_llm_client_by_provider, get_llm_client_by_alias
+from services.llms.factory import get_llm_client_by_provider, get_llm_client_by_alias, get_router_client_by_alias
+from services.llms.cache.response import response_cache
+from services.llms.cache.semantic import semantic_cache
+from services.llms.cache.catalog import model_catalog
+from services.llms.ratelimit import rate_limiters
+from services.llms.hedging import hedge_trackers
+from services.llms.embeddings import embedding_service
+from services.llms.base import LLMProviderError
+from services.llms.ratelimit import RateLimitQueueFull
 
 
 router = APIRouter(prefix="/llms", tags=["LLM"])
@@ -16,6 +26,71 @@ def list_llms(limit: Optional[int] = None, db: Session = Depends(get_db)):
     return ListLLMs(api=[], local=[])
 
 
+#################
+## Response cache
+#################
+
+@router.get("/cache/stats", response_model=ResponseCacheStats, description="Hit/miss counters of the response cache")
+def get_response_cache_stats():
+    return response_cache.stats()
+
+
+@router.get("/cache/semantic/stats", response_model=SemanticCacheStats, description="Hit rate and saved provider latency of the semantic cache")
+def get_semantic_cache_stats():
+    return semantic_cache.stats()
+
+
+@router.delete("/cache", response_model=ClearedResponseCache, description="Drop the cached responses of an alias, or all of them")
+def clear_response_cache(alias: Optional[str] = Query(None, description="The LLM alias")):
+    return {"removed": response_cache.clear(alias)}
+
+
+##########################
+## Rate limits and hedging
+##########################
+
+@router.get("/rate-limits/stats", response_model=dict[str, RateLimitStats], description="Queue depth and wait times of the rate limited remote LLMs")
+def get_rate_limit_stats():
+    return rate_limiters.stats()
+
+
+@router.get("/hedging/stats", response_model=dict[str, HedgingStats], description="Hedges sent, and the latency tails with and without them, of the hedged LLMs")
+def get_hedging_stats():
+    return hedge_trackers.stats()
+
+
+#############
+## Embeddings
+#############
+
+@router.get("/embeddings/stats", description="Hit rate of the embedding cache, and the provider batches sent per alias and model")
+def get_embeddings_stats():
+    return embedding_service.stats()
+
+
+async def embed_texts(alias: str, is_remote: bool, request: EmbeddingsRequest, db: Session) -> dict:
+    """Embed the texts of a request with an alias, through the embedding cache and the batcher of the alias."""
+    try:
+        llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=is_remote)
+    except Exception:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    model = request.model
+    if not model:
+        models = await model_catalog.aget(alias, is_remote, "embeddings_models", llm.list_embeddings_models)
+        if not models:
+            raise HTTPException(status_code=400, detail=f"{alias} has no embeddings model")
+        model = models[0]
+    try:
+        embeddings, cached = await embedding_service.embed(llm, alias, is_remote, request.texts, model)
+    except NotImplementedError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RateLimitQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except LLMProviderError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    return {"model": model, "embeddings": embeddings, "cached": cached}
+
+
 ###########################
 ## Remote LLMs - though API
 ###########################
@@ -55,7 +130,7 @@ def delete_api_key(alias: str, db: Session = Depends(get_db)):
 async def get_available_remote_models(alias: str = Path(..., description="The remote LLM alias"), db: Session = Depends(get_db)):
     try:
         llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=True)
-        return {"models": llm.list_models()}
+        return {"models": await model_catalog.aget(alias, True, "models", llm.list_models)}
     except Exception as e:
         print(e)
         return {"error": f"Validation error: {str(e)}"}
@@ -65,11 +140,43 @@ async def get_available_remote_models(alias: str = Path(..., description="The re
 async def get_available_remote_embeddings_models(alias: str = Path(..., description="The remote LLM alias"), db: Session = Depends(get_db)):
     try:
         llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=True)
-        return {"embeddings_models": llm.list_embeddings_models()}
+        return {"embeddings_models": await model_catalog.aget(alias, True, "embeddings_models", llm.list_embeddings_models)}
     except Exception as e:
         print(e)
         return {"error": f"Validation error: {str(e)}"}
 
+@router.post("/remote/{alias}/embeddings", response_model=EmbeddingsResponse, description="Embed texts with an embeddings model of a remote LLM")
+async def embed_remote(request: EmbeddingsRequest, alias: str = Path(..., description="The remote LLM alias"), db: Session = Depends(get_db)):
+    return await embed_texts(alias, True, request, db)
+
+@router.put("/remote/{alias}/cache", response_model=ResponseCacheSettings, description="Enable or disable the response cache of a remote LLM")
+def update_remote_llm_cache(settings: ResponseCacheSettings, alias: str = Path(..., description="The remote LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=True, name="response_cache", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
+@router.put("/remote/{alias}/semantic-cache", response_model=SemanticCacheSettings, description="Enable or disable the semantic cache of a remote LLM")
+def update_remote_llm_semantic_cache(settings: SemanticCacheSettings, alias: str = Path(..., description="The remote LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=True, name="semantic_cache", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
+@router.put("/remote/{alias}/rate-limit", response_model=RateLimitSettings, description="Set the requests and tokens per minute of a remote LLM")
+def update_remote_llm_rate_limit(settings: RateLimitSettings, alias: str = Path(..., description="The remote LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=True, name="rate_limit", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
+@router.put("/remote/{alias}/hedging", response_model=HedgingSettings, description="Enable or disable hedged requests for a remote LLM")
+def update_remote_llm_hedging(settings: HedgingSettings, alias: str = Path(..., description="The remote LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=True, name="hedging", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
 # API Status Check
 
 @router.post("/remote/validate-key", response_model=LLMValidationResponse, description="Validate a remote LLM API key")
@@ -98,7 +205,7 @@ async def validate_remote_llm_key(alias: str = Path(..., description="The remote
 async def get_tunable_parameters(alias: str = Path(..., description="The remote LLM alias"), model: Optional[str] = Query(None, description="The remote LLM model"), db: Session = Depends(get_db)):
     try:
         llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=True)
-        return llm.get_tunable_parameters(model)
+        return await model_catalog.aget(alias, True, "parameters", lambda: llm.get_tunable_parameters(model), argument=model)
     except Exception as e:
         print(e)
         return {"error": f"Validation error: {str(e)}"}
@@ -139,11 +246,13 @@ def delete_local_llm(alias: str, db: Session = Depends(get_db)):
     return deleted
 
 
-@router.get("/local/{alias}/models", response_model=ListModels)
+@router.get("/local/{alias}/models", response_model=ListLocalModels, description="List the GGUF models of a local LLM with the metadata of their headers")
 async def get_available_local_models(alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
     try:
         llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=False)
-        return {"models": llm.list_models()}
+        # not served from the model catalog: the model index checks the files on every call and only reads new or changed headers
+        details = await asyncio.to_thread(llm.list_model_details)
+        return {"models": [model["file"] for model in details], "details": details}
     except Exception as e:
         return {"error": f"Validation error: {str(e)}"}
 
@@ -152,23 +261,150 @@ async def get_available_local_models(alias: str = Path(..., description="The loc
 async def get_available_local_embeddings_models(alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
     try:
         llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=False)
-        return {"embeddings_models": llm.list_embeddings_models()}
+        return {"embeddings_models": await model_catalog.aget(alias, False, "embeddings_models", llm.list_embeddings_models)}
     except Exception as e:
         return {"error": f"Validation error: {str(e)}"}
 
 
+@router.post("/local/{alias}/embeddings", response_model=EmbeddingsResponse, description="Embed texts with an embeddings model of a local LLM")
+async def embed_local(request: EmbeddingsRequest, alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
+    return await embed_texts(alias, False, request, db)
+
+
 @router.get("/local/{alias}/parameters", response_model=LLMTunableParameters, description="Get tunable parameters for a local LLM")
 async def get_tunable_parameters(alias: str = Path(..., description="The local LLM alias"), model: Optional[str] = Query(None, description="The local LLM model"), db: Session = Depends(get_db)):
     try:
         llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=False)
-        return llm.get_tunable_parameters(model)
+        return await model_catalog.aget(alias, False, "parameters", lambda: llm.get_tunable_parameters(model), argument=model)
     except Exception as e:
         print(e)
         return {"error": f"Validation error: {str(e)}"}
 
 
+@router.put("/local/{alias}/cache", response_model=ResponseCacheSettings, description="Enable or disable the response cache of a local LLM")
+def update_local_llm_cache(settings: ResponseCacheSettings, alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=False, name="response_cache", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
+
+@router.put("/local/{alias}/semantic-cache", response_model=SemanticCacheSettings, description="Enable or disable the semantic cache of a local LLM")
+def update_local_llm_semantic_cache(settings: SemanticCacheSettings, alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=False, name="semantic_cache", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
+
+@router.put("/local/{alias}/hedging", response_model=HedgingSettings, description="Enable or disable hedged requests for a local LLM, towards an alternate alias")
+def update_local_llm_hedging(settings: HedgingSettings, alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=False, name="hedging", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
+
+@router.put("/local/{alias}/speculative", response_model=SpeculativeSettings, description="Enable speculative or prompt-lookup decoding for a local LLM")
+def update_local_llm_speculative(settings: SpeculativeSettings, alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
+    updated = update_llm_settings(db, alias, is_remote=False, name="speculative", settings=settings.model_dump())
+    if not updated:
+        raise HTTPException(status_code=404, detail="LLM not found")
+    return settings
+
+
+@router.get("/local/{alias}/loaded", response_model=list[LoadedLocalModel], description="List the models of a local LLM that are loaded in memory")
+def list_loaded_local_models(alias: str = Path(..., description="The local LLM alias"), db: Session = Depends(get_db)):
+    llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=False)
+    return llm.loaded_models()
+
+
+@router.post("/local/{alias}/load", response_model=LoadedLocalModel, description="Load a local LLM model into memory ahead of the first request")
+def load_local_model(alias: str = Path(..., description="The local LLM alias"), model: str = Query(..., description="The model file to load"), db: Session = Depends(get_db)):
+    llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=False)
+    try:
+        return llm.load_model(model)
+    except RuntimeError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+
+
+@router.post("/local/{alias}/unload", response_model=UnloadedLocalModels, description="Unload a local LLM model, or all its idle models, from memory")
+def unload_local_model(alias: str = Path(..., description="The local LLM alias"), model: Optional[str] = Query(None, description="The model file to unload"), db: Session = Depends(get_db)):
+    llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=False)
+    return {"unloaded": llm.unload_model(model)}
+
+
+@router.post("/local/{alias}/benchmark", response_model=LocalBenchmarkResult, description="Benchmark a local LLM model on this host and tune its load parameters")
+def benchmark_local_model(
+    request: LocalBenchmarkRequest = Body(default_factory=LocalBenchmarkRequest),
+    alias: str = Path(..., description="The local LLM alias"),
+    model: str = Query(..., description="The model file to benchmark"),
+    db: Session = Depends(get_db),
+):
+    llm = get_llm_client_by_alias(alias=alias, db=db, is_remote=False)
+    try:
+        result = llm.benchmark(model, **request.model_dump(exclude={"apply"}, exclude_none=True))
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=f"{e}")
+    except RuntimeError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    if request.apply:
+        tuning = dict((get_local_llm_by_alias(db, alias).parameters or {}).get("tuning") or {})
+        tuning[model] = {"load_params": result["load_params"], "cpu_count": result["cpu_count"], "tuned_at": time.time()}
+        update_llm_settings(db, alias, is_remote=False, name="tuning", settings=tuning)
+        # the loaded copy keeps the previous parameters, the next request reloads the model with the tuned ones
+        llm.unload_model(model)
+    return {"model": model, **result, "applied": request.apply}
+
+
 @router.get("/local/{provider}/recommended-path", response_model=dict[str, str])
 def get_recommended_path(provider: str = Path(..., description="The local LLM provider")):
     llm = get_llm_client_by_provider(provider.lower().replace(" ", "_").replace(".", "_"))
     recommended_path: str = llm.get_recommended_path()
     return {"path": recommended_path}
+
+
+##############
+## LLM Routers
+##############
+
+@router.get("/router", response_model=list[RouterLLM])
+def list_router_llms(limit: Optional[int] = None, db: Session = Depends(get_db)):
+    return get_router_llms(db, limit)
+
+
+@router.post("/router", response_model=RouterLLM, description="Create a router alias over remote and local aliases")
+def new_router_llm(llm: RouterLLM, db: Session = Depends(get_db)):
+    return create_router_llm(db, llm.alias, [target.model_dump() for target in llm.targets])
+
+
+@router.get("/router/{alias}", response_model=RouterLLM, description="Get a router alias")
+def get_router_llm(alias: str = Path(..., description="The router alias"), db: Session = Depends(get_db)):
+    llm = get_router_llm_by_alias(db, alias)
+    if not llm:
+        raise HTTPException(status_code=404, detail="Router not found")
+    return llm
+
+
+@router.put("/router/{alias}", response_model=RouterLLM, description="Replace the targets of a router alias")
+def update_router_llm(llm: RouterLLM, alias: str = Path(..., description="The router alias"), db: Session = Depends(get_db)):
+    updated = update_router_llm_by_alias(db, alias, [target.model_dump() for target in llm.targets])
+    if not updated:
+        raise HTTPException(status_code=404, detail="Router not found")
+    return updated
+
+
+@router.delete("/router/{alias}")
+def delete_router_llm(alias: str = Path(..., description="The router alias"), db: Session = Depends(get_db)):
+    deleted = delete_router_llm_by_alias(db, alias)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Router not found")
+    return deleted
+
+
+@router.get("/router/{alias}/stats", response_model=list[RouterTargetStats], description="Rolling latency, error rate and circuit breaker state of the targets of a router")
+def get_router_llm_stats(alias: str = Path(..., description="The router alias"), db: Session = Depends(get_db)):
+    try:
+        return get_router_client_by_alias(alias, db).stats()
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=f"{e}")
@@ -0,0 +1,85 @@
+"""
+Aggregate decode throughput of a local GGUF model for N concurrent generations.
+
+Compares the continuous batching scheduler against a single stream, e.g.:
+    python -m benchmarks.bench_batching /path/to/model.gguf --concurrency 1 2 4 8 --max-tokens 128
+
+Run from the backend directory.
+"""
+import argparse
+import os
+import threading
+import time
+from llama_cpp import Llama
+from services.llms.local.scheduler import BatchScheduler, Sequence
+
+
+PROMPTS = [
+    "Write a short story about a lighthouse keeper.",
+    "Explain how a hash map works.",
+    "List some tips for learning a new language.",
+    "Describe the water cycle.",
+    "What are the benefits of unit testing?",
+    "Summarize the plot of a detective novel.",
+    "Explain the difference between TCP and UDP.",
+    "Give a recipe for a simple tomato soup.",
+]
+
+
+def run(scheduler: BatchScheduler, llm: Llama, concurrency: int, max_tokens: int) -> tuple[int, float]:
+    """Run concurrency generations at once and return (generated tokens, elapsed seconds)."""
+    done = threading.Semaphore(0)
+    counts = [0] * concurrency
+
+    def emit_for(i: int):
+        def emit(_, kind, payload):
+            if kind == "token":
+                counts[i] += 1
+            else:
+                done.release()
+        return emit
+
+    start = time.perf_counter()
+    for i in range(concurrency):
+        prompt = PROMPTS[i % len(PROMPTS)]
+        scheduler.submit(Sequence(
+            request_id=str(i),
+            tokens=llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True),
+            max_tokens=max_tokens,
+            temperature=0.0,
+            emit=emit_for(i),
+            is_cancelled=lambda: False,
+        ))
+    for _ in range(concurrency):
+        done.acquire()
+    return sum(counts), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", help="Path of a GGUF model")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--n-ctx", type=int, default=1024)
+    parser.add_argument("--n-threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    llm = Llama(model_path=args.model, n_ctx=args.n_ctx, n_threads=args.n_threads, verbose=False)
+    scheduler = BatchScheduler(llm, n_ctx=args.n_ctx, max_sequences=max(args.concurrency))
+    run(scheduler, llm, 1, 8)  # warm up
+
+    tokens, elapsed = run(scheduler, llm, 1, args.max_tokens)
+    baseline = tokens / elapsed
+    print(f"single stream: {baseline:.1f} tok/s")
+    print(f"{'streams':>8} {'tokens':>8} {'seconds':>8} {'tok/s':>8} {'scaling':>8}")
+    for concurrency in args.concurrency:
+        tokens, elapsed = run(scheduler, llm, concurrency, args.max_tokens)
+        throughput = tokens / elapsed
+        print(f"{concurrency:>8} {tokens:>8} {elapsed:>8.2f} {throughput:>8.1f} {throughput / baseline:>7.2f}x")
+
+    scheduler.close()
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Single stream decode speed of a local GGUF model with and without speculative decoding.
+
+Runs the same greedy generations with no drafter, with prompt-lookup decoding and, when a draft model is given,
+with speculative decoding, e.g.:
+    python -m benchmarks.bench_speculative /path/to/model.gguf --draft-model /path/to/draft.gguf --max-tokens 128
+
+The prompts quote a short document, as RAG prompts do, which is where prompt lookup pays off.
+Run from the backend directory.
+"""
+import argparse
+import os
+import threading
+import time
+from llama_cpp import Llama
+from services.llms.local.scheduler import BatchScheduler, Sequence
+from services.llms.local.speculative import DraftModelDrafter, PromptLookupDrafter
+
+
+DOCUMENT = (
+    "The lighthouse at Point Reyes was built in 1870. Its first order Fresnel lens, made of 1,032 pieces of glass, "
+    "was manufactured in France and shipped around Cape Horn. The keepers climbed 308 steps down the cliff every "
+    "evening to light the lamp, and the station was automated in 1975."
+)
+
+PROMPTS = [
+    f"Context:\n{DOCUMENT}\n\nQuestion: Repeat the sentence of the context about the lens, word for word.\nAnswer:",
+    f"Context:\n{DOCUMENT}\n\nQuestion: When was the lighthouse built and when was it automated? Quote the context.\nAnswer:",
+    f"Context:\n{DOCUMENT}\n\nQuestion: Summarize the context in two sentences.\nAnswer:",
+]
+
+
+def run(scheduler: BatchScheduler, llm: Llama, max_tokens: int) -> tuple[int, float]:
+    """Run the prompts one after the other and return (generated tokens, elapsed seconds)."""
+    tokens, elapsed = 0, 0.0
+    for i, prompt in enumerate(PROMPTS):
+        done = threading.Event()
+        count = [0]
+
+        def emit(_, kind, payload):
+            if kind == "token":
+                count[0] += 1
+            else:
+                done.set()
+
+        start = time.perf_counter()
+        scheduler.submit(Sequence(
+            request_id=str(i),
+            tokens=llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True),
+            max_tokens=max_tokens,
+            temperature=0.0,
+            emit=emit,
+            is_cancelled=lambda: False,
+        ))
+        done.wait()
+        elapsed += time.perf_counter() - start
+        tokens += count[0]
+    return tokens, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", help="Path of a GGUF model")
+    parser.add_argument("--draft-model", help="Path of a smaller GGUF model sharing the vocabulary of the model")
+    parser.add_argument("--draft-tokens", type=int, default=4)
+    parser.add_argument("--ngram-max", type=int, default=3)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--n-ctx", type=int, default=1024)
+    parser.add_argument("--n-threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    llm = Llama(model_path=args.model, n_ctx=args.n_ctx, n_threads=args.n_threads, verbose=False)
+    draft = Llama(model_path=args.draft_model, n_ctx=args.n_ctx, n_threads=args.n_threads, verbose=False) if args.draft_model else None
+
+    drafters = {
+        "none": lambda: None,
+        "prompt lookup": lambda: PromptLookupDrafter(args.draft_tokens, ngram_max=args.ngram_max),
+    }
+    if draft is not None:
+        drafters["draft model"] = lambda: DraftModelDrafter(draft, n_ctx=args.n_ctx, max_sequences=1, draft_tokens=args.draft_tokens)
+
+    print(f"{'drafter':>14} {'tokens':>8} {'seconds':>8} {'tok/s':>8} {'speedup':>8} {'accepted':>9}")
+    baseline = None
+    for name, make_drafter in drafters.items():
+        scheduler = BatchScheduler(llm, n_ctx=args.n_ctx, max_sequences=1, drafter=make_drafter())
+        run(scheduler, llm, 8)  # warm up
+        scheduler.stats.update(drafted=0, accepted=0)
+        tokens, elapsed = run(scheduler, llm, args.max_tokens)
+        throughput = tokens / elapsed
+        baseline = baseline or throughput
+        drafted = scheduler.stats["drafted"]
+        acceptance = f"{scheduler.stats['accepted'] / drafted:>8.0%}" if drafted else f"{'-':>8}"
+        print(f"{name:>14} {tokens:>8} {elapsed:>8.2f} {throughput:>8.1f} {throughput / baseline:>7.2f}x {acceptance:>9}")
+        scheduler.close()
+
+    if draft is not None:
+        draft.close()
+    llm.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import os
+from pathlib import Path
+from dotenv import load_dotenv
+
+
+root_dir = Path(__file__).resolve().parents[2]
+load_dotenv(root_dir / ".env")
+
+
+####################################
+## Local LLMs - resident model cache
+####################################
+
+# Upper bound of GGUF weights (in bytes) kept loaded at the same time, least recently used models are unloaded first
+LLAMA_CACHE_MAX_BYTES = int(os.getenv("LLAMA_CACHE_MAX_BYTES", 8 * 1024 ** 3))
+# Seconds a loaded model may stay unused before it is unloaded, 0 disables idle unloading
+LLAMA_CACHE_IDLE_TIMEOUT = float(os.getenv("LLAMA_CACHE_IDLE_TIMEOUT", 15 * 60))
+
+
+#################################
+## Local LLMs - inference workers
+#################################
+
+# Number of worker processes that own the loaded models, 0 runs local inference inside the API process
+LLAMA_INFERENCE_WORKERS = int(os.getenv("LLAMA_INFERENCE_WORKERS", 1))
+# Concurrent requests each worker (or the API process) executes
+LLAMA_WORKER_THREADS = int(os.getenv("LLAMA_WORKER_THREADS", 4))
+# Seconds a blocking local request waits for the next event of the backend (a token, its result) before it gives up
+LLAMA_REQUEST_TIMEOUT = float(os.getenv("LLAMA_REQUEST_TIMEOUT", 10 * 60))
+
+
+###################################
+## Local LLMs - continuous batching
+###################################
+
+# Sequences decoded together in one llama.cpp batch per loaded model, further requests wait for a free slot
+LLAMA_BATCH_MAX_SEQUENCES = int(os.getenv("LLAMA_BATCH_MAX_SEQUENCES", 4))
+# Tokens submitted to a single llama_decode call (decode tokens of running sequences plus prompt chunks)
+LLAMA_BATCH_MAX_TOKENS = int(os.getenv("LLAMA_BATCH_MAX_TOKENS", 512))
+# Prompt tokens a single sequence may prefill per step. Lower values keep running streams fluent while long prompts are admitted
+LLAMA_BATCH_PREFILL_CHUNK = int(os.getenv("LLAMA_BATCH_PREFILL_CHUNK", 128))
+
+
+##########################
+## Local LLMs - embeddings
+##########################
+
+# Texts embedded by a single request to the inference backend, larger batches are split by the embedding batcher
+LLAMA_EMBEDDING_BATCH = int(os.getenv("LLAMA_EMBEDDING_BATCH", 32))
+
+
+#####################################
+## Local LLMs - speculative decoding
+#####################################
+
+# Default draft tokens proposed per step and verified by the model in the same decode, when an alias enables speculation
+LLAMA_SPECULATIVE_DRAFT_TOKENS = int(os.getenv("LLAMA_SPECULATIVE_DRAFT_TOKENS", 4))
+# Default longest n-gram of the generated text looked up in the prompt by prompt-lookup decoding
+LLAMA_PROMPT_LOOKUP_NGRAM = int(os.getenv("LLAMA_PROMPT_LOOKUP_NGRAM", 3))
+
+
+##########################################
+## Local LLMs - load parameters and tuning
+##########################################
+
+# Load parameters of the models that were not tuned with the /llms/local/{alias}/benchmark routine
+LLAMA_DEFAULT_N_CTX = int(os.getenv("LLAMA_DEFAULT_N_CTX", 1024))
+# Defaults to the physical cores, assuming two hardware threads per core: decoding is memory bound and rarely gains from more
+LLAMA_DEFAULT_N_THREADS = int(os.getenv("LLAMA_DEFAULT_N_THREADS", max(1, (os.cpu_count() or 8) // 2)))
+# Prompt tokens prefilled and tokens decoded by each run of the benchmark
+LLAMA_TUNE_PROMPT_TOKENS = int(os.getenv("LLAMA_TUNE_PROMPT_TOKENS", 512))
+LLAMA_TUNE_DECODE_TOKENS = int(os.getenv("LLAMA_TUNE_DECODE_TOKENS", 32))
+# Largest context window the benchmark tries, it is also capped by the context the model was trained with
+LLAMA_TUNE_MAX_N_CTX = int(os.getenv("LLAMA_TUNE_MAX_N_CTX", 8192))
+# The tuned context window is the largest whose decode speed, with the context 3/4 full, keeps this share of the short-context speed
+LLAMA_TUNE_MIN_DECODE_RATIO = float(os.getenv("LLAMA_TUNE_MIN_DECODE_RATIO", 0.5))
+# Seconds the benchmark of a local model may run, it sends no event until it is done; 0 waits however long it takes
+LLAMA_BENCHMARK_TIMEOUT = float(os.getenv("LLAMA_BENCHMARK_TIMEOUT", 2 * 60 * 60))
+
+
+###########################
+## Local LLMs - model index
+###########################
+
+# Metadata read from the GGUF headers of the local model directories, keyed by file path, modification time and size
+LLAMA_MODEL_INDEX_FILE = os.getenv("LLAMA_MODEL_INDEX_FILE", str(root_dir / "storage" / "llama_state" / "model_index.json"))
+
+
+#######################################
+## Local LLMs - prompt prefix KV cache
+#######################################
+
+# Memory budget (in bytes) of the cached KV states of shared prompt prefixes (system prompts), 0 disables the cache
+LLAMA_PREFIX_CACHE_MAX_BYTES = int(os.getenv("LLAMA_PREFIX_CACHE_MAX_BYTES", 1024 ** 3))
+# Disk budget (in bytes) of the prefix states spilled out of memory, 0 keeps them in memory only
+LLAMA_PREFIX_CACHE_DISK_BYTES = int(os.getenv("LLAMA_PREFIX_CACHE_DISK_BYTES", 4 * 1024 ** 3))
+LLAMA_PREFIX_CACHE_DIR = os.getenv("LLAMA_PREFIX_CACHE_DIR", str(root_dir / "storage" / "llama_state" / "prefix"))
+# Shorter prefixes are cheaper to evaluate than to restore
+LLAMA_PREFIX_CACHE_MIN_TOKENS = int(os.getenv("LLAMA_PREFIX_CACHE_MIN_TOKENS", 16))
+
+
+############################################
+## Local LLMs - conversation state snapshots
+############################################
+
+# Memory cap (in bytes) of the llama.cpp states saved after each assistant turn, 0 disables the snapshots
+LLAMA_SESSION_CACHE_MAX_BYTES = int(os.getenv("LLAMA_SESSION_CACHE_MAX_BYTES", 512 * 1024 ** 2))
+# Disk budget (in bytes) of the snapshots spilled out of memory, 0 keeps them in memory only
+LLAMA_SESSION_CACHE_DISK_BYTES = int(os.getenv("LLAMA_SESSION_CACHE_DISK_BYTES", 2 * 1024 ** 3))
+LLAMA_SESSION_CACHE_DIR = os.getenv("LLAMA_SESSION_CACHE_DIR", str(root_dir / "storage" / "llama_state" / "sessions"))
+# Seconds a conversation snapshot stays valid after the turn it was saved at
+LLAMA_SESSION_CACHE_TTL = float(os.getenv("LLAMA_SESSION_CACHE_TTL", 60 * 60))
+
+
+###############
+## LLM clients
+###############
+
+# Seconds the previous client of an updated or deleted alias keeps its connections open, for the requests still using it
+LLM_CLIENT_CLOSE_GRACE = float(os.getenv("LLM_CLIENT_CLOSE_GRACE", 5 * 60))
+
+
+##################################
+## LLM response (completion) cache
+##################################
+
+# Responses kept in the in-memory tier, the SQLite tier keeps every response until it expires
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+# Seconds a cached response stays valid, when the alias does not set its own TTL. Temperature 0 responses never expire
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 24 * 60 * 60))
+# Seconds between two purges of the expired responses of the SQLite tier
+RESPONSE_CACHE_PURGE_INTERVAL = float(os.getenv("RESPONSE_CACHE_PURGE_INTERVAL", 10 * 60))
+
+
+#####################
+## LLM semantic cache
+#####################
+
+# Cosine similarity a cached prompt must reach to be served, when the alias does not set its own threshold
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+# Prompts kept in the in-memory vector index, least recently used ones are evicted first
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 2048))
+# Seconds a cached answer stays valid, 0 keeps answers until they are evicted
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 24 * 60 * 60))
+
+
+##########################
+## LLM model catalog cache
+##########################
+
+# Seconds the model lists and tunable parameters of an alias are served without asking the provider again
+MODEL_CATALOG_TTL = float(os.getenv("MODEL_CATALOG_TTL", 5 * 60))
+# Seconds past the TTL a catalog is still served while it is refreshed in the background
+MODEL_CATALOG_MAX_STALE = float(os.getenv("MODEL_CATALOG_MAX_STALE", 24 * 60 * 60))
+
+
+####################################
+## Token counting and context window
+####################################
+
+# Context window assumed for models whose window is unknown
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", 8192))
+# What to do with a chat that does not fit in the context window: "trim" drops the oldest messages, "reject" fails the request
+CONTEXT_OVERFLOW_POLICY = os.getenv("CONTEXT_OVERFLOW_POLICY", "trim")
+
+
+##############
+## LLM routers
+##############
+
+# Requests per target kept in the rolling latency and error window
+ROUTER_STATS_WINDOW = int(os.getenv("ROUTER_STATS_WINDOW", 100))
+# Consecutive failures that trip the circuit breaker of a target
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", 3))
+# Seconds a tripped target is skipped before a single request probes it again
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", 30))
+
+
+##################
+## LLM rate limits
+##################
+
+# Default requests and tokens (prompt + max_tokens) per minute of a remote alias, 0 for no limit
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", 0))
+RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", 0))
+# Requests of an alias that may wait for capacity at once, further ones are refused
+RATE_LIMIT_MAX_QUEUE = int(os.getenv("RATE_LIMIT_MAX_QUEUE", 100))
+# Retries of a request that failed with a retryable provider error (429, 5xx, timeout)
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", 4))
+# Seconds of the first retry backoff, doubled on every retry up to the max, and jittered
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", 1))
+RATE_LIMIT_BACKOFF_MAX = float(os.getenv("RATE_LIMIT_BACKOFF_MAX", 30))
+
+
+##################
+## Hedged requests
+##################
+
+# Percentile of the recent first-token latencies of an alias after which a request is hedged
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+# Largest share of the recent requests of an alias that may be hedged
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", 0.1))
+# Requests of an alias seen before hedging starts, and the size of its latency window
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", 200))
+
+
+##################
+## Batch workloads
+##################
+
+# Requests of an alias that batch workloads (batch endpoint, bulk jobs) run at once
+BATCH_ALIAS_CONCURRENCY = int(os.getenv("BATCH_ALIAS_CONCURRENCY", 8))
+# Requests accepted by a single call of the batch chat endpoint
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 1000))
+
+
+############
+## Bulk jobs
+############
+
+# Items of a job in flight at once, the per-alias cap of the batch workloads applies on top
+BULK_JOB_MAX_IN_FLIGHT = int(os.getenv("BULK_JOB_MAX_IN_FLIGHT", 64))
+# Results written to the DB at once, and the longest time a result waits to be written (its checkpoint)
+BULK_JOB_FLUSH_SIZE = int(os.getenv("BULK_JOB_FLUSH_SIZE", 100))
+BULK_JOB_FLUSH_INTERVAL = float(os.getenv("BULK_JOB_FLUSH_INTERVAL", 2))
+
+
+#############
+## Embeddings
+#############
+
+# Texts sent to a provider in one embeddings request, providers with a lower limit use theirs
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+# Seconds a request waits for concurrent ones to share its provider batch
+EMBEDDING_BATCH_WAIT = float(os.getenv("EMBEDDING_BATCH_WAIT", 0.01))
+# Embeddings kept in memory, every embedding is also stored in the storage DB
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 10000))
+
+
+############
+## Streaming
+############
+
+# Seconds the tokens of a stream are gathered into one SSE frame, a token arriving after a quiet period is sent at once
+STREAM_FRAME_INTERVAL = float(os.getenv("STREAM_FRAME_INTERVAL", 0.02))
+# Characters of content after which a frame is sent without waiting for the interval
+STREAM_FRAME_MAX_CHARS = int(os.getenv("STREAM_FRAME_MAX_CHARS", 2048))
+
+
+################
+## Chat sessions
+################
+
+# Tokens of the latest turns of a session sent verbatim with every turn, older turns are only sent as the summary
+CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", 3072))
+# Tokens of the latest turns left out of the summary when it is updated, the gap to the max is summarized at once
+CHAT_HISTORY_KEEP_TOKENS = int(os.getenv("CHAT_HISTORY_KEEP_TOKENS", 1536))
+# Completion tokens of the running summary of the older turns
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", 512))
+
+
+##########################
+## Provider prompt caching
+##########################
+
+# Mark the system prompt and the chat as cacheable for providers whose prompt cache is explicit (Anthropic): the next
+# turn of a chat then reads its prefix from the cache, at a fraction of the price and prefill time. Writing the cache
+# costs a little more than a plain prompt, prompts shorter than the minimum of the model are never cached
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
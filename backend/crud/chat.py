@@ -0,0 +1,88 @@
+import time
+import uuid
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+from models.chat import ChatSession, ChatMessage
+from typing import List, Optional, Tuple
+
+
+def create_session(db: Session, title: Optional[str] = None) -> ChatSession:
+    now = time.time()
+    session = ChatSession(id=uuid.uuid4().hex, title=title, summarized_upto=0, message_count=0, created_at=now, updated_at=now)
+    db.add(session)
+    db.commit()
+    db.refresh(session)
+    return session
+
+
+def get_session_by_id(db: Session, session_id: str) -> Optional[ChatSession]:
+    return db.query(ChatSession).filter(ChatSession.id == session_id).first()
+
+
+def get_sessions(db: Session, limit: Optional[int] = None) -> List[ChatSession]:
+    query = db.query(ChatSession).order_by(ChatSession.updated_at.desc())
+    if limit:
+        return query.limit(limit).all()
+    return query.all()
+
+
+def delete_session_by_id(db: Session, session_id: str) -> Optional[ChatSession]:
+    session = get_session_by_id(db, session_id)
+    if not session:
+        return None
+    db.query(ChatMessage).filter(ChatMessage.session_id == session_id).delete()
+    db.delete(session)
+    db.commit()
+    return session
+
+
+def add_messages(db: Session, session_id: str, messages: List[Tuple[str, str]]) -> Optional[ChatSession]:
+    """Append (role, content) messages to a session, in one transaction."""
+    session = get_session_by_id(db, session_id)
+    if not session:
+        return None
+    now = time.time()
+    start = session.message_count
+    db.execute(insert(ChatMessage), [
+        {"session_id": session_id, "index": start + i, "role": role, "content": content, "created_at": now}
+        for i, (role, content) in enumerate(messages)
+    ])
+    session.message_count = start + len(messages)
+    session.updated_at = now
+    db.commit()
+    db.refresh(session)
+    return session
+
+
+def get_messages(
+    db: Session,
+    session_id: str,
+    start: int = 0,
+    end: Optional[int] = None,
+    limit: Optional[int] = None,
+    newest_first: bool = False,
+) -> List[ChatMessage]:
+    """The messages of a session with an index in [start, end), oldest first unless newest_first."""
+    query = db.query(ChatMessage).filter(ChatMessage.session_id == session_id, ChatMessage.index >= start)
+    if end is not None:
+        query = query.filter(ChatMessage.index < end)
+    query = query.order_by(ChatMessage.index.desc() if newest_first else ChatMessage.index)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def update_summary(db: Session, session_id: str, summary: str, summarized_from: int, summarized_upto: int) -> bool:
+    """
+    Replace the summary of a session, which now covers its messages before summarized_upto.
+    Only applies if the summary still ends at summarized_from, so a concurrent update is not overwritten.
+    Returns:
+        bool: Whether the summary was replaced.
+    """
+    updated = db.execute(
+        update(ChatSession)
+        .where(ChatSession.id == session_id, ChatSession.summarized_upto == summarized_from)
+        .values(summary=summary, summarized_upto=summarized_upto)
+    ).rowcount
+    db.commit()
+    return bool(updated)
@@ -0,0 +1,130 @@
+import time
+import uuid
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+from models.jobs import BulkJob, BulkJobItem
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+def create_job(db: Session, items: Iterable[Tuple[Optional[str], dict]], chunk_size: int = 1000) -> BulkJob:
+    """
+    Create a job from its (custom_id, request) items, in the order they were uploaded.
+    Items are inserted in chunks, so large uploads do not build one huge statement.
+    """
+    now = time.time()
+    job = BulkJob(id=uuid.uuid4().hex, status="pending", created_at=now, updated_at=now)
+    db.add(job)
+    db.flush()
+    total, rows = 0, []
+    for index, (custom_id, request) in enumerate(items):
+        rows.append({"job_id": job.id, "index": index, "custom_id": custom_id, "request": request, "status": "pending", "attempts": 0})
+        if len(rows) == chunk_size:
+            db.execute(insert(BulkJobItem), rows)
+            total, rows = total + len(rows), []
+    if rows:
+        db.execute(insert(BulkJobItem), rows)
+        total += len(rows)
+    job.total_items = total
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def get_job_by_id(db: Session, job_id: str) -> Optional[BulkJob]:
+    return db.query(BulkJob).filter(BulkJob.id == job_id).first()
+
+
+def get_jobs(db: Session, limit: Optional[int] = None) -> List[BulkJob]:
+    query = db.query(BulkJob).order_by(BulkJob.created_at.desc())
+    if limit:
+        return query.limit(limit).all()
+    return query.all()
+
+
+def get_unfinished_jobs(db: Session) -> List[BulkJob]:
+    return db.query(BulkJob).filter(BulkJob.status.in_(["pending", "running"])).order_by(BulkJob.created_at).all()
+
+
+def update_job_status(db: Session, job_id: str, status: str, retry_failed: bool = False) -> Optional[BulkJob]:
+    """Set the status of a job; retry_failed sends its failed items back to pending."""
+    job = get_job_by_id(db, job_id)
+    if not job:
+        return None
+    if retry_failed:
+        db.execute(
+            update(BulkJobItem)
+            .where(BulkJobItem.job_id == job_id, BulkJobItem.status == "failed")
+            .values(status="pending", error=None)
+        )
+        job.failed_items = 0
+    job.status = status
+    job.updated_at = time.time()
+    job.finished_at = time.time() if status in ("completed", "cancelled") else None
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def delete_job_by_id(db: Session, job_id: str) -> Optional[BulkJob]:
+    job = get_job_by_id(db, job_id)
+    if not job:
+        return None
+    db.query(BulkJobItem).filter(BulkJobItem.job_id == job_id).delete()
+    db.delete(job)
+    db.commit()
+    return job
+
+
+def get_pending_items(db: Session, job_id: str, after_id: int, limit: int) -> List[Tuple[int, dict]]:
+    """The (id, request) of the next pending items of a job, in upload order."""
+    rows = (
+        db.query(BulkJobItem.id, BulkJobItem.request)
+        .filter(BulkJobItem.job_id == job_id, BulkJobItem.status == "pending", BulkJobItem.id > after_id)
+        .order_by(BulkJobItem.id)
+        .limit(limit)
+        .all()
+    )
+    return [(row.id, row.request) for row in rows]
+
+
+def save_item_results(db: Session, job_id: str, results: List[Tuple[int, str, Optional[dict], Optional[str]]], finished: bool = False) -> None:
+    """
+    Checkpoint the (item id, status, response, error) results of a job, and its progress counters, in one transaction.
+    Args:
+        finished (bool): Whether the job has no pending item left.
+    """
+    counts = {"completed": 0, "failed": 0}
+    for item_id, status, response, error in results:
+        # only pending items are written, so a checkpoint that is written twice is not counted twice
+        written = db.execute(
+            update(BulkJobItem)
+            .where(BulkJobItem.id == item_id, BulkJobItem.status == "pending")
+            .values(status=status, response=response, error=error, attempts=BulkJobItem.attempts + 1)
+        ).rowcount
+        counts[status] += written
+    job = get_job_by_id(db, job_id)
+    job.completed_items += counts["completed"]
+    job.failed_items += counts["failed"]
+    job.updated_at = time.time()
+    if finished and job.status == "running":
+        job.status = "completed"
+        job.finished_at = job.updated_at
+    db.commit()
+
+
+def iter_item_results(db: Session, job_id: str, page_size: int = 1000) -> Iterator[BulkJobItem]:
+    """Yield the items of a job in upload order, a page at a time."""
+    last_index = -1
+    while True:
+        page = (
+            db.query(BulkJobItem)
+            .filter(BulkJobItem.job_id == job_id, BulkJobItem.index > last_index)
+            .order_by(BulkJobItem.index)
+            .limit(page_size)
+            .all()
+        )
+        if not page:
+            return
+        yield from page
+        last_index = page[-1].index
+        db.expunge_all()
@@ -1,7 +1,8 @@
 from sqlalchemy.orm import Session
-from models.llms import LLMRemote, LLMLocal
+from models.llms import LLMRemote, LLMLocal, LLMRouter
 from typing import Optional
 from core.encryption import fernet_encrypt, fernet_decrypt
+from services.llms.registry import llm_registry
 
 
 #####################
@@ -34,6 +35,8 @@ def update_remote_llm_by_alias(db: Session, old_alias: str, new_alias: str, api_
     llm.api_key = fernet_encrypt(api_key)
     db.commit()
     db.refresh(llm)
+    llm_registry.invalidate(old_alias, is_remote=True)
+    llm_registry.invalidate(new_alias, is_remote=True)
     return llm
 
 
@@ -43,6 +46,7 @@ def delete_remote_llm_by_alias(db: Session, alias: str):
         return None
     db.delete(llm)
     db.commit()
+    llm_registry.invalidate(alias, is_remote=True)
     return llm
 
 
@@ -82,6 +86,7 @@ def update_local_llm_by_alias(db: Session, alias: str, provider: str, path: str)
     llm.path = path
     db.commit()
     db.refresh(llm)
+    llm_registry.invalidate(alias, is_remote=False)
     return llm
 
 
@@ -91,4 +96,67 @@ def delete_local_llm_by_alias(db: Session, alias: str):
         return None
     db.delete(llm)
     db.commit()
-    return llm
\ No newline at end of file
+    llm_registry.invalidate(alias, is_remote=False)
+    return llm
+
+
+###############
+## LLM Routers
+###############
+
+def get_router_llms(db: Session, limit: Optional[int] = None):
+    if limit:
+        return db.query(LLMRouter).limit(limit).all()
+    return db.query(LLMRouter).all()
+
+
+def get_router_llm_by_alias(db: Session, alias: str):
+    return db.query(LLMRouter).filter(LLMRouter.alias == alias).first()
+
+
+def create_router_llm(db: Session, alias: str, targets: list[dict]):
+    router = LLMRouter(alias=alias, targets=targets)
+    db.add(router)
+    db.commit()
+    db.refresh(router)
+    return router
+
+
+def update_router_llm_by_alias(db: Session, alias: str, targets: list[dict]):
+    router = db.query(LLMRouter).filter(LLMRouter.alias == alias).first()
+    if not router:
+        return None
+    router.targets = targets
+    db.commit()
+    db.refresh(router)
+    return router
+
+
+def delete_router_llm_by_alias(db: Session, alias: str):
+    router = db.query(LLMRouter).filter(LLMRouter.alias == alias).first()
+    if not router:
+        return None
+    db.delete(router)
+    db.commit()
+    return router
+
+
+###################
+## LLM settings
+###################
+
+def update_llm_settings(db: Session, alias: str, is_remote: bool, name: str, settings: dict):
+    """
+    Store a settings group (e.g. "response_cache") in the parameters of an alias.
+    Returns:
+        The updated LLM, or None if the alias does not exist.
+    """
+    model = LLMRemote if is_remote else LLMLocal
+    llm = db.query(model).filter(model.alias == alias).first()
+    if not llm:
+        return None
+    llm.parameters = {**(llm.parameters or {}), name: settings}  # reassigned, in-place changes of a JSON column are not tracked
+    db.commit()
+    db.refresh(llm)
+    llm_registry.invalidate(alias, is_remote=is_remote)
+    return llm
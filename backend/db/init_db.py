@@ -1,9 +1,12 @@
 from pathlib import Path
 from db.session import engine
 from db.base import Base
-from models.llms import LLMRemote, LLMLocal
+from models.llms import LLMRemote, LLMLocal, LLMRouter
 from models.flows import Flow
 from models.tools import Tool
+from models.cache import LLMResponseCacheEntry, LLMEmbeddingCacheEntry
+from models.jobs import BulkJob, BulkJobItem
+from models.chat import ChatSession, ChatMessage
 from db.utils import get_absolute_db_path
 
 DB_PATH = get_absolute_db_path(keep_url=False)
@@ -15,7 +18,11 @@ def init_db():
         Base.metadata.create_all(bind=engine)
         print("[AgentSmith DB] ✅ Database and tables created.")
     else:
-        print("[AgentSmith DB] ✅ Database already exists, skipping creation.")
+        Base.metadata.create_all(bind=engine)  # only creates the tables added since the database was created
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)  # and the indexes added to existing tables
+        print("[AgentSmith DB] ✅ Database already exists, missing tables created.")
 
 
 # in case the file is ran directly
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
@@ -5,9 +6,22 @@ from api.llms import router as llm_router
 from api.flows import router as flow_router
 from api.tools import router as tool_router
 from api.chatbot import router as chatbot_router
+from api.jobs import router as job_router
 from core.startup import startup
+from services.llms.cache.response import ResponseCacheBypassMiddleware
+from services.jobs.bulk import bulk_job_runner
+from services.sandbox.chatbot.sessions import chat_sessions
 
-app = FastAPI(title="Agentsmith API", description="Agentsmith API", version="0.0.1")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await bulk_job_runner.start()  # resume the bulk jobs interrupted by the last shutdown
+    yield
+    await bulk_job_runner.stop()
+    await chat_sessions.stop()
+
+
+app = FastAPI(title="Agentsmith API", description="Agentsmith API", version="0.0.1", lifespan=lifespan)
 
 
 # CORS middleware configuration
@@ -21,6 +35,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ResponseCacheBypassMiddleware)
 
 # Include routers
 router = APIRouter(prefix="/api")
@@ -28,6 +43,7 @@ router.include_router(llm_router)
 router.include_router(flow_router)
 router.include_router(tool_router)
 router.include_router(chatbot_router)
+router.include_router(job_router)
 app.include_router(router)
 
 
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, String, Float, JSON, LargeBinary
+from db.base import Base
+
+
+class LLMResponseCacheEntry(Base):
+    __tablename__ = 'llm_response_cache'
+
+    key = Column(String, primary_key=True)  # sha256 of the request
+    alias = Column(String, nullable=False, index=True)
+    model = Column(String, nullable=True)
+    chunks = Column(JSON, nullable=False)  # the streamed chunks of the response, replayed as they were received
+    created_at = Column(Float, nullable=False)
+    expires_at = Column(Float, nullable=True, index=True)  # None never expires
+
+
+class LLMEmbeddingCacheEntry(Base):
+    __tablename__ = 'llm_embedding_cache'
+
+    model = Column(String, primary_key=True)  # provider and embeddings model, e.g. openai:text-embedding-3-small
+    text_hash = Column(String, primary_key=True)  # sha256 of the text
+    vector = Column(LargeBinary, nullable=False)  # float32 embedding
+    created_at = Column(Float, nullable=False)
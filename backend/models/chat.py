@@ -0,0 +1,28 @@
+from sqlalchemy import Column, Integer, String, Float, Text, ForeignKey, Index
+from db.base import Base
+
+
+class ChatSession(Base):
+    __tablename__ = 'chat_sessions'
+
+    id = Column(String, primary_key=True)
+    title = Column(String, nullable=True)
+    summary = Column(Text, nullable=True)  # running summary of the turns before summarized_upto
+    summarized_upto = Column(Integer, nullable=False, default=0)  # index of the first message left out of the summary
+    message_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+
+class ChatMessage(Base):
+    __tablename__ = 'chat_messages'
+    __table_args__ = (
+        Index("ix_chat_messages_session_index", "session_id", "index", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String, ForeignKey("chat_sessions.id", ondelete="CASCADE"), nullable=False)
+    index = Column(Integer, nullable=False)  # position of the message in the session
+    role = Column(String, nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(Float, nullable=False)
@@ -0,0 +1,33 @@
+from sqlalchemy import Column, Integer, String, Float, JSON, ForeignKey, Index
+from db.base import Base
+
+
+class BulkJob(Base):
+    __tablename__ = 'bulk_jobs'
+
+    id = Column(String, primary_key=True)
+    status = Column(String, nullable=False, default="pending")  # pending, running, completed, cancelled
+    total_items = Column(Integer, nullable=False, default=0)
+    completed_items = Column(Integer, nullable=False, default=0)
+    failed_items = Column(Integer, nullable=False, default=0)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    finished_at = Column(Float, nullable=True)
+
+
+class BulkJobItem(Base):
+    __tablename__ = 'bulk_job_items'
+    __table_args__ = (
+        Index("ix_bulk_job_items_job_status", "job_id", "status", "id"),
+        Index("ix_bulk_job_items_job_index", "job_id", "index", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String, ForeignKey("bulk_jobs.id", ondelete="CASCADE"), nullable=False)
+    index = Column(Integer, nullable=False)  # line of the item in the uploaded JSONL
+    custom_id = Column(String, nullable=True)
+    request = Column(JSON, nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending, completed, failed
+    response = Column(JSON, nullable=True)
+    error = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
@@ -23,3 +23,10 @@ class LLMLocal(Base):
     parameters = Column(JSON, nullable=True)
 
 
+class LLMRouter(Base):
+    __tablename__ = 'llm_router'
+
+    id = Column(Integer, primary_key=True)
+    alias = Column(String, nullable=False, unique=True)
+    targets = Column(JSON, nullable=False)  # [{"alias", "type": "remote" | "local", "model"}]
+    parameters = Column(JSON, nullable=True)
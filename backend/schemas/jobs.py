@@ -0,0 +1,16 @@
+from pydantic import BaseModel
+from typing import Optional, Literal
+
+
+class BulkJobOut(BaseModel):
+    id: str
+    status: Literal["pending", "running", "completed", "cancelled"]
+    total_items: int
+    completed_items: int
+    failed_items: int
+    created_at: float
+    updated_at: float
+    finished_at: Optional[float] = None
+
+    class Config:
+        from_attributes = True
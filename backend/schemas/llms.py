@@ -1,6 +1,6 @@
 from enum import Enum
 from typing import Optional, Literal, Dict, Any
-from pydantic import BaseModel, Field, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl, model_validator
 
 
 class LLMType(str, Enum):
@@ -105,9 +105,218 @@ class ListLLMs(BaseModel):
 class ListModels(BaseModel):
     models: list[str]
 
+
+class LocalModelInfo(BaseModel):
+    file: str
+    size_bytes: int
+    architecture: Optional[str] = None
+    name: Optional[str] = None
+    size_label: Optional[str] = Field(None, description="Parameter count label, e.g. 8B")
+    quantization: Optional[str] = Field(None, description="Quantization type of the weights, e.g. Q4_K_M")
+    context_length: Optional[int] = Field(None, description="Context window the model was trained with")
+    embedding_length: Optional[int] = None
+    block_count: Optional[int] = None
+    vocab_size: Optional[int] = None
+    split_count: int = Field(1, description="Files the model is split across, the file is the first one")
+    is_embedding: bool = False
+
+
+class ListLocalModels(ListModels):
+    details: list[LocalModelInfo] = Field(default_factory=list, description="What the GGUF header of each model tells")
+
+
 class ListEmbeddingsModels(BaseModel):
     embeddings_models: list[str]
 
+
+class EmbeddingsRequest(BaseModel):
+    texts: list[str] = Field(..., min_length=1, description="Texts to embed")
+    model: Optional[str] = Field(None, description="Embeddings model, defaults to the first embeddings model of the LLM")
+
+
+class EmbeddingsResponse(BaseModel):
+    model: str
+    embeddings: list[list[float]]
+    cached: int = Field(..., description="Texts whose embedding was served from the embedding cache")
+
+
+class LoadedLocalModel(BaseModel):
+    model: str
+    size_bytes: int
+    idle_seconds: float
+    in_use: bool
+
+
+class UnloadedLocalModels(BaseModel):
+    unloaded: list[str]
+
+
+class ResponseCacheSettings(BaseModel):
+    enabled: bool = Field(False, description="Serve repeated completions of the alias from the response cache")
+    ttl: Optional[float] = Field(None, gt=0, description="Seconds a response stays cached, defaults to RESPONSE_CACHE_TTL")
+
+
+class ResponseCacheStats(BaseModel):
+    memory_entries: int
+    hits: int
+    memory_hits: int
+    db_hits: int
+    misses: int
+    bypassed: int
+    stores: int
+    hit_rate: float
+    aliases: Dict[str, Dict[str, int]]
+
+
+class ClearedResponseCache(BaseModel):
+    removed: int
+
+
+class SemanticCacheSettings(BaseModel):
+    enabled: bool = Field(False, description="Serve answers of similar past prompts of the alias from the semantic cache")
+    threshold: Optional[float] = Field(None, ge=0, le=1, description="Cosine similarity a past prompt must reach, defaults to SEMANTIC_CACHE_THRESHOLD")
+
+
+class SemanticCacheAliasStats(BaseModel):
+    hits: int
+    misses: int
+    stores: int
+    hit_rate: float
+    saved_latency_seconds: float
+
+
+class SemanticCacheStats(BaseModel):
+    entries: int
+    hits: int
+    misses: int
+    hit_rate: float
+    saved_latency_seconds: float
+    aliases: Dict[str, SemanticCacheAliasStats]
+
+class RateLimitSettings(BaseModel):
+    rpm: Optional[int] = Field(None, ge=0, description="Requests per minute, 0 for no limit, defaults to RATE_LIMIT_RPM")
+    tpm: Optional[int] = Field(None, ge=0, description="Prompt and completion tokens per minute, 0 for no limit, defaults to RATE_LIMIT_TPM")
+    max_queue: Optional[int] = Field(None, ge=0, description="Requests that may wait for capacity at once, defaults to RATE_LIMIT_MAX_QUEUE")
+
+
+class RateLimitStats(BaseModel):
+    rpm: int
+    tpm: int
+    queue_depth: int
+    max_queue: int
+    requests: int
+    queued: int
+    rejected: int
+    retries: int
+    wait_seconds: float
+    max_wait_seconds: float
+    avg_wait_seconds: float
+
+
+class RouterTarget(BaseModel):
+    alias: str = Field(..., description="Alias of a remote or local LLM")
+    type: Literal["remote", "local"]
+    model: str = Field(..., description="Model the target serves the router requests with")
+
+
+class HedgingSettings(BaseModel):
+    enabled: bool = Field(False, description="Send a duplicate of the requests of the alias that are slower than usual")
+    percentile: Optional[float] = Field(None, ge=50, lt=100, description="Percentile of the recent latencies after which a request is hedged, defaults to HEDGE_PERCENTILE")
+    max_rate: Optional[float] = Field(None, ge=0, le=1, description="Largest share of the requests that may be hedged, defaults to HEDGE_MAX_RATE")
+    alternate: Optional[RouterTarget] = Field(None, description="Alias (and model) the hedges go to, defaults to the alias itself")
+
+
+class SpeculativeSettings(BaseModel):
+    mode: Optional[Literal["draft_model", "prompt_lookup"]] = Field(None, description="Speculative decoding with a draft GGUF model, or prompt-lookup decoding; None disables it")
+    draft_model: Optional[str] = Field(None, description="GGUF file of the draft model, in the path of the alias, it must share the vocabulary of the models of the alias")
+    draft_tokens: Optional[int] = Field(None, ge=1, le=16, description="Draft tokens proposed per step, defaults to LLAMA_SPECULATIVE_DRAFT_TOKENS")
+    ngram_max: Optional[int] = Field(None, ge=1, le=8, description="Longest n-gram looked up in the prompt, defaults to LLAMA_PROMPT_LOOKUP_NGRAM")
+
+    @model_validator(mode="after")
+    def check_draft_model(self):
+        if self.mode == "draft_model" and not self.draft_model:
+            raise ValueError("draft_model is required for speculative decoding with a draft model")
+        return self
+
+
+class LocalBenchmarkRequest(BaseModel):
+    n_threads: Optional[list[int]] = Field(None, description="Thread counts to try, defaults to the powers of two below the CPU count, half of it and all of it")
+    n_batch: Optional[list[int]] = Field(None, description="Batch sizes to try, larger than prompt_tokens are skipped")
+    n_ctx: Optional[list[int]] = Field(None, description="Context windows of a sequence to try, each allocated for LLAMA_BATCH_MAX_SEQUENCES sequences like the batch scheduler does, defaults to 1024 up to LLAMA_TUNE_MAX_N_CTX")
+    prompt_tokens: Optional[int] = Field(None, ge=32, le=8192, description="Prompt tokens prefilled by each run, defaults to LLAMA_TUNE_PROMPT_TOKENS")
+    decode_tokens: Optional[int] = Field(None, ge=1, le=512, description="Tokens decoded by each run, defaults to LLAMA_TUNE_DECODE_TOKENS")
+    apply: bool = Field(True, description="Store the picked load parameters in the settings of the alias, they are used on every load of the model")
+
+
+class LocalBenchmarkRun(BaseModel):
+    stage: Literal["threads", "batch", "context"]
+    n_threads: Optional[int] = None
+    n_batch: Optional[int] = None
+    n_ctx: Optional[int] = None
+    prefill_tps: Optional[float] = Field(None, description="Prompt tokens evaluated per second")
+    decode_tps: Optional[float] = Field(None, description="Tokens decoded per second")
+
+
+class LocalBenchmarkResult(BaseModel):
+    model: str
+    load_params: Dict[str, int] = Field(..., description="The picked n_threads, n_threads_batch, n_batch, n_ubatch and n_ctx")
+    runs: list[LocalBenchmarkRun]
+    cpu_count: Optional[int] = None
+    seconds: float
+    applied: bool
+
+
+class HedgingStats(BaseModel):
+    requests: int
+    hedges: int
+    hedge_wins: int
+    capped: int
+    hedge_rate: float
+    latency_p50: Optional[float] = None
+    latency_p95: Optional[float] = None
+    latency_p99: Optional[float] = None
+    unhedged_latency_p50: Optional[float] = None
+    unhedged_latency_p95: Optional[float] = None
+    unhedged_latency_p99: Optional[float] = None
+    ttft_p50: Optional[float] = None
+    ttft_p95: Optional[float] = None
+    ttft_p99: Optional[float] = None
+    unhedged_ttft_p50: Optional[float] = None
+    unhedged_ttft_p95: Optional[float] = None
+    unhedged_ttft_p99: Optional[float] = None
+
+
+class RouterLLM(BaseModel):
+    """Model for router aliases, which spread requests over remote and local aliases"""
+    alias: str
+    targets: list[RouterTarget] = Field(..., min_length=1, description="Targets, in order of preference when their latency is equal")
+
+    class Config:
+        from_attributes = True
+        json_schema_extra = {
+            "example": {
+                "alias": "Fast chat",
+                "targets": [
+                    {"alias": "My OpenAI API", "type": "remote", "model": "gpt-4o-mini"},
+                    {"alias": "My Local LLaMA", "type": "local", "model": "llama-3-8b.Q4_K_M.gguf"},
+                ]
+            }
+        }
+
+
+class RouterTargetStats(BaseModel):
+    alias: str
+    type: Literal["remote", "local"]
+    model: str
+    requests: int
+    error_rate: float
+    latency_p50: Optional[float] = None
+    latency_p95: Optional[float] = None
+    ttft_p50: Optional[float] = None
+    ttft_p95: Optional[float] = None
+    breaker: Literal["closed", "open", "half_open"]
+
+
 # Union type that can represent any LLM type
 LLM = RemoteLLM | LocalLLM
 
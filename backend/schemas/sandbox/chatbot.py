@@ -10,17 +10,27 @@ class ChatRequest(BaseModel):
     messages: List[Message]
     model: Optional[str] = Field(None, description="Optional model name")
     llm_alias: str = Field(..., description="Alias for the LLM configuration")
-    llm_type: Literal['remote', 'local'] = Field(..., description="Type of LLM: 'remote' or 'local'")
+    llm_type: Literal['remote', 'local', 'router'] = Field(..., description="Type of LLM: 'remote', 'local' or 'router'")
     temperature: Optional[float] = Field(None, ge=0, le=1)
     max_tokens: Optional[int] = Field(None, ge=1, le=4096)
     top_p: Optional[float] = Field(None, ge=0, le=1)
     frequency_penalty: Optional[float] = Field(None, ge=0, le=2)
     presence_penalty: Optional[float] = Field(None, ge=0, le=2)
+    conversation_id: Optional[str] = Field(None, description="Conversation id, lets local models resume from the state of the previous turn")
+    session_id: Optional[str] = Field(None, description="Chat session id, the history is then kept server side and messages only holds the new messages")
+
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., min_length=1, description="Chat requests, answered in completion order with their index")
+
+class PromptTokensDetails(BaseModel):
+    cached_tokens: int = Field(0, description="Prompt tokens read from the prompt cache of the provider")
+    cache_creation_tokens: int = Field(0, description="Prompt tokens written to the prompt cache of the provider")
 
 class TokenUsage(BaseModel):
     prompt_tokens: int
     completion_tokens: int
     total_tokens: int
+    prompt_tokens_details: Optional[PromptTokensDetails] = None
 
 class ChatResponse(BaseModel):
     id: str
@@ -36,3 +46,27 @@ class ChatCompletionChunk(BaseModel):
     created: int
     model: str
     choices: List[Dict[str, Any]]
+
+class ChatSessionCreate(BaseModel):
+    title: Optional[str] = None
+
+class ChatSessionOut(BaseModel):
+    id: str
+    title: Optional[str] = None
+    summary: Optional[str] = None
+    summarized_upto: int
+    message_count: int
+    created_at: float
+    updated_at: float
+
+    class Config:
+        from_attributes = True
+
+class ChatMessageOut(BaseModel):
+    index: int
+    role: str
+    content: str
+    created_at: float
+
+    class Config:
+        from_attributes = True
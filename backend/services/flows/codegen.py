@@ -2,7 +2,7 @@ from jinja2 import Environment, FileSystemLoader, select_autoescape
 from schemas.flows import FlowPayload
 import os
 from db.session import get_db 
-from services.llms.factory import get_llm_client_by_alias
+from services.llms.factory import get_llm_client
 from services.tools.factory import get_tool_by_name
 from sqlalchemy.orm import Session
 
@@ -33,8 +33,7 @@ class CodeGenerator:
 
             # LLMs
             if node.data.llm is not None and node.data.llm.alias not in llms.keys():
-                is_remote = node.data.llm.type == "remote"
-                llm = get_llm_client_by_alias(node.data.llm.alias, db=self.db, is_remote=is_remote)
+                llm = get_llm_client(node.data.llm.alias, db=self.db, llm_type=node.data.llm.type)
                 llms[node.data.llm.alias] = llm.to_code(node.data.llm.model)
 
             if len(llms) == 0: llms["default"] = "pass"
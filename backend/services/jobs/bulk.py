@@ -0,0 +1,176 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from sqlalchemy.orm import sessionmaker
+from core.config import BULK_JOB_MAX_IN_FLIGHT, BULK_JOB_FLUSH_SIZE, BULK_JOB_FLUSH_INTERVAL
+from crud.jobs import get_unfinished_jobs, update_job_status, get_pending_items, save_item_results
+from db.session import SessionLocal
+from schemas.sandbox.chatbot import ChatRequest
+from services.llms.concurrency import alias_concurrency
+
+
+# complete(request) -> response of a chat request, e.g. a chat completion of the LLM service
+Completer = Callable[[dict], Awaitable[dict]]
+
+ItemResult = Tuple[int, str, Optional[dict], Optional[str]]  # (item id, status, response, error)
+
+
+class ChatCompleter:
+    """Runs the chat requests of the job items through the chatbot LLM service, like /playground/chatbot/chat does."""
+
+    def __init__(self):
+        self._service = None
+
+
+    async def __call__(self, request: dict) -> dict:
+        if self._service is None:
+            # the service opens a DB session and pulls in every provider, it is only built once a job runs
+            from services.sandbox.chatbot.llm_service import LLMService
+            self._service = LLMService()
+        chat = ChatRequest.model_validate(request)
+        if not chat.model and chat.llm_type != "router":
+            raise ValueError("Model must be specified")
+        response = None
+        async for chunk in self._service.generate_chat_completion(
+            messages=chat.messages,
+            model=chat.model,
+            llm_alias=chat.llm_alias,
+            llm_type=chat.llm_type,
+            temperature=chat.temperature,
+            max_tokens=chat.max_tokens,
+            top_p=chat.top_p,
+            frequency_penalty=chat.frequency_penalty,
+            presence_penalty=chat.presence_penalty,
+            stream=False,
+        ):
+            response = chunk
+        return response
+
+
+class BulkJobRunner:
+    """
+    Runs the bulk completion jobs in the background of the API process.
+
+    Every job has a task that feeds its pending items to the LLM layer, at most max_in_flight at once and within the
+    per-alias cap shared with the other batch workloads. Results are checkpointed to the DB every flush_size results
+    or flush_interval seconds; an item stays pending until its result is written, so a job interrupted by a restart
+    resumes from its last checkpoint and only re-runs the items that were in flight.
+
+    Args:
+        session_factory (sessionmaker): Opens the DB sessions of the runner.
+        complete (Optional[Completer]): Answers the request of an item, defaults to the chatbot LLM service.
+        max_in_flight (int): Items of a job in flight at once.
+        flush_size (int): Results written to the DB at once.
+        flush_interval (float): Longest time a result waits to be written.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker = SessionLocal,
+        complete: Optional[Completer] = None,
+        max_in_flight: int = BULK_JOB_MAX_IN_FLIGHT,
+        flush_size: int = BULK_JOB_FLUSH_SIZE,
+        flush_interval: float = BULK_JOB_FLUSH_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.complete = complete or ChatCompleter()
+        self.max_in_flight = max_in_flight
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+
+    async def start(self) -> None:
+        """Resume the jobs a previous run of the server left pending or running."""
+        jobs = await asyncio.to_thread(self._db, get_unfinished_jobs)
+        for job in jobs:
+            print(f"[AgentSmith Jobs] Resuming bulk job {job.id} ({job.completed_items + job.failed_items}/{job.total_items} done)")
+            self.submit(job.id)
+
+
+    async def stop(self) -> None:
+        """Stop the running jobs, they are resumed by the next start."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    def submit(self, job_id: str) -> None:
+        """Start running a job, unless it already runs."""
+        if job_id in self._tasks:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+
+    def is_running(self, job_id: str) -> bool:
+        return job_id in self._tasks
+
+
+    async def cancel(self, job_id: str) -> None:
+        """Stop a job and mark it cancelled, the results of its finished items are kept."""
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await asyncio.to_thread(self._db, update_job_status, job_id, "cancelled")
+
+
+    async def wait(self, job_id: str) -> None:
+        """Wait for a running job to stop."""
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+
+    def _db(self, fn, *args, **kwargs):
+        with self.session_factory() as db:
+            return fn(db, *args, **kwargs)
+
+
+    async def _run(self, job_id: str) -> None:
+        job = await asyncio.to_thread(self._db, update_job_status, job_id, "running")
+        if job is None:
+            return
+        in_flight: set = set()
+        results: List[ItemResult] = []
+        last_id, exhausted, last_flush = 0, False, time.monotonic()
+        try:
+            while True:
+                while not exhausted and len(in_flight) < self.max_in_flight:
+                    page = await asyncio.to_thread(self._db, get_pending_items, job_id, last_id, self.max_in_flight - len(in_flight))
+                    if not page:
+                        exhausted = True
+                        break
+                    last_id = page[-1][0]
+                    in_flight.update(asyncio.ensure_future(self._run_item(item_id, request)) for item_id, request in page)
+                if not in_flight:
+                    break
+                done, in_flight = await asyncio.wait(in_flight, timeout=self.flush_interval, return_when=asyncio.FIRST_COMPLETED)
+                results.extend(task.result() for task in done)
+                if len(results) >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval:
+                    await asyncio.to_thread(self._db, save_item_results, job_id, results)
+                    results, last_flush = [], time.monotonic()
+            await asyncio.to_thread(self._db, save_item_results, job_id, results, finished=True)
+            print(f"[AgentSmith Jobs] Bulk job {job_id} completed")
+        except asyncio.CancelledError:
+            for task in in_flight:
+                task.cancel()
+            # keep what already finished, the cancelled items stay pending
+            results.extend(task.result() for task in in_flight if task.done() and not task.cancelled())
+            await asyncio.to_thread(self._db, save_item_results, job_id, results)
+            raise
+
+
+    async def _run_item(self, item_id: int, request: dict) -> ItemResult:
+        try:
+            async with alias_concurrency.slot(request.get("llm_type", "remote"), request.get("llm_alias", "")):
+                response = await self.complete(request)
+            return item_id, "completed", response, None
+        except Exception as e:
+            return item_id, "failed", None, str(e)
+
+
+bulk_job_runner = BulkJobRunner()
@@ -1,13 +1,81 @@
 from abc import ABC, abstractmethod
+import asyncio
 import os
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from typing import Optional, AsyncGenerator
+from typing import Dict, List, Optional, AsyncGenerator
+
+
+# HTTP statuses of provider errors that may succeed when the request is sent again
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class LLMProviderError(RuntimeError):
+    """
+    Error of an LLM provider API, with what is needed to decide whether to retry the request.
+
+    Attributes:
+        status_code (Optional[int]): The HTTP status, None for connection errors and timeouts.
+        retry_after (Optional[float]): Seconds the provider asked to wait before retrying.
+    """
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+    @property
+    def retryable(self) -> bool:
+        return self.status_code is None or self.status_code in RETRYABLE_STATUS_CODES
+
+
+    @classmethod
+    def from_api_error(cls, message: str, error: Exception) -> "LLMProviderError":
+        """Wrap an error of a provider SDK (openai, anthropic, huggingface_hub)."""
+        response = getattr(error, "response", None)
+        status_code = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+        retry_after = None
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        return cls(f"{message}: {error}", status_code=status_code, retry_after=retry_after)
+
+
+def record_usage(
+    usage: Optional[dict],
+    prompt_tokens: Optional[int],
+    completion_tokens: Optional[int],
+    cached_tokens: Optional[int] = 0,
+    cache_creation_tokens: Optional[int] = 0,
+) -> None:
+    """
+    Fill the usage dict a caller passed to a completion with the token counts the provider reported.
+    Args:
+        usage (Optional[dict]): The usage kwarg of the completion, None when the caller does not ask for it.
+        prompt_tokens (Optional[int]): Every prompt token, cached or not.
+        completion_tokens (Optional[int]): The generated tokens.
+        cached_tokens (Optional[int]): Prompt tokens read from the prompt cache of the provider.
+        cache_creation_tokens (Optional[int]): Prompt tokens written to the prompt cache of the provider.
+    """
+    if usage is None or prompt_tokens is None:
+        return
+    usage.update(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens or 0,
+        cached_tokens=cached_tokens or 0,
+        cache_creation_tokens=cache_creation_tokens or 0,
+    )
 
 
 class BaseLLM(ABC):
     """
     Base class for LLMs.
 
+    Completions take a system prompt and a user prompt. Chat clients also pass the chat as messages, a list of
+    {"role", "content"} dicts, oldest first: the providers send them as native turns rather than the user prompt, so
+    the prompt of a turn extends the prompt of the previous one and the providers serve that prefix from their prompt
+    cache. A usage dict passed along is filled with the token counts the provider reports (see record_usage).
+
     Attributes:
         name (str): The name of the LLM.
         client: The client for the LLM.
@@ -26,12 +94,32 @@ class BaseLLM(ABC):
         )
         self.template = None  # Template for rendering code
 
+
+    @staticmethod
+    def chat_messages(system_prompt: str, user_prompt: str, messages: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+        """
+        The messages of a chat completion request: the system prompt, then the user and assistant messages of the chat,
+        or the user prompt as the only message when there is no chat.
+        """
+        turns = [
+            {"role": message["role"], "content": message["content"]} for message in messages or [] if message["role"] != "system"
+        ]
+        return [{"role": "system", "content": system_prompt}, *(turns or [{"role": "user", "content": user_prompt}])]
+
     @abstractmethod
     def get_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
         """Get a non-streaming completion from the LLM."""
         ...
 
 
+    async def aget_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        """
+        Get a non-streaming completion from the LLM without blocking the event loop.
+        Providers with a native async client override this, the default runs get_completion in a worker thread.
+        """
+        return await asyncio.to_thread(self.get_completion, system_prompt, user_prompt, **kwargs)
+
+
     @abstractmethod
     def stream_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> AsyncGenerator[str, None]:
         """Stream a completion from the LLM."""
@@ -49,6 +137,35 @@ class BaseLLM(ABC):
         """List available embeddings models."""
         ...
 
+
+    # Texts a provider accepts in one embeddings request
+    max_embedding_batch: int = 256
+
+    def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        """
+        Embed texts with an embeddings model of the LLM.
+        Args:
+            texts (List[str]): The texts to embed.
+            model (str): One of the embeddings models of the LLM.
+        Returns:
+            List[List[float]]: One embedding per text, in the order of the texts.
+        """
+        raise NotImplementedError(f"{self.name} does not provide embeddings models")
+
+
+    async def aembed(self, texts: List[str], model: str) -> List[List[float]]:
+        """Embed texts without blocking the event loop, the default runs embed in a worker thread."""
+        return await asyncio.to_thread(self.embed, texts, model)
+
+
+    def close(self) -> None:
+        """Close the connections of the sync client, the default has none."""
+
+
+    async def aclose(self) -> None:
+        """Close the connections of the sync and async clients, the default has none."""
+        self.close()
+
     @abstractmethod
     def to_code(self, model: str) -> str:
         """Generate a Python code snippet for the LLM."""
@@ -73,9 +190,26 @@ class BaseLLM(ABC):
 class BaseAPILLM(BaseLLM):
     """Base class for API LLMs."""
 
-    def __init__(self, name: str, api_key: Optional[str] = None):
+    def __init__(self, name: str, api_key: Optional[str] = None, base_url: Optional[str] = None):
         super().__init__(name)
         self.api_key = api_key
+        self.base_url = base_url
+        self.async_client = None
+
+
+    def close(self) -> None:
+        """Close the HTTP connection pool of the sync SDK client."""
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+
+    async def aclose(self) -> None:
+        """Close the HTTP connection pools of the SDK clients, the async one on the event loop it was used on."""
+        self.close()
+        close = getattr(self.async_client, "close", None)
+        if close is not None:
+            await close()
 
     @staticmethod
     @abstractmethod
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional, Set, Tuple
+from core.config import MODEL_CATALOG_TTL, MODEL_CATALOG_MAX_STALE
+from services.llms.registry import llm_registry
+
+
+CatalogKey = Tuple[str, bool, str, Hashable]  # (alias, is_remote, catalog, argument)
+
+
+class ModelCatalogCache:
+    """
+    Per-alias cache of the model catalogs (models, embeddings models, tunable parameters) of the LLM clients.
+
+    A catalog is fresh for ttl seconds. After that it is still served, stale, for up to max_stale more seconds
+    while a background refresh fetches it again; only a missing or too old catalog is fetched by the caller.
+    A fetch that fails, or comes back empty, leaves the cached catalog in place.
+    Concurrent fetches of the same catalog are coalesced, and the catalogs of an alias are dropped when the
+    alias is updated or deleted.
+
+    Args:
+        ttl (float): Seconds a catalog is served without refreshing it.
+        max_stale (float): Seconds past the ttl a catalog is still served while it is refreshed.
+    """
+
+    def __init__(self, ttl: float = MODEL_CATALOG_TTL, max_stale: float = MODEL_CATALOG_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries: Dict[CatalogKey, Tuple[object, float]] = {}  # key -> (catalog, fetched_at)
+        self._loading: Dict[CatalogKey, threading.Lock] = {}
+        self._refreshing: Set[CatalogKey] = set()
+        self._generation: Dict[Tuple[str, bool], int] = {}  # bumped on invalidation, so in-flight fetches are discarded
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-catalog-refresh")
+
+
+    def get(self, alias: str, is_remote: bool, catalog: str, loader: Callable[[], object], argument: Hashable = None) -> object:
+        """
+        Get a catalog of an alias.
+        Args:
+            alias (str): The LLM alias.
+            is_remote (bool): Whether the alias is a remote or a local LLM.
+            catalog (str): The name of the catalog, e.g. "models".
+            loader (Callable[[], object]): Fetches the catalog from the LLM client.
+            argument (Hashable): The argument the catalog depends on, e.g. the model of the tunable parameters.
+        Returns:
+            object: The catalog.
+        """
+        key = (alias, is_remote, catalog, argument)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                value, fetched_at = cached
+                age = now - fetched_at
+                if age <= self.ttl:
+                    return value
+                if age <= self.ttl + self.max_stale:
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        self._executor.submit(self._refresh, key, loader)
+                    return value
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                cached = self._entries.get(key)
+                if cached is not None and time.monotonic() - cached[1] <= self.ttl:
+                    return cached[0]
+            return self._load(key, loader)
+
+
+    async def aget(self, alias: str, is_remote: bool, catalog: str, loader: Callable[[], object], argument: Hashable = None) -> object:
+        """Like get, a catalog that has to be fetched is fetched in a worker thread."""
+        key = (alias, is_remote, catalog, argument)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and time.monotonic() - cached[1] <= self.ttl:
+                return cached[0]
+        return await asyncio.to_thread(self.get, alias, is_remote, catalog, loader, argument)
+
+
+    def invalidate(self, alias: str, is_remote: Optional[bool] = None) -> None:
+        """Drop the catalogs of an alias."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == alias and (is_remote is None or key[1] == is_remote)]:
+                del self._entries[key]
+            for remote in ([is_remote] if is_remote is not None else [True, False]):
+                self._generation[(alias, remote)] = self._generation.get((alias, remote), 0) + 1
+
+
+    def _load(self, key: CatalogKey, loader: Callable[[], object]) -> object:
+        with self._lock:
+            generation = self._generation.get(key[:2], 0)
+        try:
+            value = loader()
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        with self._lock:
+            if not value:
+                # the providers list nothing when they can not be reached, an empty catalog is a failed fetch: it is
+                # not cached and the previous catalog, if any, keeps being served
+                cached = self._entries.get(key)
+                if cached is not None:
+                    print(f"[AgentSmith LLM] The {key[2]} catalog of {key[0]} came back empty, serving the cached one")
+                    return cached[0]
+            elif self._generation.get(key[:2], 0) == generation:
+                self._entries[key] = (value, time.monotonic())
+        return value
+
+
+    def _refresh(self, key: CatalogKey, loader: Callable[[], object]) -> None:
+        try:
+            self._load(key, loader)
+        except Exception as e:
+            print(f"[AgentSmith LLM] Could not refresh the {key[2]} catalog of {key[0]}, serving the cached one: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+model_catalog = ModelCatalogCache()
+llm_registry.add_invalidation_listener(model_catalog.invalidate)
@@ -0,0 +1,432 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import aclosing, contextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+from core.config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PURGE_INTERVAL
+from db.session import SessionLocal
+from models.cache import LLMResponseCacheEntry
+from services.llms.proxy import LLMProxy
+
+
+# Requests with this header (any value), or with "Cache-Control: no-cache", skip the response cache
+CACHE_BYPASS_HEADER = "x-llm-cache-bypass"
+
+_bypass: ContextVar[bool] = ContextVar("llm_response_cache_bypass", default=False)
+
+
+class ResponseCacheBypassMiddleware:
+    """ASGI middleware that turns the response cache off for the requests that carry the bypass header."""
+
+    def __init__(self, app):
+        self.app = app
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        cache_control = headers.get(b"cache-control", b"").decode("latin-1").lower()
+        bypass = CACHE_BYPASS_HEADER.encode() in headers or "no-cache" in cache_control or "no-store" in cache_control
+        token = _bypass.set(bypass)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _bypass.reset(token)
+
+
+def is_cache_bypassed() -> bool:
+    """Whether the current request asked to skip the LLM caches."""
+    return _bypass.get()
+
+
+@contextmanager
+def cache_bypass():
+    """Skip the response cache for the LLM calls made inside the block."""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+class _Flight:
+    """The provider call of a request, shared by its concurrent callers, who each read its chunks at their own pace."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._updated = asyncio.Event()
+
+
+    def publish(self, chunk: Optional[str] = None, done: bool = False, error: Optional[BaseException] = None) -> None:
+        if chunk is not None:
+            self.chunks.append(chunk)
+        self.done = self.done or done
+        self.error = self.error or error
+        updated, self._updated = self._updated, asyncio.Event()
+        updated.set()
+
+
+    async def read(self) -> AsyncGenerator[str, None]:
+        read = 0
+        while True:
+            updated = self._updated
+            while read < len(self.chunks):
+                read += 1
+                yield self.chunks[read - 1]
+            if self.done and read == len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+            await updated.wait()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of LLM responses.
+
+    Responses are stored as the list of chunks they were streamed (or returned) in, so a cached response can be
+    replayed to a streaming caller. The most recently used responses are kept in memory, every response is
+    stored in the llm_response_cache table of the storage DB, which survives restarts. The expired responses
+    of the table are purged by the stores, at most every purge_interval seconds.
+
+    Args:
+        max_entries (int): Responses kept in the memory tier.
+        session_factory (sessionmaker): Opens the DB sessions of the cache.
+        purge_interval (float): Seconds between two purges of the expired responses of the DB.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        session_factory: sessionmaker = SessionLocal,
+        purge_interval: float = RESPONSE_CACHE_PURGE_INTERVAL,
+    ):
+        self.max_entries = max_entries
+        self.session_factory = session_factory
+        self.purge_interval = purge_interval
+        self._memory: "OrderedDict[str, Tuple[str, List[str], Optional[float]]]" = OrderedDict()  # key -> (alias, chunks, expires_at)
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, Tuple[threading.Lock, int]] = {}
+        self._flights: Dict[str, _Flight] = {}
+        self._stats: Dict[str, Counter] = defaultdict(Counter)
+        self._last_purge = 0.0
+
+
+    @staticmethod
+    def make_key(alias: str, is_remote: bool, provider: str, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        kwargs.pop("conversation_id", None)  # the messages already identify the conversation
+        kwargs.pop("usage", None)  # filled by the provider, not part of the request
+        payload = [alias, is_remote, provider, system_prompt, user_prompt, sorted(kwargs.items())]
+        return hashlib.sha256(json.dumps(payload, default=str).encode("utf-8")).hexdigest()
+
+
+    def lookup(self, key: str, alias: str) -> Optional[List[str]]:
+        """Get the chunks of a cached response, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            chunks = self._memory_lookup(key)
+            if chunks is not None:
+                self._stats[alias]["memory_hits"] += 1
+                return chunks
+
+        chunks, expires_at = self._db_lookup(key, now)
+        with self._lock:
+            if chunks is None:
+                self._stats[alias]["misses"] += 1
+                return None
+            self._stats[alias]["db_hits"] += 1
+            self._remember(key, alias, chunks, expires_at)
+        return chunks
+
+
+    def store(self, key: str, alias: str, model: Optional[str], chunks: List[str], ttl: Optional[float]) -> None:
+        """Cache a response. A ttl of None never expires."""
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            self._remember(key, alias, chunks, expires_at)
+            self._stats[alias]["stores"] += 1
+            purge = now - self._last_purge >= self.purge_interval
+            if purge:
+                self._last_purge = now
+        try:
+            with self.session_factory() as db:
+                db.merge(LLMResponseCacheEntry(
+                    key=key, alias=alias, model=model, chunks=chunks, created_at=now, expires_at=expires_at
+                ))
+                if purge:
+                    db.query(LLMResponseCacheEntry).filter(LLMResponseCacheEntry.expires_at < now).delete()
+                db.commit()
+        except SQLAlchemyError as e:
+            print(f"[AgentSmith LLM] Could not store the response in the response cache: {e}")
+
+
+    async def alookup(self, key: str, alias: str) -> Optional[List[str]]:
+        with self._lock:
+            chunks = self._memory_lookup(key)
+            if chunks is not None:
+                self._stats[alias]["memory_hits"] += 1
+                return chunks
+        return await asyncio.to_thread(self.lookup, key, alias)
+
+
+    async def astore(self, key: str, alias: str, model: Optional[str], chunks: List[str], ttl: Optional[float]) -> None:
+        await asyncio.to_thread(self.store, key, alias, model, chunks, ttl)
+
+
+    def record_bypass(self, alias: str) -> None:
+        with self._lock:
+            self._stats[alias]["bypassed"] += 1
+
+
+    def clear(self, alias: Optional[str] = None) -> int:
+        """Drop the cached responses of an alias, or all of them. Returns the number of DB entries removed."""
+        with self._lock:
+            for key in [key for key, cached in self._memory.items() if alias is None or cached[0] == alias]:
+                del self._memory[key]
+        with self.session_factory() as db:
+            query = db.query(LLMResponseCacheEntry)
+            if alias is not None:
+                query = query.filter(LLMResponseCacheEntry.alias == alias)
+            removed = query.delete()
+            db.commit()
+        return removed
+
+
+    def stats(self) -> dict:
+        """Hit/miss counters, in total and per alias."""
+        with self._lock:
+            per_alias = {alias: dict(counter) for alias, counter in self._stats.items()}
+            memory_entries = len(self._memory)
+        total = Counter()
+        for counter in per_alias.values():
+            total.update(counter)
+        lookups = total["memory_hits"] + total["db_hits"] + total["misses"]
+        return {
+            "memory_entries": memory_entries,
+            "hits": total["memory_hits"] + total["db_hits"],
+            "memory_hits": total["memory_hits"],
+            "db_hits": total["db_hits"],
+            "misses": total["misses"],
+            "bypassed": total["bypassed"],
+            "stores": total["stores"],
+            "hit_rate": (total["memory_hits"] + total["db_hits"]) / lookups if lookups else 0.0,
+            "aliases": per_alias,
+        }
+
+
+    @contextmanager
+    def single_flight(self, key: str):
+        """Serialize the callers of the same request, so only the first one reaches the provider."""
+        with self._lock:
+            lock, waiters = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (lock, waiters + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, waiters = self._key_locks[key]
+                if waiters == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (lock, waiters - 1)
+
+
+    async def coalesce(
+        self,
+        key: str,
+        alias: str,
+        model: Optional[str],
+        ttl: Optional[float],
+        produce: Callable[[], AsyncIterator[str]],
+    ) -> AsyncGenerator[str, None]:
+        """
+        Stream the response of a request the cache missed. The concurrent callers of the same request share a
+        single provider call, produce(): the first one starts it in a task, every caller reads its chunks at its
+        own pace, and the response is cached once it is complete. The call is cancelled when every caller left.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                # the response may have been cached since the caller looked it up
+                chunks = self._memory_lookup(key)
+                if chunks is not None:
+                    flight = _Flight()
+                    flight.chunks, flight.done = list(chunks), True
+                else:
+                    flight = self._flights[key] = _Flight()
+                    flight.task = asyncio.ensure_future(self._fly(key, alias, model, ttl, produce, flight))
+            flight.readers += 1
+        try:
+            async with aclosing(flight.read()) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+        finally:
+            with self._lock:
+                flight.readers -= 1
+                abandoned = flight.readers == 0 and not flight.done
+                if abandoned and self._flights.get(key) is flight:
+                    del self._flights[key]
+            if abandoned and flight.task is not None:
+                flight.task.cancel()
+
+
+    async def _fly(
+        self,
+        key: str,
+        alias: str,
+        model: Optional[str],
+        ttl: Optional[float],
+        produce: Callable[[], AsyncIterator[str]],
+        flight: _Flight,
+    ) -> None:
+        try:
+            async with aclosing(produce()) as stream:
+                async for chunk in stream:
+                    flight.publish(chunk)
+            # only responses that were produced to the end are cached, before the flight is left to the cache
+            await self.astore(key, alias, model, flight.chunks, ttl)
+            flight.publish(done=True)
+        except BaseException as e:
+            flight.publish(done=True, error=e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+
+    def _memory_lookup(self, key: str) -> Optional[List[str]]:
+        """Get the chunks of a response of the memory tier, None if missing or expired. Must be called with the lock held."""
+        cached = self._memory.get(key)
+        if cached is None:
+            return None
+        if cached[2] is not None and cached[2] <= time.time():
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return cached[1]
+
+
+    def _remember(self, key: str, alias: str, chunks: List[str], expires_at: Optional[float]) -> None:
+        """Put a response in the memory tier. Must be called with the lock held."""
+        self._memory[key] = (alias, chunks, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+    def _db_lookup(self, key: str, now: float) -> Tuple[Optional[List[str]], Optional[float]]:
+        try:
+            with self.session_factory() as db:
+                entry = db.get(LLMResponseCacheEntry, key)
+                if entry is None:
+                    return None, None
+                if entry.expires_at is not None and entry.expires_at <= now:
+                    db.delete(entry)
+                    db.commit()
+                    return None, None
+                return entry.chunks, entry.expires_at
+        except SQLAlchemyError as e:
+            print(f"[AgentSmith LLM] Response cache lookup failed: {e}")
+            return None, None
+
+
+response_cache = ResponseCache()
+
+
+class CachedLLM(LLMProxy):
+    """
+    LLM client with the response cache in front of its completion methods.
+    Responses of temperature 0 requests are deterministic, they never expire. Concurrent identical requests share
+    the provider call of the first one, so they reach the provider only once.
+
+    Args:
+        llm: The wrapped LLM client.
+        alias (str): The LLM alias.
+        is_remote (bool): Whether the alias is a remote or a local LLM.
+        ttl (Optional[float]): Seconds responses stay cached, defaults to RESPONSE_CACHE_TTL.
+    """
+    def __init__(self, llm, alias: str, is_remote: bool, ttl: Optional[float] = None):
+        super().__init__(llm)
+        self.alias = alias
+        self.is_remote = is_remote
+        self.ttl = ttl if ttl is not None else RESPONSE_CACHE_TTL
+
+
+    def _key(self, system_prompt: str, user_prompt: str, kwargs: dict) -> str:
+        return response_cache.make_key(self.alias, self.is_remote, self.llm.name, system_prompt, user_prompt, **kwargs)
+
+
+    def _ttl(self, kwargs: dict) -> Optional[float]:
+        return None if kwargs.get("temperature") == 0 else self.ttl
+
+
+    def get_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        if _bypass.get():
+            response_cache.record_bypass(self.alias)
+            return self.llm.get_completion(system_prompt, user_prompt, **kwargs)
+        key = self._key(system_prompt, user_prompt, kwargs)
+        with response_cache.single_flight(key):
+            chunks = response_cache.lookup(key, self.alias)
+            if chunks is not None:
+                return "".join(chunks)
+            text = self.llm.get_completion(system_prompt, user_prompt, **kwargs)
+            response_cache.store(key, self.alias, kwargs.get("model"), [text], self._ttl(kwargs))
+            return text
+
+
+    async def aget_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        if _bypass.get():
+            response_cache.record_bypass(self.alias)
+            return await self.llm.aget_completion(system_prompt, user_prompt, **kwargs)
+        key = self._key(system_prompt, user_prompt, kwargs)
+        chunks = await response_cache.alookup(key, self.alias)
+        if chunks is not None:
+            return "".join(chunks)
+
+        async def complete():
+            yield await self.llm.aget_completion(system_prompt, user_prompt, **kwargs)
+
+        chunks = []
+        async with aclosing(response_cache.coalesce(key, self.alias, kwargs.get("model"), self._ttl(kwargs), complete)) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+        return "".join(chunks)
+
+
+    async def stream_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> AsyncGenerator[str, None]:
+        if _bypass.get():
+            response_cache.record_bypass(self.alias)
+            async with aclosing(self.llm.stream_completion(system_prompt, user_prompt, **kwargs)) as stream:
+                async for token in stream:
+                    yield token
+            return
+
+        key = self._key(system_prompt, user_prompt, kwargs)
+        chunks = await response_cache.alookup(key, self.alias)
+        if chunks is not None:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        def produce():
+            return self.llm.stream_completion(system_prompt, user_prompt, **kwargs)
+
+        # concurrent identical requests share the provider stream, none of them holds a lock while it is consumed
+        async with aclosing(response_cache.coalesce(key, self.alias, kwargs.get("model"), self._ttl(kwargs), produce)) as stream:
+            async for token in stream:
+                yield token
@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from core.config import SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD
+from services.llms.cache.response import is_cache_bypassed
+from services.llms.proxy import LLMProxy
+from services.llms.registry import llm_registry
+
+
+# embed(texts) -> one embedding per text
+Embedder = Callable[[List[str]], List[List[float]]]
+
+# request kwargs left out of the scope: the chat is scoped by its earlier turns and matched by the embedding of its
+# latest question, the usage is filled by the provider
+UNSCOPED_KWARGS = ("messages", "conversation_id", "usage")
+
+
+def default_embedder() -> Embedder:
+    """The ONNX all-MiniLM-L6-v2 embedding function that ships with chromadb, it runs on the CPU of the API process."""
+    from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+    return DefaultEmbeddingFunction()
+
+
+def split_chat(user_prompt: str, messages: Optional[List[dict]]) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Split a request into the question it asks, its latest user message, and the (role, content) turns around it.
+    Returns:
+        The question and the other turns, the user prompt and no turns for a request without messages.
+    """
+    if not messages:
+        return user_prompt, []
+    turns = [(message["role"], message["content"]) for message in messages]
+    latest = max((i for i, (role, _) in enumerate(turns) if role == "user"), default=None)
+    if latest is None:
+        return user_prompt, turns
+    return turns[latest][1], turns[:latest] + turns[latest + 1:]
+
+
+@dataclass
+class SemanticEntry:
+    alias: str
+    prompt: str
+    chunks: List[str]
+    latency: float  # seconds the provider took to produce the response
+    created_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class _ScopeIndex:
+    """The embeddings of the cached questions that share an alias, model, system prompt, earlier turns and sampling settings, one row per entry."""
+
+    def __init__(self, dim: int):
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.entries: List[SemanticEntry] = []
+
+
+    def add(self, vector: np.ndarray, entry: SemanticEntry) -> None:
+        self.vectors = np.vstack([self.vectors, vector[None, :]])
+        self.entries.append(entry)
+
+
+    def remove(self, indices: List[int]) -> None:
+        keep = np.ones(len(self.entries), dtype=bool)
+        keep[indices] = False
+        self.vectors = self.vectors[keep]
+        self.entries = [entry for entry, kept in zip(self.entries, keep) if kept]
+
+
+class SemanticCache:
+    """
+    Cache of LLM responses looked up by the meaning of the prompt.
+
+    The latest user message is embedded and compared (cosine similarity) with the questions cached in the same
+    scope, i.e. with the same alias, model, system prompt, earlier turns and sampling settings. Embedding models only
+    read the start of a text, so a long chat embedded whole would match the previous turn of the same chat. The answer of the closest prompt is returned when its
+    similarity reaches the threshold of the alias. The index lives in memory: entries expire after the TTL and
+    the least recently used ones are evicted beyond max_entries. A scope is dropped when the model behind it
+    changes (e.g. a GGUF file is replaced), and all scopes of an alias when the alias is updated or deleted.
+
+    Args:
+        embedder (Optional[Embedder]): Embeds the prompts, defaults to the chromadb ONNX embedding function.
+        max_entries (int): Entries kept across all scopes.
+        ttl (float): Seconds an entry stays valid, 0 keeps entries until they are evicted.
+    """
+
+    def __init__(self, embedder: Optional[Embedder] = None, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, ttl: float = SEMANTIC_CACHE_TTL):
+        self._embedder = embedder
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._scopes: Dict[str, _ScopeIndex] = {}
+        self._scope_owner: Dict[str, Tuple[str, str]] = {}  # scope -> (alias, model)
+        self._fingerprints: Dict[Tuple[str, str], str] = {}  # (alias, model) -> fingerprint of the model
+        self._stats: Dict[str, Counter] = defaultdict(Counter)
+        self._saved_latency: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+
+    @property
+    def embedder(self) -> Embedder:
+        if self._embedder is None:
+            self._embedder = default_embedder()
+        return self._embedder
+
+
+    @staticmethod
+    def make_scope(alias: str, provider: str, model: Optional[str], system_prompt: str, history: Sequence[Tuple[str, str]] = (), **sampling) -> str:
+        """
+        The scope of a request, history holds the (role, content) turns around its question and sampling its other
+        settings (temperature, max_tokens...), which all change the answer.
+        """
+        for name in UNSCOPED_KWARGS:
+            sampling.pop(name, None)
+        history_digest = hashlib.sha256(json.dumps([list(turn) for turn in history]).encode("utf-8")).hexdigest()
+        payload = [alias, provider, model, system_prompt, history_digest, sorted(sampling.items())]
+        return hashlib.sha256(json.dumps(payload, default=str).encode("utf-8")).hexdigest()
+
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embedder([text])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+    def check_model(self, alias: str, model: Optional[str], fingerprint: Optional[str]) -> None:
+        """Drop the entries of a model whose fingerprint changed since they were cached."""
+        if fingerprint is None:
+            return
+        with self._lock:
+            previous = self._fingerprints.get((alias, model))
+            self._fingerprints[(alias, model)] = fingerprint
+            if previous is not None and previous != fingerprint:
+                self._drop_scopes(lambda owner: owner == (alias, model))
+
+
+    def lookup(self, scope: str, alias: str, vector: np.ndarray, threshold: float) -> Optional[SemanticEntry]:
+        """Get the entry of the most similar cached prompt, or None if none reaches the threshold."""
+        with self._lock:
+            index = self._scopes.get(scope)
+            if index is not None and self.ttl > 0:
+                expired = [i for i, entry in enumerate(index.entries) if time.time() - entry.created_at > self.ttl]
+                if expired:
+                    index.remove(expired)
+            if index is None or not index.entries:
+                self._stats[alias]["misses"] += 1
+                return None
+            similarities = index.vectors @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                self._stats[alias]["misses"] += 1
+                return None
+            entry = index.entries[best]
+            entry.last_used = time.monotonic()
+            self._stats[alias]["hits"] += 1
+            self._saved_latency[alias] += entry.latency
+            return entry
+
+
+    def store(self, scope: str, alias: str, model: Optional[str], vector: np.ndarray, entry: SemanticEntry) -> None:
+        with self._lock:
+            index = self._scopes.get(scope)
+            if index is None or index.vectors.shape[1] != vector.shape[0]:
+                index = self._scopes[scope] = _ScopeIndex(vector.shape[0])
+                self._scope_owner[scope] = (alias, model)
+            index.add(vector, entry)
+            self._stats[alias]["stores"] += 1
+            self._evict()
+
+
+    def invalidate(self, alias: str) -> None:
+        """Drop every entry of an alias."""
+        with self._lock:
+            self._drop_scopes(lambda owner: owner[0] == alias)
+            for key in [key for key in self._fingerprints if key[0] == alias]:
+                del self._fingerprints[key]
+
+
+    def stats(self) -> dict:
+        """Hit rate and the provider latency saved by the hits, in total and per alias."""
+        with self._lock:
+            entries = sum(len(index.entries) for index in self._scopes.values())
+            aliases = {
+                alias: {
+                    "hits": counter["hits"],
+                    "misses": counter["misses"],
+                    "stores": counter["stores"],
+                    "hit_rate": counter["hits"] / (counter["hits"] + counter["misses"]) if counter["hits"] + counter["misses"] else 0.0,
+                    "saved_latency_seconds": self._saved_latency[alias],
+                }
+                for alias, counter in self._stats.items()
+            }
+        hits = sum(stats["hits"] for stats in aliases.values())
+        misses = sum(stats["misses"] for stats in aliases.values())
+        return {
+            "entries": entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "saved_latency_seconds": sum(stats["saved_latency_seconds"] for stats in aliases.values()),
+            "aliases": aliases,
+        }
+
+
+    def _drop_scopes(self, predicate: Callable[[Tuple[str, str]], bool]) -> None:
+        """Must be called with the lock held."""
+        for scope in [scope for scope, owner in self._scope_owner.items() if predicate(owner)]:
+            self._scopes.pop(scope, None)
+            self._scope_owner.pop(scope, None)
+
+
+    def _evict(self) -> None:
+        """Evict the least recently used entries beyond max_entries. Must be called with the lock held."""
+        total = sum(len(index.entries) for index in self._scopes.values())
+        if total <= self.max_entries:
+            return
+        ranked = sorted(
+            ((entry.last_used, scope, i) for scope, index in self._scopes.items() for i, entry in enumerate(index.entries)),
+        )
+        evicted: Dict[str, List[int]] = defaultdict(list)
+        for _, scope, i in ranked[:total - self.max_entries]:
+            evicted[scope].append(i)
+        for scope, indices in evicted.items():
+            self._scopes[scope].remove(indices)
+
+
+semantic_cache = SemanticCache()
+llm_registry.add_invalidation_listener(lambda alias, is_remote: semantic_cache.invalidate(alias))
+
+
+class SemanticCachedLLM(LLMProxy):
+    """
+    LLM client with the semantic cache in front of its completion methods.
+
+    Args:
+        llm: The wrapped LLM client.
+        alias (str): The LLM alias.
+        is_remote (bool): Whether the alias is a remote one.
+        threshold (float): Cosine similarity a cached prompt must reach to be served.
+    """
+    def __init__(self, llm, alias: str, is_remote: bool, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        super().__init__(llm)
+        self.alias = alias
+        self.is_remote = is_remote
+        self.threshold = threshold
+
+
+    def to_code(self, model: str) -> str:
+        """The code of a flow LLM that calls the alias through its client, rather than the provider, so the cache answers the agent nodes too."""
+        return self.env.get_template("llms/alias.jinja").render(
+            alias=self.alias,
+            llm_type="remote" if self.is_remote else "local",
+            model_name=model,
+        )
+
+
+    def _lookup(self, system_prompt: str, user_prompt: str, kwargs: dict) -> Tuple[str, np.ndarray, Optional[SemanticEntry]]:
+        model = kwargs.get("model")
+        fingerprint = getattr(self.llm, "model_fingerprint", None)
+        semantic_cache.check_model(self.alias, model, fingerprint(model) if fingerprint is not None else model)
+        sampling = {name: value for name, value in kwargs.items() if name != "model"}
+        # only the latest question is embedded, the earlier turns of a chat must match exactly
+        question, history = split_chat(user_prompt, kwargs.get("messages"))
+        scope = semantic_cache.make_scope(self.alias, self.llm.name, model, system_prompt, history, **sampling)
+        vector = semantic_cache.embed(question)
+        return scope, vector, semantic_cache.lookup(scope, self.alias, vector, self.threshold)
+
+
+    def _store(self, scope: str, vector: np.ndarray, user_prompt: str, chunks: List[str], latency: float, kwargs: dict) -> None:
+        question, _ = split_chat(user_prompt, kwargs.get("messages"))
+        entry = SemanticEntry(alias=self.alias, prompt=question, chunks=chunks, latency=latency)
+        semantic_cache.store(scope, self.alias, kwargs.get("model"), vector, entry)
+
+
+    def get_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        if is_cache_bypassed():
+            return self.llm.get_completion(system_prompt, user_prompt, **kwargs)
+        scope, vector, entry = self._lookup(system_prompt, user_prompt, kwargs)
+        if entry is not None:
+            return "".join(entry.chunks)
+        start = time.perf_counter()
+        text = self.llm.get_completion(system_prompt, user_prompt, **kwargs)
+        self._store(scope, vector, user_prompt, [text], time.perf_counter() - start, kwargs)
+        return text
+
+
+    async def aget_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        if is_cache_bypassed():
+            return await self.llm.aget_completion(system_prompt, user_prompt, **kwargs)
+        # embedding runs on the CPU, off the event loop
+        scope, vector, entry = await asyncio.to_thread(self._lookup, system_prompt, user_prompt, kwargs)
+        if entry is not None:
+            return "".join(entry.chunks)
+        start = time.perf_counter()
+        text = await self.llm.aget_completion(system_prompt, user_prompt, **kwargs)
+        self._store(scope, vector, user_prompt, [text], time.perf_counter() - start, kwargs)
+        return text
+
+
+    async def stream_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> AsyncGenerator[str, None]:
+        if is_cache_bypassed():
+            async with aclosing(self.llm.stream_completion(system_prompt, user_prompt, **kwargs)) as stream:
+                async for token in stream:
+                    yield token
+            return
+
+        # embedding runs on the CPU, off the event loop
+        scope, vector, entry = await asyncio.to_thread(self._lookup, system_prompt, user_prompt, kwargs)
+        if entry is not None:
+            for chunk in entry.chunks:
+                yield chunk
+            return
+
+        start = time.perf_counter()
+        chunks = []
+        async with aclosing(self.llm.stream_completion(system_prompt, user_prompt, **kwargs)) as stream:
+            async for token in stream:
+                chunks.append(token)
+                yield token
+        self._store(scope, vector, user_prompt, chunks, time.perf_counter() - start, kwargs)
@@ -0,0 +1,28 @@
+import asyncio
+import threading
+from typing import Dict, Tuple
+from core.config import BATCH_ALIAS_CONCURRENCY
+
+
+class AliasConcurrency:
+    """
+    Caps the in-flight requests of every alias across the batch workloads (batch endpoint, bulk jobs) of the
+    process, so concurrent batches share the provider concurrency of an alias instead of multiplying it.
+
+    Args:
+        limit (int): Requests of an alias in flight at once.
+    """
+
+    def __init__(self, limit: int = BATCH_ALIAS_CONCURRENCY):
+        self.limit = limit
+        self._slots: Dict[Tuple[str, str], asyncio.Semaphore] = {}
+        self._lock = threading.Lock()
+
+
+    def slot(self, llm_type: str, alias: str) -> asyncio.Semaphore:
+        """The semaphore to hold while a batch request of the alias runs."""
+        with self._lock:
+            return self._slots.setdefault((llm_type, alias), asyncio.Semaphore(self.limit))
+
+
+alias_concurrency = AliasConcurrency()
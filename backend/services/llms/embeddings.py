@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+from core.config import EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT, EMBEDDING_CACHE_MAX_ENTRIES
+from db.session import SessionLocal
+from models.cache import LLMEmbeddingCacheEntry
+from services.llms.registry import llm_registry
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache of the embeddings of texts, keyed by (model, sha256 of the text).
+
+    The most recently used embeddings are kept in memory, every embedding is stored as float32 in the
+    llm_embedding_cache table of the storage DB, so a chunk is embedded once however often it is indexed.
+
+    Args:
+        session_factory (sessionmaker): Opens the DB sessions of the cache.
+        max_entries (int): Embeddings kept in the memory tier.
+    """
+
+    # keys per IN query, under the SQLite limit of bound parameters
+    DB_PAGE = 500
+
+    def __init__(self, session_factory: sessionmaker = SessionLocal, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.session_factory = session_factory
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._table_ready = False
+
+
+    def get_many(self, model: str, hashes: Iterable[str]) -> Dict[str, List[float]]:
+        """The cached embeddings of the given text hashes, the ones that are not cached are left out."""
+        found, missing = {}, []
+        with self._lock:
+            for h in set(hashes):
+                vector = self._memory.get((model, h))
+                if vector is None:
+                    missing.append(h)
+                    continue
+                self._memory.move_to_end((model, h))
+                found[h] = vector
+            self._stats["memory_hits"] += len(found)
+
+        stored = self._db_get_many(model, missing) if missing else {}
+        with self._lock:
+            for h, vector in stored.items():
+                self._remember(model, h, vector)
+            self._stats["db_hits"] += len(stored)
+            self._stats["misses"] += len(missing) - len(stored)
+        found.update(stored)
+        return found
+
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        """Cache the embeddings of the given text hashes."""
+        if not vectors:
+            return
+        with self._lock:
+            for h, vector in vectors.items():
+                self._remember(model, h, vector)
+            self._stats["stores"] += len(vectors)
+        now = time.time()
+        rows = [
+            {"model": model, "text_hash": h, "vector": np.asarray(vector, dtype=np.float32).tobytes(), "created_at": now}
+            for h, vector in vectors.items()
+        ]
+        try:
+            self._ensure_table()
+            with self.session_factory() as db:
+                db.execute(insert(LLMEmbeddingCacheEntry).on_conflict_do_nothing(), rows)
+                db.commit()
+        except SQLAlchemyError as e:
+            print(f"[AgentSmith LLM] Could not store the embeddings in the embedding cache: {e}")
+
+
+    def clear(self, model: Optional[str] = None) -> int:
+        """Drop the cached embeddings of a model, or all of them. Returns the number of DB entries removed."""
+        with self._lock:
+            for key in [key for key in self._memory if model is None or key[0] == model]:
+                del self._memory[key]
+        self._ensure_table()
+        with self.session_factory() as db:
+            query = db.query(LLMEmbeddingCacheEntry)
+            if model is not None:
+                query = query.filter(LLMEmbeddingCacheEntry.model == model)
+            removed = query.delete()
+            db.commit()
+        return removed
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["memory_hits"] + self._stats["db_hits"] + self._stats["misses"]
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self._stats["memory_hits"],
+                "db_hits": self._stats["db_hits"],
+                "misses": self._stats["misses"],
+                "stores": self._stats["stores"],
+                "hit_rate": (self._stats["memory_hits"] + self._stats["db_hits"]) / lookups if lookups else 0.0,
+            }
+
+
+    def _remember(self, model: str, h: str, vector: List[float]) -> None:
+        """Put an embedding in the memory tier. Must be called with the lock held."""
+        self._memory[(model, h)] = vector
+        self._memory.move_to_end((model, h))
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+    def _db_get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        try:
+            self._ensure_table()
+            with self.session_factory() as db:
+                for start in range(0, len(hashes), self.DB_PAGE):
+                    rows = (
+                        db.query(LLMEmbeddingCacheEntry.text_hash, LLMEmbeddingCacheEntry.vector)
+                        .filter(LLMEmbeddingCacheEntry.model == model, LLMEmbeddingCacheEntry.text_hash.in_(hashes[start:start + self.DB_PAGE]))
+                        .all()
+                    )
+                    found.update((row.text_hash, np.frombuffer(row.vector, dtype=np.float32).tolist()) for row in rows)
+        except SQLAlchemyError as e:
+            print(f"[AgentSmith LLM] Embedding cache lookup failed: {e}")
+        return found
+
+
+    def _ensure_table(self) -> None:
+        # databases created before the embedding cache existed do not have its table yet
+        if not self._table_ready:
+            with self.session_factory() as db:
+                LLMEmbeddingCacheEntry.__table__.create(bind=db.get_bind(), checkfirst=True)
+            self._table_ready = True
+
+
+embedding_cache = EmbeddingCache()
+
+
+class EmbeddingBatcher:
+    """
+    Merges the concurrent embedding requests of a client and model into provider-sized batches.
+
+    Texts are queued until batch_size of them are waiting or the oldest one waited max_wait seconds, then sent in
+    one provider request. A text that is already queued or in flight is not sent again, its callers share the result.
+
+    Args:
+        llm: The LLM client, anything with aembed(texts, model).
+        model (str): The embeddings model.
+        batch_size (int): Texts per provider request.
+        max_wait (float): Seconds a text waits for others to fill its batch.
+    """
+
+    def __init__(self, llm, model: str, batch_size: int = EMBEDDING_BATCH_SIZE, max_wait: float = EMBEDDING_BATCH_WAIT):
+        self.llm = llm
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queued: "OrderedDict[str, Tuple[str, asyncio.Future]]" = OrderedDict()  # hash -> (text, future)
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._sends: Set[asyncio.Task] = set()
+        self.stats = Counter()
+
+
+    async def embed(self, hashes: List[str], texts: List[str]) -> List[List[float]]:
+        """Embed texts, given with their hashes, and return their embeddings in the same order."""
+        loop = asyncio.get_running_loop()
+        futures = []
+        for h, text in zip(hashes, texts):
+            future = self._in_flight.get(h) or (self._queued[h][1] if h in self._queued else None)
+            if future is None:
+                future = loop.create_future()
+                self._queued[h] = (text, future)
+                if len(self._queued) >= self.batch_size:
+                    self._flush()
+            futures.append(future)
+        if self._queued and self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        # shielded, so a caller that goes away does not cancel the texts it shares with others
+        return list(await asyncio.gather(*(asyncio.shield(future) for future in futures)))
+
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queued:
+            batch = [self._queued.popitem(last=False) for _ in range(min(self.batch_size, len(self._queued)))]
+            for h, (_, future) in batch:
+                self._in_flight[h] = future
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+
+    async def _send(self, batch: List[Tuple[str, Tuple[str, asyncio.Future]]]) -> None:
+        self.stats["batches"] += 1
+        self.stats["texts"] += len(batch)
+        try:
+            vectors = await self.llm.aembed([text for _, (text, _) in batch], self.model)
+            if len(vectors) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+            for (_, (_, future)), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        except Exception as e:
+            for _, (_, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for h, _ in batch:
+                self._in_flight.pop(h, None)
+
+
+class EmbeddingService:
+    """
+    Embeds texts with the embeddings models of the LLM aliases: cached embeddings are served from the embedding
+    cache, the others go through the batcher of their alias and model and are cached once computed.
+
+    Args:
+        cache (EmbeddingCache): The embedding cache.
+    """
+
+    def __init__(self, cache: EmbeddingCache = embedding_cache):
+        self.cache = cache
+        self._batchers: Dict[Tuple[str, bool, str], EmbeddingBatcher] = {}
+        self._lock = threading.Lock()
+
+
+    def batcher(self, llm, alias: str, is_remote: bool, model: str) -> EmbeddingBatcher:
+        with self._lock:
+            batcher = self._batchers.get((alias, is_remote, model))
+            if batcher is None or batcher.llm is not llm:
+                batch_size = min(EMBEDDING_BATCH_SIZE, getattr(llm, "max_embedding_batch", EMBEDDING_BATCH_SIZE))
+                batcher = self._batchers[(alias, is_remote, model)] = EmbeddingBatcher(llm, model, batch_size=batch_size)
+            return batcher
+
+
+    async def embed(self, llm, alias: str, is_remote: bool, texts: List[str], model: str) -> Tuple[List[List[float]], int]:
+        """
+        Embed texts with a model of an alias.
+        Returns:
+            Tuple[List[List[float]], int]: One embedding per text, and how many of the texts were served from the cache.
+        """
+        # the provider is part of the key, providers may serve different models under the same name
+        cache_model = f"{llm.name}:{model}"
+        hashes = [text_hash(text) for text in texts]
+        found = await asyncio.to_thread(self.cache.get_many, cache_model, hashes)
+        cached = sum(h in found for h in hashes)
+
+        missing = {h: text for h, text in zip(hashes, texts) if h not in found}
+        if missing:
+            vectors = await self.batcher(llm, alias, is_remote, model).embed(list(missing), list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            await asyncio.to_thread(self.cache.put_many, cache_model, computed)
+            found.update(computed)
+        return [found[h] for h in hashes], cached
+
+
+    def invalidate(self, alias: str, is_remote: bool) -> None:
+        """Drop the batchers of an alias, its rebuilt client gets new ones."""
+        with self._lock:
+            for key in [key for key in self._batchers if key[:2] == (alias, is_remote)]:
+                del self._batchers[key]
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            batchers = dict(self._batchers)
+        batches = {f"{alias}:{model}": dict(batcher.stats) for (alias, _, model), batcher in batchers.items()}
+        return {"cache": self.cache.stats(), "batchers": batches}
+
+
+embedding_service = EmbeddingService()
+llm_registry.add_invalidation_listener(embedding_service.invalidate)
@@ -2,24 +2,38 @@ from services.llms.providers.anthropic import AnthropicAPILLM
 from services.llms.providers.openai import OpenAIAPILLM
 from services.llms.local.llama_cpp import LlamaCppLLM
 from services.llms.providers.hugging_face import HuggingFaceAPILLM
-from typing import Callable, Dict
-from crud.llms import get_api_key_by_alias, get_remote_llm_by_alias, get_local_llm_by_alias
+from services.llms.registry import llm_registry
+from services.llms.cache.response import CachedLLM
+from services.llms.cache.semantic import SemanticCachedLLM
+from services.llms.router import RouterLLM, RouterTarget
+from services.llms.ratelimit import rate_limited
+from services.llms.hedging import HedgedLLM
+from typing import Callable, Dict, Optional
+from core.config import SEMANTIC_CACHE_THRESHOLD, HEDGE_PERCENTILE, HEDGE_MAX_RATE
+from db.session import SessionLocal
+from crud.llms import get_api_key_by_alias, get_remote_llm_by_alias, get_local_llm_by_alias, get_router_llm_by_alias
 from sqlalchemy.orm import Session
 
 
-REMOTE_PROVIDERS: Dict[str, Callable[[str], object]] = {
-    "anthropic": lambda key: AnthropicAPILLM(api_key=key),
-    "openai": lambda key: OpenAIAPILLM(api_key=key),
-    "huggingface": lambda key: HuggingFaceAPILLM(api_key=key),
+REMOTE_PROVIDERS: Dict[str, Callable[..., object]] = {
+    "anthropic": lambda key, base_url=None: AnthropicAPILLM(api_key=key, base_url=base_url),
+    "openai": lambda key, base_url=None: OpenAIAPILLM(api_key=key, base_url=base_url),
+    "huggingface": lambda key, base_url=None: HuggingFaceAPILLM(api_key=key, base_url=base_url),
 }
 
-LOCAL_PROVIDERS: Dict[str, Callable[[str], object]] = {
-    "llama-cpp": lambda path: LlamaCppLLM(path),
+LOCAL_PROVIDERS: Dict[str, Callable[..., object]] = {
+    "llama-cpp": lambda path, parameters=None: LlamaCppLLM(path, parameters),
 }
 
 
 def get_llm_client_by_alias(alias: str, db: Session, is_remote: bool):
 
+    client = llm_registry.get(alias, is_remote)
+    if client is not None:
+        return client
+
+    # read before the settings, a client built from settings an update replaced meanwhile is not registered
+    generation = llm_registry.generation(alias, is_remote)
     try:
         if is_remote:
             llm = get_remote_llm_by_alias(db, alias=alias)
@@ -27,7 +41,9 @@ def get_llm_client_by_alias(alias: str, db: Session, is_remote: bool):
             if llm.provider not in REMOTE_PROVIDERS:
                 raise ValueError(f"Unknown Remote LLM provider: {llm.provider}")
 
-            return REMOTE_PROVIDERS[llm.provider](api_key)
+            client = REMOTE_PROVIDERS[llm.provider](api_key, llm.base_url)
+            # cache hits never reach the provider, so the limiter sits under the caches
+            client = rate_limited(client, alias, (llm.parameters or {}).get("rate_limit"))
 
         else:
             llm = get_local_llm_by_alias(db, alias=alias)
@@ -35,12 +51,64 @@ def get_llm_client_by_alias(alias: str, db: Session, is_remote: bool):
             if llm.provider not in LOCAL_PROVIDERS:
                 raise ValueError(f"Unknown Local LLM provider: {llm.provider}")
 
-            return LOCAL_PROVIDERS[llm.provider](llm.path)
+            client = LOCAL_PROVIDERS[llm.provider](llm.path, llm.parameters)
+
+        # hedges are only sent for the requests the caches do not answer
+        hedge_settings = (llm.parameters or {}).get("hedging") or {}
+        if hedge_settings.get("enabled"):
+            client = HedgedLLM(
+                client,
+                alias,
+                percentile=hedge_settings.get("percentile") or HEDGE_PERCENTILE,
+                max_rate=hedge_settings.get("max_rate") if hedge_settings.get("max_rate") is not None else HEDGE_MAX_RATE,
+                resolve_hedge=_hedge_resolver(hedge_settings.get("alternate")),
+            )
+
+        # the exact-match cache is checked before the semantic cache, which has to embed the prompt
+        semantic_settings = (llm.parameters or {}).get("semantic_cache") or {}
+        if semantic_settings.get("enabled"):
+            client = SemanticCachedLLM(client, alias, is_remote, threshold=semantic_settings.get("threshold") or SEMANTIC_CACHE_THRESHOLD)
+        cache_settings = (llm.parameters or {}).get("response_cache") or {}
+        if cache_settings.get("enabled"):
+            client = CachedLLM(client, alias, is_remote, ttl=cache_settings.get("ttl"))
+
+        return llm_registry.put(alias, llm.provider, is_remote, client, generation)
     except Exception as e:
         print(f"LLM client instantiation error: {e}")
         raise
 
 
+def _hedge_resolver(alternate: Optional[dict]):
+    """The hedge target of an alias: None hedges to the alias itself, otherwise the alternate alias and its model."""
+    if not alternate:
+        return None
+
+    def resolve():
+        # the client outlives the request that built it, so it can not hold on to the session of that request
+        with SessionLocal() as db:
+            llm = get_llm_client_by_alias(alternate["alias"], db=db, is_remote=alternate["type"] == "remote")
+        return llm, {"model": alternate["model"]} if alternate.get("model") else {}
+    return resolve
+
+
+def get_router_client_by_alias(alias: str, db: Session) -> RouterLLM:
+    """
+    Build the client of a router alias. Routers hold no connection of their own, their targets are resolved
+    through get_llm_client_by_alias, so they share the cached clients of the target aliases.
+    """
+    router = get_router_llm_by_alias(db, alias=alias)
+    if router is None:
+        raise ValueError(f"Unknown LLM router: {alias}")
+    targets = [RouterTarget(t["alias"], t["type"] == "remote", t["model"]) for t in router.targets]
+    return RouterLLM(alias, targets, lambda target: get_llm_client_by_alias(target.alias, db=db, is_remote=target.is_remote))
+
+
+def get_llm_client(alias: str, db: Session, llm_type: str):
+    """Get the client of a "remote", "local" or "router" alias."""
+    if llm_type == "router":
+        return get_router_client_by_alias(alias, db)
+    return get_llm_client_by_alias(alias, db=db, is_remote=llm_type == "remote")
+
 
 def get_llm_client_by_provider(provider: str, **kwargs):
 
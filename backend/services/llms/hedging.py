@@ -0,0 +1,227 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncGenerator, Callable, Deque, Dict, Optional, Tuple
+import numpy as np
+from core.config import HEDGE_PERCENTILE, HEDGE_MAX_RATE, HEDGE_MIN_SAMPLES, HEDGE_WINDOW
+from services.llms.proxy import LLMProxy
+
+
+# The hedge target: (client, kwargs overrides), e.g. an alternate alias and its model
+HedgeResolver = Callable[[], Tuple[object, dict]]
+
+
+class HedgeTracker:
+    """
+    Recent latencies of an alias and how often it was hedged.
+
+    The primary window holds the time to the first token (streams) or to the response (completions) of the first
+    request sent, i.e. the latency without hedging; a primary cancelled before it answered only tells its latency
+    was longer than its elapsed time, such censored samples are left out of the window rather than skewing the
+    trigger percentile down. The observed window holds the latency the callers actually got. Comparing the tails of
+    the two tells how much latency hedging saved, the hedge count how much extra it cost.
+    """
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self.primary: Dict[bool, Deque[float]] = {stream: deque(maxlen=window) for stream in (False, True)}
+        self.observed: Dict[bool, Deque[float]] = {stream: deque(maxlen=window) for stream in (False, True)}
+        self.hedged: Deque[bool] = deque(maxlen=window)
+        self.counts = {"requests": 0, "hedges": 0, "hedge_wins": 0, "capped": 0}
+        self._lock = threading.Lock()
+
+
+    def trigger_delay(self, percentile: float, stream: bool) -> Optional[float]:
+        """Seconds to wait for the primary before hedging, None until enough requests were seen."""
+        with self._lock:
+            samples = self.primary[stream]
+            if len(samples) < HEDGE_MIN_SAMPLES:
+                return None
+            return float(np.percentile(samples, percentile))
+
+
+    def allow_hedge(self, max_rate: float) -> bool:
+        """Whether hedging one more request keeps the share of hedged requests under max_rate."""
+        with self._lock:
+            if sum(self.hedged) + 1 > max_rate * (len(self.hedged) + 1):
+                self.counts["capped"] += 1
+                return False
+            return True
+
+
+    def record(self, stream: bool, primary: Optional[float], observed: float, hedged: bool, hedge_won: bool) -> None:
+        """Record a request, primary is None when the primary was cancelled before it answered."""
+        with self._lock:
+            if primary is not None:
+                self.primary[stream].append(primary)
+            self.observed[stream].append(observed)
+            self.hedged.append(hedged)
+            self.counts["requests"] += 1
+            self.counts["hedges"] += hedged
+            self.counts["hedge_wins"] += hedge_won
+
+
+    def stats(self) -> dict:
+        def tail(samples, q):
+            return float(np.percentile(samples, q)) if samples else None
+
+        with self._lock:
+            stats = {**self.counts, "hedge_rate": self.counts["hedges"] / self.counts["requests"] if self.counts["requests"] else 0.0}
+            for stream, kind in ((False, "latency"), (True, "ttft")):
+                for q in (50, 95, 99):
+                    stats[f"{kind}_p{q}"] = tail(self.observed[stream], q)
+                    stats[f"unhedged_{kind}_p{q}"] = tail(self.primary[stream], q)
+            return stats
+
+
+class HedgeTrackers:
+    """The trackers of the hedged aliases. A tracker outlives the client of its alias, so a rebuilt client keeps its history."""
+
+    def __init__(self):
+        self._trackers: Dict[str, HedgeTracker] = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, alias: str) -> HedgeTracker:
+        with self._lock:
+            return self._trackers.setdefault(alias, HedgeTracker())
+
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            trackers = dict(self._trackers)
+        return {alias: tracker.stats() for alias, tracker in trackers.items()}
+
+
+hedge_trackers = HedgeTrackers()
+
+
+class HedgedLLM(LLMProxy):
+    """
+    LLM client that hedges slow requests: when no first token (or response) arrived within the given percentile of
+    the recent latencies of the alias, a duplicate request is sent to the same alias or to an alternate one.
+    The first to answer is used and the other is cancelled. Hedges are capped to max_rate of the requests.
+
+    Args:
+        llm: The wrapped LLM client.
+        alias (str): The LLM alias.
+        percentile (float): Percentile of the recent latencies after which a request is hedged.
+        max_rate (float): Largest share of the recent requests that may be hedged.
+        resolve_hedge (Optional[HedgeResolver]): The client (and kwargs overrides) of the hedge, defaults to the wrapped client.
+    """
+    def __init__(
+        self,
+        llm,
+        alias: str,
+        percentile: float = HEDGE_PERCENTILE,
+        max_rate: float = HEDGE_MAX_RATE,
+        resolve_hedge: Optional[HedgeResolver] = None,
+    ):
+        super().__init__(llm)
+        self.alias = alias
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.tracker = hedge_trackers.get(alias)
+        self._resolve_hedge = resolve_hedge or (lambda: (self.llm, {}))
+
+
+    def _hedge_delay(self, stream: bool) -> Optional[float]:
+        return self.tracker.trigger_delay(self.percentile, stream)
+
+
+    async def aget_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        delay = self._hedge_delay(stream=False)
+        start = time.monotonic()
+        contenders = [asyncio.ensure_future(self.llm.aget_completion(system_prompt, user_prompt, **kwargs))]
+        try:
+            done, _ = await asyncio.wait(contenders, timeout=delay)
+            if done or not self.tracker.allow_hedge(self.max_rate):
+                text = await contenders[0]
+                elapsed = time.monotonic() - start
+                self.tracker.record(False, elapsed, elapsed, hedged=False, hedge_won=False)
+                return text
+
+            llm, overrides = self._resolve_hedge()
+            contenders.append(asyncio.ensure_future(llm.aget_completion(system_prompt, user_prompt, **{**kwargs, **overrides})))
+            pending, error = set(contenders), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=contenders.index):
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    # the primary, cancelled when the hedge wins, has no latency to record
+                    elapsed = time.monotonic() - start
+                    hedge_won = task is contenders[1]
+                    self.tracker.record(False, None if hedge_won else elapsed, elapsed, hedged=True, hedge_won=hedge_won)
+                    return task.result()
+            raise error
+        finally:
+            for task in contenders:
+                task.cancel()
+
+
+    async def stream_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> AsyncGenerator[str, None]:
+        """
+        When the hedge wins, the primary is only cancelled at its first token (or when the stream ends), so its
+        time to first token, i.e. the latency without hedging, is measured rather than guessed.
+        """
+        delay = self._hedge_delay(stream=True)
+        start = time.monotonic()
+        queue: asyncio.Queue = asyncio.Queue()
+        pumps = [asyncio.ensure_future(self._pump(0, self.llm, system_prompt, user_prompt, kwargs, queue))]
+        hedged, winner, first_token, primary_first = False, None, None, None
+        try:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=delay)
+            except asyncio.TimeoutError:
+                item = None
+                if self.tracker.allow_hedge(self.max_rate):
+                    hedged = True
+                    llm, overrides = self._resolve_hedge()
+                    pumps.append(asyncio.ensure_future(self._pump(1, llm, system_prompt, user_prompt, {**kwargs, **overrides}, queue)))
+
+            failed = set()
+            while True:
+                index, kind, payload = item if item is not None else await queue.get()
+                item = None
+                now = time.monotonic() - start
+                if index == 0 and primary_first is None:
+                    primary_first = now
+                    if winner is not None:
+                        pumps[0].cancel()  # the primary lost, it was only kept to measure its latency
+                        continue
+                if winner is None:
+                    if kind == "error" and len(failed) + 1 < len(pumps):
+                        failed.add(index)  # the other contender may still answer
+                        continue
+                    winner, first_token = index, now
+                    if winner == 0:
+                        for pump in pumps[1:]:
+                            pump.cancel()
+                if index != winner:
+                    continue
+                if kind == "error":
+                    raise payload
+                if kind == "end":
+                    return
+                yield payload
+        finally:
+            for pump in pumps:
+                pump.cancel()
+            if first_token is not None:
+                # a primary cancelled before its first token has no time to first token to record
+                self.tracker.record(True, primary_first, first_token, hedged=hedged, hedge_won=winner == 1)
+
+
+    @staticmethod
+    async def _pump(index: int, llm, system_prompt: str, user_prompt: str, kwargs: dict, queue: asyncio.Queue) -> None:
+        """Stream a contender into the shared queue, in its own task so it can be cancelled on its own."""
+        try:
+            async with aclosing(llm.stream_completion(system_prompt, user_prompt, **kwargs)) as stream:
+                async for token in stream:
+                    queue.put_nowait((index, "token", token))
+            queue.put_nowait((index, "end", None))
+        except Exception as e:
+            queue.put_nowait((index, "error", e))
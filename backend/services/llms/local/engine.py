@@ -0,0 +1,206 @@
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+from services.llms.local.model_cache import LlamaModelCache, CachedModel
+from services.llms.local.scheduler import BatchScheduler, Sequence
+from services.llms.local.state_cache import get_prefix_cache, get_session_cache
+from services.llms.local.speculative import Drafter, DraftModelDrafter, PromptLookupDrafter
+from services.llms.local.tuning import tune_model
+from core.config import LLAMA_BATCH_MAX_SEQUENCES, LLAMA_BATCH_MAX_TOKENS, LLAMA_SPECULATIVE_DRAFT_TOKENS, LLAMA_PROMPT_LOOKUP_NGRAM
+
+
+# emit(request_id, kind, payload) with kind one of "token", "done", "error"
+Emit = Callable[[str, str, object], None]
+
+
+class LocalInferenceEngine:
+    """
+    Executes local inference requests against a resident model cache.
+
+    Requests are plain dicts so they can cross a process boundary:
+        {"id": ..., "op": "generate", "path": ..., "model": ..., "load_params": {...}, "prompt": ..., "prompt_prefix": ..., "conversation_id": ..., "temperature": ..., "max_tokens": ..., "speculative": {...}}
+        {"id": ..., "op": "embed", "path": ..., "model": ..., "load_params": {...}, "texts": [...]}
+        {"id": ..., "op": "load" | "unload" | "loaded", "path": ..., "model": ..., "load_params": {...}}
+        {"id": ..., "op": "benchmark", "path": ..., "model": ..., "load_params": {...}, "options": {...}}
+    Each request runs on a thread of the engine and reports back through emit: zero or more "token" events
+    followed by exactly one "done" (with the op result) or "error" (with the error message) event.
+    Generations are handed to the BatchScheduler of their model, which decodes concurrent requests together.
+    The optional prompt_prefix is the leading part of the prompt shared across requests (the system prompt),
+    whose KV state is cached in the prefix cache of the partition, and the optional conversation_id resumes
+    from the state saved at the end of the previous turn of the conversation. The optional speculative settings
+    ({"mode": "prompt_lookup" | "draft_model", "draft_model": ..., "draft_tokens": ..., "ngram_max": ...}) give
+    the scheduler of the model a drafter.
+    """
+
+    def __init__(self, cache: LlamaModelCache, max_threads: int = 4, partition: str = "main"):
+        self.cache = cache
+        self.partition = partition
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="llama-inference")
+        self._cancelled: set[str] = set()
+        self._lock = threading.Lock()
+
+
+    def submit(self, request: dict, emit: Emit) -> None:
+        self._executor.submit(self._run, request, emit)
+
+
+    def cancel(self, request_id: str) -> None:
+        """Stop a running generation at its next token."""
+        with self._lock:
+            self._cancelled.add(request_id)
+
+
+    def is_cancelled(self, request_id: str) -> bool:
+        with self._lock:
+            return request_id in self._cancelled
+
+
+    def _forget(self, request_id: str) -> None:
+        with self._lock:
+            self._cancelled.discard(request_id)
+
+
+    def _run(self, request: dict, emit: Emit) -> None:
+        request_id = request["id"]
+        if request["op"] == "generate":
+            try:
+                self._generate(request, emit)
+            except Exception as e:
+                self._forget(request_id)
+                emit(request_id, "error", f"{type(e).__name__}: {e}")
+            return
+
+        try:
+            op = request["op"]
+            if op == "load":
+                result = self.cache.get(request["path"], request["model"], **request["load_params"]).to_dict()
+            elif op == "unload":
+                result = self.cache.unload(request["path"], request.get("model"))
+            elif op == "loaded":
+                result = [entry.to_dict() for entry in self.cache.loaded(request["path"])]
+            elif op == "embed":
+                result = self._embed(request)
+            elif op == "benchmark":
+                options = request.get("options") or {}
+                result = tune_model(
+                    os.path.join(request["path"], request["model"]),
+                    verbose=request["load_params"].get("verbose", False),
+                    is_cancelled=lambda: self.is_cancelled(request_id),
+                    **options,
+                )
+            else:
+                raise ValueError(f"Unknown local inference op: {op}")
+            emit(request_id, "done", result)
+        except Exception as e:
+            emit(request_id, "error", f"{type(e).__name__}: {e}")
+        finally:
+            self._forget(request_id)
+
+
+    def _scheduler_for(self, entry: CachedModel, speculative: Optional[dict] = None) -> BatchScheduler:
+        speculative = speculative if speculative and speculative.get("mode") else None
+        with self._lock:
+            if entry.scheduler is not None and entry.speculative != speculative and entry.scheduler.active == 0:
+                # the speculative settings of the alias changed, the idle scheduler is rebuilt with the new ones
+                entry.scheduler.close()
+                entry.scheduler = None
+            if entry.scheduler is None:
+                entry.speculative = speculative
+                entry.scheduler = BatchScheduler(
+                    entry.llm,
+                    n_ctx=entry.params.get("n_ctx") or entry.llm.n_ctx(),
+                    # the batch size the model was loaded (or tuned) with
+                    max_batch_tokens=entry.params.get("n_batch") or LLAMA_BATCH_MAX_TOKENS,
+                    # states of a model file that was replaced in place must not be restored
+                    model_id=f"{entry.key!r}@{os.stat(os.path.join(entry.path, entry.model)).st_mtime_ns}",
+                    prefix_cache=get_prefix_cache(self.partition),
+                    session_cache=get_session_cache(self.partition),
+                    drafter=self._drafter_for(entry, speculative),
+                )
+            return entry.scheduler
+
+
+    def _drafter_for(self, entry: CachedModel, speculative: Optional[dict]) -> Optional[Drafter]:
+        if speculative is None:
+            return None
+        draft_tokens = speculative.get("draft_tokens") or LLAMA_SPECULATIVE_DRAFT_TOKENS
+        if speculative["mode"] == "prompt_lookup":
+            return PromptLookupDrafter(draft_tokens, ngram_max=speculative.get("ngram_max") or LLAMA_PROMPT_LOOKUP_NGRAM)
+        if speculative["mode"] == "draft_model":
+            # the draft model lives in the resident model cache, pinned for as long as the scheduler uses it
+            draft = self.cache.get(entry.path, speculative["draft_model"], pin=True, **entry.params)
+            try:
+                return DraftModelDrafter(
+                    draft.llm,
+                    n_ctx=entry.params.get("n_ctx") or entry.llm.n_ctx(),
+                    max_sequences=LLAMA_BATCH_MAX_SEQUENCES,
+                    draft_tokens=draft_tokens,
+                    max_batch_tokens=LLAMA_BATCH_MAX_TOKENS,
+                    on_close=lambda: self.cache.unpin(draft),
+                )
+            except Exception:
+                self.cache.unpin(draft)
+                raise
+        raise ValueError(f"Unknown speculative decoding mode: {speculative['mode']}")
+
+
+    @staticmethod
+    def _tokenize(entry: CachedModel, prompt: str, prefix: Optional[str]) -> Tuple[List[int], int]:
+        """Tokenize a prompt and return its tokens and the number of tokens of its shared prefix."""
+        if not prefix or not prompt.startswith(prefix):
+            return entry.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True), 0
+        # the prefix is tokenized on its own, so its tokens are the same for every prompt that starts with it
+        prefix_tokens = entry.llm.tokenize(prefix.encode("utf-8"), add_bos=True, special=True)
+        rest_tokens = entry.llm.tokenize(prompt[len(prefix):].encode("utf-8"), add_bos=False, special=True)
+        return prefix_tokens + rest_tokens, len(prefix_tokens)
+
+
+    def _embed(self, request: dict) -> List[List[float]]:
+        """Embed a batch of texts with a model loaded in embedding mode."""
+        params = {**request["load_params"], "embedding": True}
+        # every text is evaluated in a single llama.cpp batch, longer texts are truncated to the context
+        n_ctx = params.get("n_ctx") or 512
+        params.update(n_batch=n_ctx, n_ubatch=n_ctx)
+        with self.cache.acquire(request["path"], request["model"], **params) as llm:
+            vectors = llm.embed(request["texts"], normalize=True, truncate=True)
+        return [self._pooled(vector) for vector in vectors]
+
+
+    @staticmethod
+    def _pooled(vector: list) -> List[float]:
+        """Models without a pooling type return one vector per token, they are mean-pooled into one per text."""
+        if not vector or not isinstance(vector[0], list):
+            return vector
+        pooled = np.mean(np.asarray(vector, dtype=np.float32), axis=0)
+        norm = np.linalg.norm(pooled)
+        return (pooled / norm if norm > 0 else pooled).tolist()
+
+
+    def _generate(self, request: dict, emit: Emit) -> None:
+        """Tokenize the prompt and queue the generation on the scheduler, which reports its completion."""
+        request_id = request["id"]
+        entry = self.cache.get(request["path"], request["model"], pin=True, **request["load_params"])
+
+        def on_finish():
+            self.cache.unpin(entry)
+            self._forget(request_id)
+
+        try:
+            tokens, prefix_len = self._tokenize(entry, request["prompt"], request.get("prompt_prefix"))
+            scheduler = self._scheduler_for(entry, request.get("speculative"))
+        except Exception:
+            self.cache.unpin(entry)
+            raise
+        scheduler.submit(Sequence(
+            request_id=request_id,
+            tokens=tokens,
+            max_tokens=request["max_tokens"],
+            temperature=request["temperature"],
+            prefix_len=prefix_len,
+            session_id=request.get("conversation_id"),
+            emit=emit,
+            is_cancelled=lambda: self.is_cancelled(request_id),
+            on_finish=on_finish,
+        ))
@@ -0,0 +1,97 @@
+import struct
+from typing import BinaryIO, Dict, Optional
+
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF metadata value types: struct format of the scalar ones
+SCALAR_FORMATS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+STRING, ARRAY = 8, 9
+
+# Architectures of the encoder-only models, which llama.cpp can only run as embedding models
+EMBEDDING_ARCHITECTURES = {"bert", "nomic-bert", "nomic-bert-moe", "jina-bert-v2", "modern-bert", "neo-bert", "t5encoder"}
+
+
+class GGUFError(ValueError):
+    """The file is not a GGUF file, or its header is truncated."""
+
+
+def _read(f: BinaryIO, fmt: str):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise GGUFError("Truncated GGUF header")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f: BinaryIO) -> str:
+    length = _read(f, "<Q")
+    data = f.read(length)
+    if len(data) != length:
+        raise GGUFError("Truncated GGUF header")
+    return data.decode("utf-8", errors="replace")
+
+
+def _skip_strings(f: BinaryIO, count: int) -> None:
+    # vocabularies hold 100k+ strings, their lengths are walked in memory rather than with a read and a seek each
+    buffer, offset = b"", 0
+    for _ in range(count):
+        if offset + 8 > len(buffer):
+            buffer, offset = buffer[offset:] + f.read(1 << 20), 0
+            if len(buffer) < 8:
+                raise GGUFError("Truncated GGUF header")
+        offset += 8 + struct.unpack_from("<Q", buffer, offset)[0]
+        if offset > len(buffer):
+            f.seek(offset - len(buffer), 1)
+            buffer, offset = b"", 0
+    # give back what was read past the last string
+    f.seek(offset - len(buffer), 1)
+
+
+def _read_value(f: BinaryIO, value_type: int):
+    if value_type in SCALAR_FORMATS:
+        return _read(f, SCALAR_FORMATS[value_type])
+    if value_type == STRING:
+        return _read_string(f)
+    if value_type == ARRAY:
+        item_type, count = _read(f, "<I"), _read(f, "<Q")
+        # arrays are the vocabulary and merges of the tokenizer, they are skipped and only their length is kept
+        if item_type in SCALAR_FORMATS:
+            f.seek(count * struct.calcsize(SCALAR_FORMATS[item_type]), 1)
+        elif item_type == STRING:
+            _skip_strings(f, count)
+        else:
+            for _ in range(count):
+                _read_value(f, item_type)
+        return count
+    raise GGUFError(f"Unknown GGUF metadata value type {value_type}")
+
+
+def read_gguf_metadata(path: str) -> Dict[str, object]:
+    """
+    Read the metadata key/values of the header of a GGUF file, without reading its tensors.
+    Array values (the tokenizer vocabulary, merges, ...) are replaced by their length.
+    Args:
+        path (str): The path of the GGUF file.
+    Returns:
+        Dict[str, object]: The metadata, e.g. {"general.architecture": "llama", "llama.context_length": 8192, ...}.
+    """
+    with open(path, "rb") as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise GGUFError(f"{path} is not a GGUF file")
+        version = _read(f, "<I")
+        # version 1 counts tensors and metadata with 32 bit integers
+        count_format = "<I" if version == 1 else "<Q"
+        _read(f, count_format)  # tensor count
+        kv_count = _read(f, count_format)
+        metadata = {"gguf.version": version}
+        for _ in range(kv_count):
+            key = _read_string(f)
+            metadata[key] = _read_value(f, _read(f, "<I"))
+        return metadata
+
+
+def is_embedding_model(metadata: Dict[str, object]) -> bool:
+    """Whether a GGUF model is meant for embeddings: an encoder-only architecture, or a model that declares its pooling."""
+    architecture: Optional[str] = metadata.get("general.architecture")
+    return architecture in EMBEDDING_ARCHITECTURES or f"{architecture}.pooling_type" in metadata
@@ -1,24 +1,109 @@
 from services.llms.base import BaseLocalLLM
-from typing import Optional, AsyncGenerator
+from services.llms.local.workers import get_inference_backend
+from services.llms.local.model_index import model_index
+from core.config import LLAMA_BENCHMARK_TIMEOUT, LLAMA_EMBEDDING_BATCH, LLAMA_DEFAULT_N_CTX, LLAMA_DEFAULT_N_THREADS
+from typing import List, Optional, AsyncGenerator
+from dataclasses import asdict
+from contextlib import aclosing
 import os
-from llama_cpp import Llama
 
 
 class LlamaCppLLM(BaseLocalLLM):
-    """LLaMA-CPP LLM."""
-    def __init__(self, path: Optional[str] = None):
+    """
+    LLaMA-CPP LLM.
+    Inference runs on the local inference backend, by default a pool of worker processes that keep the models loaded.
+    Besides the prompts, completions accept the chat history as messages and a conversation_id, which renders the
+    prompt turn by turn and resumes from the model state saved at the end of the previous turn.
+
+    Args:
+        path (Optional[str]): The directory of the GGUF files.
+        parameters (Optional[dict]): The settings of the alias, its "speculative" settings enable speculative decoding
+            with a draft model ({"mode": "draft_model", "draft_model": ..., "draft_tokens": ...}) or prompt-lookup
+            decoding ({"mode": "prompt_lookup", "draft_tokens": ..., "ngram_max": ...}), its "tuning" settings hold
+            the load parameters the benchmark picked for each model ({model: {"load_params": {...}, ...}}).
+    """
+    def __init__(self, path: Optional[str] = None, parameters: Optional[dict] = None):
         super().__init__("llama-cpp", path)
         self.client = None
-    
+        self.load_params = {
+            "n_ctx": LLAMA_DEFAULT_N_CTX,
+            "n_threads": LLAMA_DEFAULT_N_THREADS,
+            "verbose": False,
+        }
+        self.speculative = (parameters or {}).get("speculative")
+        self.tuning = (parameters or {}).get("tuning") or {}
+
+
+    def model_load_params(self, model: Optional[str]) -> dict:
+        """The load parameters of a model: the defaults, overridden by the ones tuned for it on this host."""
+        tuned = ((self.tuning.get(model) or {}).get("load_params") or {}) if model else {}
+        return {**self.load_params, **tuned}
+
+
+    def _request(self, op: str, model: Optional[str] = None, **kwargs) -> dict:
+        return {
+            "op": op,
+            "path": os.path.abspath(self.path),
+            "model": model,
+            "load_params": self.model_load_params(model),
+            **kwargs,
+        }
+
 
-    def _load_model(self, model_path: str):
-        self.client = Llama(
-            model_path=f"{self.path}/{model_path}",
-            n_ctx=1024,
-            n_threads=4,
-            verbose=False,
+    def _generate_request(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        messages: Optional[list[dict]] = None,
+        conversation_id: Optional[str] = None,
+    ) -> dict:
+        # the system part of the prompt is the prefix shared by the requests of an agent or chatbot, its KV state is cached
+        prompt_prefix = f"<|system|>\n{system_prompt}\n"
+        if messages:
+            # one block per turn, so the prompt of the next turn extends the prompt and reply of this one
+            turns = "".join(f"<|{message['role']}|>\n{message['content']}\n" for message in messages if message["role"] != "system")
+        else:
+            turns = f"<|user|>\n{user_prompt}\n"
+        prompt = f"{prompt_prefix}{turns}<|assistant|>\n"
+        return self._request(
+            "generate",
+            model,
+            prompt=prompt,
+            prompt_prefix=prompt_prefix,
+            conversation_id=conversation_id,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            speculative=self.speculative,
         )
-        return
+
+
+    def load_model(self, model: str) -> dict:
+        """Load a model into the resident model cache, or return it if it is already loaded."""
+        return get_inference_backend().call(self._request("load", model))
+
+
+    def unload_model(self, model: Optional[str] = None) -> list[str]:
+        """Unload a model, or every idle model of this alias, from the resident model cache."""
+        return get_inference_backend().call(self._request("unload", model))
+
+
+    def loaded_models(self) -> list[dict]:
+        """List the models of this alias that are currently loaded."""
+        return get_inference_backend().call(self._request("loaded"))
+
+
+    def benchmark(self, model: str, **options) -> dict:
+        """
+        Measure the prefill and decode speed of a model across thread counts, batch sizes and context windows,
+        on the worker that serves it, and pick its load parameters. See services.llms.local.tuning.tune_model.
+        Raises:
+            TimeoutError: If the benchmark did not finish within LLAMA_BENCHMARK_TIMEOUT seconds, it is cancelled.
+        """
+        return get_inference_backend().call(self._request("benchmark", model, options=options), timeout=LLAMA_BENCHMARK_TIMEOUT)
+
 
     def get_completion(
         self,
@@ -29,14 +114,27 @@ class LlamaCppLLM(BaseLocalLLM):
         max_tokens: int = 1024,
         **kwargs,
     ) -> str:
-        prompt = f"<|system|>\n{system_prompt}\n<|user|>\n{user_prompt}\n<|assistant|>\n"
-        self._load_model(model)
-        output = self.client(
-            prompt,
-            temperature=temperature,
-            stream=False
+        return get_inference_backend().complete(
+            self._generate_request(
+                system_prompt, user_prompt, model, temperature, max_tokens, kwargs.get("messages"), kwargs.get("conversation_id")
+            )
         )
-        return output["choices"][0]["text"]
+
+
+    async def aget_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: str,
+        temperature: float = 0.1,
+        max_tokens: int = 1024,
+        **kwargs,
+    ) -> str:
+        tokens = []
+        async with aclosing(self.stream_completion(system_prompt, user_prompt, model, temperature, max_tokens, **kwargs)) as stream:
+            async for token in stream:
+                tokens.append(token)
+        return "".join(tokens)
 
 
     async def stream_completion(
@@ -48,26 +146,43 @@ class LlamaCppLLM(BaseLocalLLM):
         max_tokens: int = 1024,
         **kwargs,
     ) -> AsyncGenerator[str, None]:
-        prompt = f"<|system|>\n{system_prompt}\n<|user|>\n{user_prompt}\n<|assistant|>\n"
-        self._load_model(model)
-        stream = self.client(
-            prompt,
-            temperature=temperature,
-            stream=True,
+        request = self._generate_request(
+            system_prompt, user_prompt, model, temperature, max_tokens, kwargs.get("messages"), kwargs.get("conversation_id")
         )
-        for chunk in stream:
-            yield chunk["choices"][0]["text"]
+        async with aclosing(get_inference_backend().stream(request)) as stream:
+            async for token in stream:
+                yield token
 
 
     def list_models(self) -> list[str]:
-        """List available models."""
-        model_files = os.listdir(self.path)
-        return model_files
+        """List the GGUF models of the path."""
+        return [model.file for model in model_index.scan(self.path)]
+
+
+    def list_model_details(self) -> list[dict]:
+        """List the GGUF models of the path with the architecture, quantization, context length, ... of their header."""
+        return [asdict(model) for model in model_index.scan(self.path)]
+
+
+    def model_fingerprint(self, model: str) -> str:
+        """Identifies the contents of a model file, it changes when the file is replaced."""
+        stat = os.stat(os.path.join(self.path, model))
+        return f"{model}@{stat.st_size}:{stat.st_mtime_ns}"
 
 
     def list_embeddings_models(self) -> list[str]:
-        """List available embeddings models."""
-        return []
+        """List the GGUF files of the path that are embedding models, according to their header."""
+        return [model.file for model in model_index.scan(self.path) if model.is_embedding]
+
+
+    max_embedding_batch = LLAMA_EMBEDDING_BATCH
+
+    def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        """
+        Embed texts with a GGUF model in llama.cpp embedding mode, on the local inference backend.
+        The embedding context lives in the resident model cache next to the completion ones, within the same budget.
+        """
+        return get_inference_backend().call(self._request("embed", model, texts=texts))
 
 
     def to_code(self, model: str) -> str:
@@ -87,6 +202,7 @@ class LlamaCppLLM(BaseLocalLLM):
         Returns:
             dict: A dictionary of tunable parameters.
         """
+        load_params = self.model_load_params(model)
         return {
             "temperature": {
                 "type": "float",
@@ -102,15 +218,15 @@ class LlamaCppLLM(BaseLocalLLM):
             },
             "n_ctx": {
                 "type": "int",
-                "default": 1024,
+                "default": load_params["n_ctx"],
                 "min": 1,
-                "max": 8192,
+                "max": max(8192, load_params["n_ctx"]),
             },
             "n_threads": {
                 "type": "int",
-                "default": 4,
+                "default": load_params["n_threads"],
                 "min": 1,
-                "max": 32,
+                "max": os.cpu_count() or 32,
             },
             "verbose": {
                 "type": "bool",
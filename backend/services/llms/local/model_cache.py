@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+from llama_cpp import Llama
+from core.config import LLAMA_CACHE_MAX_BYTES, LLAMA_CACHE_IDLE_TIMEOUT
+
+
+ModelKey = Tuple[str, str, Tuple[Tuple[str, object], ...]]
+
+
+@dataclass
+class CachedModel:
+    """A loaded llama.cpp model together with its bookkeeping."""
+    key: ModelKey
+    llm: Llama
+    size_bytes: int
+    last_used: float = field(default_factory=time.monotonic)
+    in_use: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)  # a Llama context serves one generation at a time
+    scheduler: Optional[object] = None  # the BatchScheduler decoding concurrent generations of the model
+    speculative: Optional[dict] = None  # the speculative decoding settings the scheduler was built with
+
+    @property
+    def path(self) -> str:
+        return self.key[0]
+
+    @property
+    def model(self) -> str:
+        return self.key[1]
+
+    @property
+    def params(self) -> dict:
+        return dict(self.key[2])
+
+    def to_dict(self) -> dict:
+        return {
+            "model": self.model,
+            "size_bytes": self.size_bytes,
+            "idle_seconds": 0.0 if self.in_use else time.monotonic() - self.last_used,
+            "in_use": self.in_use > 0,
+        }
+
+
+class LlamaModelCache:
+    """
+    LRU cache of loaded llama.cpp models, keyed by (path, model file, load params).
+
+    The size of a model is its GGUF file size, which is what llama.cpp maps into memory; the contexts of a file
+    loaded with different params (e.g. for completions and for embeddings) share its mapping. Loading a model that
+    does not fit in the byte budget unloads the least recently used idle models first, and models that stay
+    unused for longer than the idle timeout are unloaded by a background sweeper.
+    """
+
+    def __init__(self, max_bytes: int = LLAMA_CACHE_MAX_BYTES, idle_timeout: float = LLAMA_CACHE_IDLE_TIMEOUT):
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self._models: "OrderedDict[ModelKey, CachedModel]" = OrderedDict()
+        self._load_locks: Dict[ModelKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+
+
+    @staticmethod
+    def make_key(path: str, model: str, **params) -> ModelKey:
+        return os.path.abspath(path), model, tuple(sorted(params.items()))
+
+
+    def get(self, path: str, model: str, pin: bool = False, **params) -> CachedModel:
+        """
+        Get a loaded model, loading it on a miss.
+        Args:
+            path (str): The directory of the local LLM alias.
+            model (str): The GGUF file name inside the directory.
+            pin (bool): Mark the model as in use until unpin, in the same critical section that finds or inserts
+                it, so an eviction can not unload it in between.
+            **params: The llama.cpp load parameters (n_ctx, n_threads, ...).
+        Returns:
+            CachedModel: The cache entry of the loaded model.
+        """
+        key = self.make_key(path, model, **params)
+        with self._lock:
+            entry = self._touch(key, pin)
+            if entry is not None:
+                return entry
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # concurrent misses of the same model wait for a single load
+        with load_lock:
+            with self._lock:
+                entry = self._touch(key, pin)
+                if entry is not None:
+                    return entry
+
+            model_path = os.path.join(key[0], model)
+            size_bytes = os.path.getsize(model_path)
+            self._make_room(key, size_bytes)
+
+            print(f"[AgentSmith LLM] Loading {model_path}")
+            llm = Llama(model_path=model_path, **params)
+            entry = CachedModel(key=key, llm=llm, size_bytes=size_bytes, in_use=int(pin))
+
+            with self._lock:
+                self._models[key] = entry
+                self._load_locks.pop(key, None)
+            self._start_sweeper()
+            return entry
+
+
+    def unpin(self, entry: CachedModel) -> None:
+        with self._lock:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+
+    def checkout(self, path: str, model: str, **params) -> CachedModel:
+        """Get a loaded model and take exclusive use of its Llama context until checkin. Blocks while it serves another request."""
+        entry = self.get(path, model, pin=True, **params)
+        entry.lock.acquire()
+        return entry
+
+
+    def checkin(self, entry: CachedModel) -> None:
+        entry.lock.release()
+        self.unpin(entry)
+
+
+    @contextmanager
+    def acquire(self, path: str, model: str, **params) -> Iterator[Llama]:
+        entry = self.checkout(path, model, **params)
+        try:
+            yield entry.llm
+        finally:
+            self.checkin(entry)
+
+
+    def unload(self, path: str, model: Optional[str] = None) -> List[str]:
+        """
+        Unload the idle models of a path, or a single model file when model is given.
+        Returns:
+            List[str]: The model files that were unloaded.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            keys = [
+                key for key, entry in self._models.items()
+                if key[0] == path and (model is None or key[1] == model) and entry.in_use == 0
+            ]
+            entries = [self._models.pop(key) for key in keys]
+        for entry in entries:
+            self._close(entry)
+        return [entry.model for entry in entries]
+
+
+    def evict_idle(self) -> List[str]:
+        """Unload the models that have not been used for longer than the idle timeout."""
+        if self.idle_timeout <= 0:
+            return []
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            keys = [key for key, entry in self._models.items() if entry.in_use == 0 and entry.last_used < deadline]
+            entries = [self._models.pop(key) for key in keys]
+        for entry in entries:
+            print(f"[AgentSmith LLM] Unloading idle model {entry.model}")
+            self._close(entry)
+        return [entry.model for entry in entries]
+
+
+    def loaded(self, path: Optional[str] = None) -> List[CachedModel]:
+        path = os.path.abspath(path) if path is not None else None
+        with self._lock:
+            return [entry for key, entry in self._models.items() if path is None or key[0] == path]
+
+
+    @property
+    def used_bytes(self) -> int:
+        with self._lock:
+            return self._resident_bytes(list(self._models.values()))
+
+
+    def _touch(self, key: ModelKey, pin: bool = False) -> Optional[CachedModel]:
+        """Mark a model as most recently used, and as in use if pin. Must be called with the cache lock held."""
+        entry = self._models.get(key)
+        if entry is not None:
+            self._models.move_to_end(key)
+            entry.last_used = time.monotonic()
+            entry.in_use += int(pin)
+        return entry
+
+
+    @staticmethod
+    def _resident_bytes(entries: List[CachedModel], incoming: Optional[Tuple[ModelKey, int]] = None) -> int:
+        """
+        Bytes of weights mapped by the given models, and the incoming (key, size) model if any.
+        The contexts of the same file (e.g. its completion and embedding contexts) memory-map the same pages, so a
+        file counts once, unless it was loaded with use_mmap=False.
+        """
+        files = {}
+        for key, size_bytes in [(entry.key, entry.size_bytes) for entry in entries] + ([incoming] if incoming else []):
+            files[key[:2] if dict(key[2]).get("use_mmap", True) else key] = size_bytes
+        return sum(files.values())
+
+
+    def _make_room(self, key: ModelKey, size_bytes: int) -> None:
+        """Unload least recently used idle models until the model of key, of size_bytes, fits in the budget."""
+        with self._lock:
+            evicted = []
+            for loaded_key in list(self._models.keys()):
+                if self._resident_bytes(list(self._models.values()), (key, size_bytes)) <= self.max_bytes:
+                    break
+                entry = self._models[loaded_key]
+                if entry.in_use:
+                    continue
+                evicted.append(self._models.pop(loaded_key))
+            over_budget = self._resident_bytes(list(self._models.values()), (key, size_bytes)) > self.max_bytes
+        for entry in evicted:
+            print(f"[AgentSmith LLM] Unloading {entry.model} to stay within the model cache budget")
+            self._close(entry)
+        if over_budget:
+            print(f"[AgentSmith LLM] Model cache budget of {self.max_bytes} bytes exceeded by models in use")
+
+
+    @staticmethod
+    def _close(entry: CachedModel) -> None:
+        if entry.scheduler is not None:
+            entry.scheduler.close()
+        close = getattr(entry.llm, "close", None)
+        if close is not None:
+            close()
+
+
+    def _start_sweeper(self) -> None:
+        if self.idle_timeout <= 0 or (self._sweeper is not None and self._sweeper.is_alive()):
+            return
+        self._sweeper = threading.Thread(target=self._sweep, name="llama-model-cache-sweeper", daemon=True)
+        self._sweeper.start()
+
+
+    def _sweep(self) -> None:
+        interval = min(self.idle_timeout / 2, 60)
+        while True:
+            time.sleep(interval)
+            self.evict_idle()
+
+
+model_cache = LlamaModelCache()
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List, Optional, Tuple
+from core.config import LLAMA_MODEL_INDEX_FILE
+from services.llms.local.gguf import read_gguf_metadata, is_embedding_model, GGUFError
+
+
+# general.file_type of the GGUF header: the llama_ftype the weights were quantized with
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1", 10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M",
+    13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS",
+    21: "Q2_K_S", 22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S",
+    29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16", 36: "TQ1_0", 37: "TQ2_0",
+}
+
+
+@dataclass
+class GGUFModelInfo:
+    """What the header of a GGUF file tells about its model."""
+    file: str
+    size_bytes: int
+    architecture: Optional[str] = None
+    name: Optional[str] = None
+    size_label: Optional[str] = None
+    quantization: Optional[str] = None
+    context_length: Optional[int] = None
+    embedding_length: Optional[int] = None
+    block_count: Optional[int] = None
+    vocab_size: Optional[int] = None
+    split_count: int = 1
+    is_embedding: bool = False
+
+    @classmethod
+    def from_metadata(cls, file: str, size_bytes: int, metadata: Dict[str, object]) -> "GGUFModelInfo":
+        architecture = metadata.get("general.architecture")
+        file_type = metadata.get("general.file_type")
+        return cls(
+            file=file,
+            size_bytes=size_bytes,
+            architecture=architecture,
+            name=metadata.get("general.name"),
+            size_label=metadata.get("general.size_label"),
+            quantization=FILE_TYPES.get(file_type, str(file_type)) if file_type is not None else None,
+            context_length=metadata.get(f"{architecture}.context_length"),
+            embedding_length=metadata.get(f"{architecture}.embedding_length"),
+            block_count=metadata.get(f"{architecture}.block_count"),
+            vocab_size=metadata.get("tokenizer.ggml.tokens"),
+            split_count=metadata.get("split.count") or 1,
+            is_embedding=is_embedding_model(metadata),
+        )
+
+
+INFO_FIELDS = {f.name for f in fields(GGUFModelInfo)}
+
+
+class GGUFModelIndex:
+    """
+    Index of the GGUF files of the local model directories, built from their headers without loading any weights.
+
+    The entry of a file is keyed by its absolute path and stays valid while its modification time and size do not
+    change, so after the first pass a scan only stats the files of the directory. The index is kept in memory and in
+    index_file, which spares the header reads after a restart.
+
+    Args:
+        index_file (Optional[str]): JSON file the index is persisted to, None keeps it in memory only.
+    """
+
+    def __init__(self, index_file: Optional[str] = LLAMA_MODEL_INDEX_FILE):
+        self.index_file = index_file
+        self._entries: Dict[str, Tuple[int, int, Optional[dict]]] = {}  # path -> (mtime_ns, size, info or None if unreadable)
+        self._lock = threading.Lock()
+        self._loaded = False
+
+
+    def scan(self, directory: str) -> List[GGUFModelInfo]:
+        """
+        The models of a directory: its readable GGUF files, the first shard only for models split across files.
+        Args:
+            directory (str): The model directory.
+        Returns:
+            List[GGUFModelInfo]: The models, sorted by file name.
+        """
+        directory = os.path.abspath(directory)
+        self._load()
+        files = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".gguf") and entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_mtime_ns, stat.st_size))
+
+        models, changed = [], False
+        for path, mtime_ns, size in sorted(files):
+            with self._lock:
+                cached = self._entries.get(path)
+            if cached is not None and cached[:2] == (mtime_ns, size):
+                info = cached[2]
+            else:
+                info = self._read(path, size)
+                changed = True
+                with self._lock:
+                    self._entries[path] = (mtime_ns, size, info)
+            if info is not None and not info.get("split_no"):
+                models.append(GGUFModelInfo(**{key: value for key, value in info.items() if key in INFO_FIELDS}))
+
+        present = {path for path, _, _ in files}
+        with self._lock:
+            removed = [path for path in self._entries if os.path.dirname(path) == directory and path not in present]
+            for path in removed:
+                del self._entries[path]
+        if changed or removed:
+            self._save()
+        return models
+
+
+    def get(self, path: str) -> Optional[GGUFModelInfo]:
+        """The info of a single GGUF file, None if it is not a readable GGUF file."""
+        path = os.path.abspath(path)
+        directory, file = os.path.split(path)
+        return next((model for model in self.scan(directory) if model.file == file), None)
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        self._save()
+
+
+    @staticmethod
+    def _read(path: str, size: int) -> Optional[dict]:
+        try:
+            metadata = read_gguf_metadata(path)
+        except (OSError, GGUFError) as e:
+            print(f"[AgentSmith LLM] Could not read the GGUF header of {os.path.basename(path)}: {e}")
+            return None
+        info = asdict(GGUFModelInfo.from_metadata(os.path.basename(path), size, metadata))
+        # shards after the first one of a split model are not models of their own
+        info["split_no"] = metadata.get("split.no") or 0
+        return info
+
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        entries = {}
+        if self.index_file and os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    entries = {path: tuple(entry) for path, entry in json.load(f).items()}
+            except (OSError, ValueError, TypeError) as e:
+                print(f"[AgentSmith LLM] Could not read the model index, rebuilding it: {e}")
+        with self._lock:
+            if not self._loaded:
+                self._entries = {**entries, **self._entries}
+                self._loaded = True
+
+
+    def _save(self) -> None:
+        if not self.index_file:
+            return
+        with self._lock:
+            data = json.dumps({path: list(entry) for path, entry in self._entries.items()})
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            # written aside and renamed, a concurrent reader never sees a partial index
+            tmp = f"{self.index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self.index_file)
+        except OSError as e:
+            print(f"[AgentSmith LLM] Could not save the model index: {e}")
+
+
+model_index = GGUFModelIndex()
@@ -0,0 +1,449 @@
+import codecs
+import ctypes
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+from core.config import LLAMA_BATCH_MAX_SEQUENCES, LLAMA_BATCH_MAX_TOKENS, LLAMA_BATCH_PREFILL_CHUNK, LLAMA_PREFIX_CACHE_MIN_TOKENS
+from services.llms.local.state_cache import LlamaStateCache
+from services.llms.local.speculative import Drafter
+
+
+@dataclass
+class Sequence:
+    """A generation request handled by the batch scheduler."""
+    request_id: str
+    tokens: List[int]  # the prompt tokens, generated tokens are appended as they are sampled
+    max_tokens: int
+    temperature: float
+    emit: Callable[[str, str, object], None]
+    is_cancelled: Callable[[], bool]
+    on_finish: Optional[Callable[[], None]] = None
+    top_k: int = 40
+    top_p: float = 0.95
+    prefix_len: int = 0  # leading prompt tokens shared across requests (the system prompt), cached once evaluated
+    session_id: Optional[str] = None  # conversation whose state is restored on admission and saved when finished
+    slot: int = -1
+    n_past: int = 0  # tokens of the sequence already evaluated into the KV cache
+    n_generated: int = 0
+    save_prefix: bool = False
+    decoder: codecs.IncrementalDecoder = field(default_factory=lambda: codecs.getincrementaldecoder("utf-8")(errors="replace"))
+
+    @property
+    def pending(self) -> int:
+        """Tokens that still have to be evaluated before the next token can be sampled."""
+        return len(self.tokens) - self.n_past
+
+
+class BatchScheduler:
+    """
+    Continuous batching scheduler for a loaded llama.cpp model.
+
+    The scheduler owns a multi-sequence llama.cpp context that shares the weights of the loaded Llama, and a
+    thread that repeatedly builds one llama_decode batch out of every running sequence: the last sampled token
+    of each generating sequence first, then chunks of the prompts of newly admitted sequences. New requests are
+    admitted into free sequence slots between steps, so they join the in-progress batch instead of waiting for
+    the running generations to finish.
+
+    Args:
+        llm (Llama): The loaded model.
+        n_ctx (int): The context window of a single sequence.
+        max_sequences (int): Sequences decoded together, each one owns a KV cache sequence slot.
+        max_batch_tokens (int): Tokens submitted to a single llama_decode call.
+        prefill_chunk (int): Prompt tokens a single sequence may evaluate per step, the fairness knob between
+            running streams and newly admitted long prompts.
+        model_id (str): Identifies the loaded model (and load params) the cached states belong to.
+        prefix_cache (Optional[LlamaStateCache]): Cache of the KV states of shared prompt prefixes. An admitted
+            sequence restores the longest cached prefix of its prompt instead of evaluating it, and a prefix
+            that was not cached is saved as soon as it has been evaluated.
+        session_cache (Optional[LlamaStateCache]): Cache of the states of conversations. The state of a sequence
+            with a session id is saved when it finishes, so the next turn of the conversation only evaluates the
+            tokens that follow the common prefix of the two turns. The state is read once the step is over, after
+            the reply was delivered, and stored in the cache off the decode thread.
+        drafter (Optional[Drafter]): Speculative decoding. The draft tokens it proposes for a generating sequence
+            are evaluated right after its last sampled token, in the same llama_decode, and every draft token
+            matching the token sampled at its position is accepted, so a step may yield several tokens. Tokens
+            are always sampled from the logits of the model, the output is the same as without drafts.
+    """
+
+    def __init__(
+        self,
+        llm: Llama,
+        n_ctx: int,
+        max_sequences: int = LLAMA_BATCH_MAX_SEQUENCES,
+        max_batch_tokens: int = LLAMA_BATCH_MAX_TOKENS,
+        prefill_chunk: int = LLAMA_BATCH_PREFILL_CHUNK,
+        model_id: str = "",
+        prefix_cache: Optional[LlamaStateCache] = None,
+        session_cache: Optional[LlamaStateCache] = None,
+        drafter: Optional[Drafter] = None,
+    ):
+        self.llm = llm
+        self.n_ctx = n_ctx
+        self.max_sequences = max_sequences
+        self.max_batch_tokens = max(max_batch_tokens, max_sequences)
+        self.prefill_chunk = max(prefill_chunk, 1)
+        self._n_vocab = llm.n_vocab()
+        self.prefix_cache = prefix_cache
+        self.session_cache = session_cache
+        self._namespace = LlamaStateCache.namespace_for(model_id)
+        self.drafter = drafter
+        if drafter is not None and getattr(drafter, "n_vocab", self._n_vocab) != self._n_vocab:
+            drafter.close()
+            raise ValueError("The draft model does not share the vocabulary of the model")
+        self.stats = {"steps": 0, "drafted": 0, "accepted": 0}
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(llm.context_params)
+        params.n_ctx = n_ctx * max_sequences
+        params.n_seq_max = max_sequences
+        params.n_batch = self.max_batch_tokens
+        params.n_ubatch = min(params.n_ubatch, self.max_batch_tokens)
+        self._ctx = internals.LlamaContext(model=llm._model, params=params, verbose=llm.verbose)
+        self._batch = internals.LlamaBatch(n_tokens=self.max_batch_tokens, embd=0, n_seq_max=1, verbose=llm.verbose)
+        self._rng = np.random.default_rng()
+
+        self._waiting: Deque[Sequence] = deque()
+        self._running: Dict[int, Sequence] = {}  # slot -> sequence
+        self._finished: Dict[int, Sequence] = {}  # slot -> finished sequence whose state is still to be saved
+        self._saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama-session-save")
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="llama-batch-scheduler", daemon=True)
+        self._thread.start()
+
+
+    def submit(self, sequence: Sequence) -> None:
+        """Queue a sequence for admission. Its events are reported through sequence.emit."""
+        if len(sequence.tokens) >= self.n_ctx:
+            self._fail(sequence, f"Prompt of {len(sequence.tokens)} tokens exceeds the context window of {self.n_ctx} tokens")
+            return
+        sequence.max_tokens = min(sequence.max_tokens, self.n_ctx - len(sequence.tokens))
+        with self._condition:
+            if self._closed:
+                self._fail(sequence, "Model was unloaded")
+                return
+            self._waiting.append(sequence)
+            self._condition.notify()
+
+
+    @property
+    def active(self) -> int:
+        with self._condition:
+            return len(self._running) + len(self._waiting)
+
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._saver.shutdown(wait=True)
+        if self.drafter is not None:
+            self.drafter.close()
+        self._batch.close()
+        self._ctx.close()
+
+
+    def _loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed and not self._waiting and not self._running:
+                    self._condition.wait()
+                if self._closed:
+                    break
+                self._admit()
+
+            self._drop_cancelled()
+            if self._running:
+                try:
+                    self._step()
+                except Exception as e:
+                    # a failed decode leaves the KV cache of the whole batch in an unknown state
+                    for sequence in list(self._running.values()):
+                        self._fail(sequence, f"{type(e).__name__}: {e}")
+                    for sequence in list(self._finished.values()):
+                        with self._condition:
+                            self._release(sequence)
+            self._save_sessions()
+
+        with self._condition:
+            sequences = list(self._running.values()) + list(self._waiting)
+            self._waiting.clear()
+        for sequence in sequences:
+            self._fail(sequence, "Model was unloaded")
+
+
+    def _admit(self) -> None:
+        """Move waiting sequences into free slots, in arrival order. Must be called with the condition held."""
+        free_slots = [slot for slot in range(self.max_sequences) if slot not in self._running and slot not in self._finished]
+        while self._waiting and free_slots:
+            sequence = self._waiting.popleft()
+            sequence.slot = free_slots.pop(0)
+            self._ctx.kv_cache_seq_rm(sequence.slot, -1, -1)
+            self._running[sequence.slot] = sequence
+            self._restore_session(sequence)
+            if sequence.n_past == 0:
+                self._restore_prefix(sequence)
+
+
+    def _session_key(self, sequence: Sequence) -> str:
+        return hashlib.sha256(sequence.session_id.encode("utf-8")).hexdigest()
+
+
+    def _restore_session(self, sequence: Sequence) -> None:
+        if self.session_cache is None or sequence.session_id is None:
+            return
+        snapshot = self.session_cache.get(self._namespace, self._session_key(sequence))
+        if snapshot is None:
+            return
+        # the previous turn was saved with its generated tokens, which the new prompt re-tokenizes from text,
+        # so only the common prefix of the two is reused
+        n_common = 0
+        for cached, token in zip(snapshot.tokens, sequence.tokens[:-1]):
+            if cached != token:
+                break
+            n_common += 1
+        if n_common < LLAMA_PREFIX_CACHE_MIN_TOKENS:
+            return
+        if not self._set_state(sequence.slot, snapshot.data):
+            self._ctx.kv_cache_seq_rm(sequence.slot, -1, -1)
+            return
+        self._ctx.kv_cache_seq_rm(sequence.slot, n_common, -1)
+        sequence.n_past = n_common
+
+
+    def _keeps_session(self, sequence: Sequence) -> bool:
+        return self.session_cache is not None and sequence.session_id is not None and sequence.n_past > 0
+
+
+    def _save_sessions(self) -> None:
+        """
+        Read the states of the sequences that finished during the step and free their slots. Reading the state of a
+        slot needs the context, so it stays on the decode thread, but storing it, which may evict and spill older
+        snapshots to disk, is left to the saver thread.
+        """
+        for sequence in list(self._finished.values()):
+            try:
+                data = self._get_state(sequence.slot)
+            except Exception as e:
+                print(f"[AgentSmith LLM] Could not snapshot the state of conversation {sequence.session_id}: {e}")
+            else:
+                self._saver.submit(
+                    self.session_cache.put, self._namespace, self._session_key(sequence), sequence.tokens[:sequence.n_past], data
+                )
+            with self._condition:
+                self._release(sequence)
+
+
+    def _restore_prefix(self, sequence: Sequence) -> None:
+        # prefixes must leave at least one prompt token to evaluate, which yields the logits of the first sampled token
+        sequence.prefix_len = min(sequence.prefix_len, len(sequence.tokens) - 1)
+        if self.prefix_cache is None or sequence.prefix_len < LLAMA_PREFIX_CACHE_MIN_TOKENS:
+            return
+        snapshot = self.prefix_cache.match(self._namespace, sequence.tokens, max_tokens=sequence.prefix_len)
+        if snapshot is not None:
+            if self._set_state(sequence.slot, snapshot.data):
+                sequence.n_past = len(snapshot.tokens)
+            else:
+                self._ctx.kv_cache_seq_rm(sequence.slot, -1, -1)
+        sequence.save_prefix = sequence.n_past < sequence.prefix_len
+
+
+    def _save_prefix(self, sequence: Sequence) -> None:
+        sequence.save_prefix = False
+        prefix = sequence.tokens[:sequence.prefix_len]
+        self.prefix_cache.put(self._namespace, LlamaStateCache.prefix_key(prefix), prefix, self._get_state(sequence.slot))
+
+
+    def _get_state(self, slot: int) -> bytes:
+        size = llama_cpp.llama_state_seq_get_size(self._ctx.ctx, slot)
+        buffer = (ctypes.c_uint8 * size)()
+        n_bytes = llama_cpp.llama_state_seq_get_data(self._ctx.ctx, buffer, size, slot)
+        return ctypes.string_at(buffer, n_bytes)
+
+
+    def _set_state(self, slot: int, data: bytes) -> bool:
+        buffer = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        return llama_cpp.llama_state_seq_set_data(self._ctx.ctx, buffer, len(data), slot) > 0
+
+
+    def _drop_cancelled(self) -> None:
+        for sequence in list(self._running.values()):
+            if sequence.is_cancelled():
+                self._finish(sequence)
+        with self._condition:
+            cancelled = [sequence for sequence in self._waiting if sequence.is_cancelled()]
+            for sequence in cancelled:
+                self._waiting.remove(sequence)
+        for sequence in cancelled:
+            self._finish(sequence)
+
+
+    def _step(self) -> None:
+        """Run a single llama_decode over all running sequences and sample their next tokens."""
+        self._batch.reset()
+        budget = self.max_batch_tokens
+        sampled: List[tuple[Sequence, int, List[int]]] = []  # (sequence, batch index of its first logits, draft tokens)
+
+        # generating sequences first, each contributes its last sampled token and the draft tokens that follow it
+        generating = [sequence for sequence in self._running.values() if sequence.pending == 1]
+        drafts = self._draft(generating, budget)
+        for sequence in generating:
+            draft = drafts.get(sequence.slot, [])
+            sampled.append((sequence, self._add(sequence, 1, draft), draft))
+            budget -= 1 + len(draft)
+
+        # then prompt chunks of the prefilling sequences, oldest slot first
+        for sequence in sorted(self._running.values(), key=lambda s: s.slot):
+            if sequence.pending <= 1 or budget <= 0:
+                continue
+            n_tokens = min(sequence.pending, self.prefill_chunk, budget)
+            if sequence.save_prefix:
+                # stop at the end of the prefix, so its state can be saved before the rest of the prompt is evaluated
+                n_tokens = min(n_tokens, sequence.prefix_len - sequence.n_past)
+            index = self._add(sequence, n_tokens)
+            budget -= n_tokens
+            if sequence.pending == 0:
+                sampled.append((sequence, index, []))
+
+        if self._batch.n_tokens() == 0:
+            return
+        self._ctx.decode(self._batch)
+        self.stats["steps"] += 1
+
+        for sequence in list(self._running.values()):
+            if sequence.save_prefix and sequence.n_past == sequence.prefix_len:
+                self._save_prefix(sequence)
+
+        for sequence, index, draft in sampled:
+            self._verify(sequence, index, draft)
+
+
+    def _draft(self, generating: List[Sequence], budget: int) -> dict:
+        """Draft tokens of the generating sequences, sharing the batch tokens their last sampled tokens leave."""
+        if self.drafter is None or not generating:
+            return {}
+        per_sequence = min(self.drafter.draft_tokens, (budget - len(generating)) // len(generating))
+        requests = {}
+        for sequence in generating:
+            # drafts never run past the token budget of the request or the context window
+            n_draft = min(per_sequence, sequence.max_tokens - sequence.n_generated - 1, self.n_ctx - len(sequence.tokens) - 1)
+            if n_draft > 0:
+                requests[sequence.slot] = (sequence.tokens, n_draft)
+        if not requests:
+            return {}
+        return self.drafter.propose(requests)
+
+
+    def _add(self, sequence: Sequence, n_tokens: int, draft: Optional[List[int]] = None) -> int:
+        """
+        Add the next n_tokens pending tokens of a sequence to the batch, followed by its draft tokens if any,
+        and return the batch index of the logits of the last pending token. Every draft token gets logits too.
+        """
+        batch = self._batch.batch
+        start = sequence.n_past
+        for position, token in enumerate(sequence.tokens[start:start + n_tokens] + (draft or []), start=start):
+            i = batch.n_tokens
+            batch.token[i] = token
+            batch.pos[i] = position
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = sequence.slot
+            batch.logits[i] = position >= start + n_tokens
+            batch.n_tokens += 1
+        sequence.n_past += n_tokens
+        last = batch.n_tokens - 1 - len(draft or [])
+        batch.logits[last] = sequence.pending == 0
+        return last
+
+
+    def _verify(self, sequence: Sequence, index: int, draft: List[int]) -> None:
+        """Sample the next token of a sequence, and while it matches the draft, the tokens after it too."""
+        tokens = []
+        for offset in range(len(draft) + 1):
+            logits = np.ctypeslib.as_array(self._ctx.get_logits_ith(index + offset), shape=(self._n_vocab,))
+            tokens.append(self._sample(logits, sequence))
+            if offset == len(draft) or tokens[-1] != draft[offset]:
+                break
+        if draft:
+            self.stats["drafted"] += len(draft)
+            self.stats["accepted"] += len(tokens) - 1
+            # the accepted draft tokens are already evaluated, the KV cache of the rejected ones is dropped
+            sequence.n_past += len(tokens) - 1
+            self._ctx.kv_cache_seq_rm(sequence.slot, sequence.n_past, -1)
+        for token in tokens:
+            if self._running.get(sequence.slot) is not sequence:
+                break  # finished (end of generation or max_tokens) within the accepted tokens
+            if sequence.is_cancelled():
+                self._finish(sequence)  # the consumer went away, the rest of the accepted drafts are not sent
+                break
+            self._accept(sequence, token)
+
+
+    def _sample(self, logits: np.ndarray, sequence: Sequence) -> int:
+        if sequence.temperature <= 0:
+            return int(np.argmax(logits))
+        k = min(sequence.top_k, logits.shape[0])
+        candidates = np.argpartition(logits, -k)[-k:]
+        scaled = logits[candidates].astype(np.float64) / sequence.temperature
+        probs = np.exp(scaled - scaled.max())
+        order = np.argsort(-probs)
+        candidates, probs = candidates[order], probs[order] / probs.sum()
+        cutoff = int(np.searchsorted(np.cumsum(probs), sequence.top_p)) + 1
+        probs = probs[:cutoff] / probs[:cutoff].sum()
+        return int(self._rng.choice(candidates[:cutoff], p=probs))
+
+
+    def _accept(self, sequence: Sequence, token: int) -> None:
+        sequence.n_generated += 1
+        if llama_cpp.llama_token_is_eog(self.llm._model.vocab, token):
+            self._finish(sequence)
+            return
+
+        sequence.tokens.append(token)
+        text = sequence.decoder.decode(self.llm.detokenize([token]))
+        if text:
+            sequence.emit(sequence.request_id, "token", text)
+        if sequence.n_generated >= sequence.max_tokens:
+            self._finish(sequence)
+
+
+    def _release(self, sequence: Sequence) -> None:
+        if self._running.get(sequence.slot) is sequence:
+            del self._running[sequence.slot]
+        elif self._finished.get(sequence.slot) is sequence:
+            del self._finished[sequence.slot]
+        else:
+            return
+        self._ctx.kv_cache_seq_rm(sequence.slot, -1, -1)
+        if self.drafter is not None:
+            self.drafter.release(sequence.slot)
+
+
+    def _finish(self, sequence: Sequence) -> None:
+        with self._condition:
+            if self._running.get(sequence.slot) is sequence and self._keeps_session(sequence):
+                # the slot keeps the state of the sequence until it is saved, once the step is over
+                del self._running[sequence.slot]
+                self._finished[sequence.slot] = sequence
+            else:
+                self._release(sequence)
+        tail = sequence.decoder.decode(b"", final=True)
+        if tail:
+            sequence.emit(sequence.request_id, "token", tail)
+        sequence.emit(sequence.request_id, "done", None)
+        if sequence.on_finish is not None:
+            sequence.on_finish()
+
+
+    def _fail(self, sequence: Sequence, message: str) -> None:
+        with self._condition:
+            self._release(sequence)
+        sequence.emit(sequence.request_id, "error", message)
+        if sequence.on_finish is not None:
+            sequence.on_finish()
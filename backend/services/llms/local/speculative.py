@@ -0,0 +1,203 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+from core.config import LLAMA_SPECULATIVE_DRAFT_TOKENS, LLAMA_PROMPT_LOOKUP_NGRAM
+
+
+# slot -> (tokens of the sequence, the last one not evaluated yet, and the most draft tokens to propose)
+DraftRequests = Dict[int, Tuple[List[int], int]]
+
+
+class Drafter(ABC):
+    """
+    Proposes the tokens a sequence is likely to continue with. The BatchScheduler evaluates them together with the
+    last sampled token and keeps the ones the model itself samples, so drafts only change the speed, never the text.
+
+    Args:
+        draft_tokens (int): Most tokens proposed per sequence and step.
+    """
+
+    def __init__(self, draft_tokens: int = LLAMA_SPECULATIVE_DRAFT_TOKENS):
+        self.draft_tokens = draft_tokens
+
+
+    @abstractmethod
+    def propose(self, requests: DraftRequests) -> Dict[int, List[int]]:
+        """Propose the draft tokens of every requested slot, a slot may get none."""
+        ...
+
+
+    def release(self, slot: int) -> None:
+        """Forget the state kept for the sequence of a slot, which finished."""
+
+
+    def close(self) -> None:
+        ...
+
+
+class PromptLookupDrafter(Drafter):
+    """
+    Prompt-lookup decoding: the last n-gram of a sequence is looked up in its earlier tokens and the tokens that
+    followed its latest occurrence are proposed. It costs no model evaluation and pays off when the output quotes
+    its context, as answers over retrieved documents, summaries and code edits do.
+
+    Args:
+        draft_tokens (int): Most tokens proposed per sequence and step.
+        ngram_max (int): Longest n-gram looked up, shorter ones are tried when it is not found.
+        ngram_min (int): Shortest n-gram looked up.
+    """
+
+    def __init__(self, draft_tokens: int = LLAMA_SPECULATIVE_DRAFT_TOKENS, ngram_max: int = LLAMA_PROMPT_LOOKUP_NGRAM, ngram_min: int = 1):
+        super().__init__(draft_tokens)
+        self.ngram_max = ngram_max
+        self.ngram_min = ngram_min
+
+
+    def propose(self, requests: DraftRequests) -> Dict[int, List[int]]:
+        drafts = {}
+        for slot, (tokens, n_draft) in requests.items():
+            draft = self.lookup(tokens, n_draft)
+            if draft:
+                drafts[slot] = draft
+        return drafts
+
+
+    def lookup(self, tokens: List[int], n_draft: int) -> List[int]:
+        array = np.asarray(tokens)
+        for n in range(self.ngram_max, self.ngram_min - 1, -1):
+            if len(array) <= n:
+                continue
+            # windows that start before the trailing n-gram itself, so every match is followed by at least one token
+            windows = np.lib.stride_tricks.sliding_window_view(array[:-1], n)
+            matches = np.flatnonzero((windows == array[-n:]).all(axis=1))
+            if len(matches):
+                start = int(matches[-1]) + n
+                return tokens[start:start + n_draft]
+        return []
+
+
+class DraftModelDrafter(Drafter):
+    """
+    Speculative decoding with a small draft model that shares the vocabulary of the target model.
+
+    The draft model has a multi-sequence context with a slot per slot of the scheduler. Every step it catches up
+    with the tokens its slot has not seen (the prompt, then the tokens the target accepted) and greedily decodes
+    the drafts, one llama_decode per draft position across all the sequences.
+
+    Args:
+        draft (Llama): The loaded draft model.
+        n_ctx (int): The context window of a single sequence.
+        max_sequences (int): The sequence slots of the scheduler.
+        draft_tokens (int): Most tokens proposed per sequence and step.
+        max_batch_tokens (int): Tokens submitted to a single llama_decode of the draft model.
+        on_close (Optional[Callable[[], None]]): Called once the drafter no longer uses the draft model.
+    """
+
+    def __init__(
+        self,
+        draft: Llama,
+        n_ctx: int,
+        max_sequences: int,
+        draft_tokens: int = LLAMA_SPECULATIVE_DRAFT_TOKENS,
+        max_batch_tokens: int = 512,
+        on_close: Optional[Callable[[], None]] = None,
+    ):
+        super().__init__(draft_tokens)
+        self.max_batch_tokens = max(max_batch_tokens, max_sequences)
+        self._n_vocab = draft.n_vocab()
+        self._on_close = on_close
+        params = llama_cpp.llama_context_params.from_buffer_copy(draft.context_params)
+        params.n_ctx = n_ctx * max_sequences
+        params.n_seq_max = max_sequences
+        params.n_batch = self.max_batch_tokens
+        params.n_ubatch = min(params.n_ubatch, self.max_batch_tokens)
+        self._ctx = internals.LlamaContext(model=draft._model, params=params, verbose=draft.verbose)
+        self._batch = internals.LlamaBatch(n_tokens=self.max_batch_tokens, embd=0, n_seq_max=1, verbose=draft.verbose)
+        self._evaluated: Dict[int, List[int]] = {}  # slot -> tokens in the KV cache of the draft model
+
+
+    @property
+    def n_vocab(self) -> int:
+        return self._n_vocab
+
+
+    def propose(self, requests: DraftRequests) -> Dict[int, List[int]]:
+        pending: Dict[int, List[int]] = {}
+        for slot, (tokens, _) in requests.items():
+            evaluated = self._evaluated.get(slot, [])
+            n_common = 0
+            for cached, token in zip(evaluated, tokens[:-1]):
+                if cached != token:
+                    break
+                n_common += 1
+            # the rejected drafts of the previous step are dropped, the last token is always evaluated for its logits
+            self._ctx.kv_cache_seq_rm(slot, n_common, -1)
+            self._evaluated[slot] = tokens[:n_common]
+            pending[slot] = tokens[n_common:]
+
+        drafts: Dict[int, List[int]] = {slot: [] for slot in requests}
+        # catch up with the unseen tokens, chunked to the batch size; the logits of the last one give the first draft
+        while pending:
+            self._batch.reset()
+            budget, last = self.max_batch_tokens, {}
+            for slot in list(pending):
+                if budget <= 0:
+                    break
+                chunk, pending[slot] = pending[slot][:budget], pending[slot][budget:]
+                last_index = self._add(slot, chunk)
+                budget -= len(chunk)
+                if not pending[slot]:
+                    del pending[slot]
+                    last[slot] = last_index
+            self._ctx.decode(self._batch)
+            for slot, index in last.items():
+                drafts[slot].append(self._greedy(index))
+
+        # then one decode per further draft position, across the sequences that want more
+        while True:
+            growing = [slot for slot, draft in drafts.items() if len(draft) < requests[slot][1]]
+            if not growing:
+                break
+            self._batch.reset()
+            indices = {slot: self._add(slot, drafts[slot][-1:]) for slot in growing}
+            self._ctx.decode(self._batch)
+            for slot, index in indices.items():
+                drafts[slot].append(self._greedy(index))
+
+        return {slot: draft[:requests[slot][1]] for slot, draft in drafts.items() if requests[slot][1] > 0}
+
+
+    def release(self, slot: int) -> None:
+        self._ctx.kv_cache_seq_rm(slot, -1, -1)
+        self._evaluated.pop(slot, None)
+
+
+    def close(self) -> None:
+        self._batch.close()
+        self._ctx.close()
+        if self._on_close is not None:
+            self._on_close()
+
+
+    def _add(self, slot: int, tokens: List[int]) -> int:
+        """Add tokens of a slot to the batch, with logits for the last one, and return its batch index."""
+        batch = self._batch.batch
+        evaluated = self._evaluated.setdefault(slot, [])
+        for token in tokens:
+            i = batch.n_tokens
+            batch.token[i] = token
+            batch.pos[i] = len(evaluated)
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = slot
+            batch.logits[i] = False
+            batch.n_tokens += 1
+            evaluated.append(token)
+        batch.logits[batch.n_tokens - 1] = True
+        return batch.n_tokens - 1
+
+
+    def _greedy(self, index: int) -> int:
+        return int(np.argmax(np.ctypeslib.as_array(self._ctx.get_logits_ith(index), shape=(self._n_vocab,))))
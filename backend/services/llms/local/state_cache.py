@@ -0,0 +1,318 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from core.config import (
+    LLAMA_PREFIX_CACHE_MAX_BYTES, LLAMA_PREFIX_CACHE_DISK_BYTES, LLAMA_PREFIX_CACHE_DIR,
+    LLAMA_SESSION_CACHE_MAX_BYTES, LLAMA_SESSION_CACHE_DISK_BYTES, LLAMA_SESSION_CACHE_DIR, LLAMA_SESSION_CACHE_TTL,
+)
+
+
+@dataclass
+class StateSnapshot:
+    """The llama.cpp sequence state (KV cache) after evaluating tokens."""
+    tokens: Tuple[int, ...]
+    data: bytes
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.data)
+
+
+class LlamaStateCache:
+    """
+    Two-tier LRU cache of llama.cpp sequence states.
+
+    Snapshots live in a namespace (the loaded model they were taken from) under a key. They are kept in memory
+    up to max_bytes; the least recently used ones spill to files in disk_dir, which is itself bounded by
+    disk_max_bytes. A disk hit is promoted back to memory. The tokens of every snapshot stay indexed in memory,
+    so match can find the longest cached prefix of a prompt without touching the disk.
+
+    Args:
+        max_bytes (int): Memory budget of the snapshots.
+        disk_dir (Optional[str]): Directory of the disk tier, None keeps snapshots in memory only.
+        disk_max_bytes (int): Disk budget of the snapshots.
+        ttl (float): Seconds a snapshot stays valid after it was stored, 0 keeps snapshots until they are evicted.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0, ttl: float = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir if disk_dir and disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+        self._memory: "OrderedDict[Tuple[str, str], StateSnapshot]" = OrderedDict()
+        self._disk: "OrderedDict[Tuple[str, str], int]" = OrderedDict()  # (namespace, key) -> file size
+        self._tokens: Dict[Tuple[str, str], Tuple[int, ...]] = {}
+        self._stored_at: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+
+    @staticmethod
+    def prefix_key(tokens: Sequence[int]) -> str:
+        return hashlib.sha256(np.asarray(tokens, dtype=np.int32).tobytes()).hexdigest()
+
+
+    @staticmethod
+    def namespace_for(model_id: str) -> str:
+        return hashlib.sha256(model_id.encode("utf-8")).hexdigest()[:16]
+
+
+    def put(self, namespace: str, key: str, tokens: Sequence[int], data: bytes) -> None:
+        snapshot = StateSnapshot(tuple(tokens), data)
+        if snapshot.size_bytes > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(namespace, key)
+            self._purge_expired()
+            self._memory[(namespace, key)] = snapshot
+            self._tokens[(namespace, key)] = snapshot.tokens
+            self._stored_at[(namespace, key)] = time.time()
+            spilled = self._shrink_memory()
+        self._spill(spilled)
+
+
+    def get(self, namespace: str, key: str) -> Optional[StateSnapshot]:
+        with self._lock:
+            if self._is_expired(namespace, key):
+                self._discard(namespace, key)
+            snapshot = self._memory.get((namespace, key))
+            if snapshot is not None:
+                self._memory.move_to_end((namespace, key))
+                self.hits += 1
+                return snapshot
+            on_disk = (namespace, key) in self._disk
+        if not on_disk:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        snapshot = self._read(namespace, key)
+        with self._lock:
+            if snapshot is None:
+                self.misses += 1
+                self._discard(namespace, key)
+                return None
+            self.hits += 1
+            snapshot.tokens = self._tokens.setdefault((namespace, key), snapshot.tokens)
+            self._memory[(namespace, key)] = snapshot
+            spilled = self._shrink_memory()
+        self._spill(spilled)
+        return snapshot
+
+
+    def match(self, namespace: str, tokens: Sequence[int], max_tokens: Optional[int] = None) -> Optional[StateSnapshot]:
+        """
+        Get the snapshot of the longest cached prefix of tokens.
+        Args:
+            namespace (str): The namespace of the snapshots.
+            tokens (Sequence[int]): The tokens of a prompt.
+            max_tokens (Optional[int]): The longest prefix that may be matched.
+        Returns:
+            Optional[StateSnapshot]: The snapshot, or None if no cached snapshot is a prefix of tokens.
+        """
+        limit = len(tokens) if max_tokens is None else min(max_tokens, len(tokens))
+        tokens = tuple(tokens)
+        best, best_len = None, 0
+        with self._lock:
+            for (ns, key), cached in self._tokens.items():
+                if (
+                    ns == namespace and best_len < len(cached) <= limit and tokens[:len(cached)] == cached
+                    and not self._is_expired(ns, key)
+                ):
+                    best, best_len = key, len(cached)
+        if best is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return self.get(namespace, best)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": sum(snapshot.size_bytes for snapshot in self._memory.values()),
+                "disk_entries": len(self._disk),
+                "disk_bytes": sum(self._disk.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+    def _forget(self, namespace: str, key: str) -> None:
+        """Remove a snapshot from the index. Must be called with the lock held."""
+        self._tokens.pop((namespace, key), None)
+        self._stored_at.pop((namespace, key), None)
+
+
+    def _is_expired(self, namespace: str, key: str) -> bool:
+        stored_at = self._stored_at.get((namespace, key))
+        return self.ttl > 0 and stored_at is not None and time.time() - stored_at > self.ttl
+
+
+    def _purge_expired(self) -> None:
+        """Remove the expired snapshots from both tiers. Must be called with the lock held."""
+        if self.ttl <= 0:
+            return
+        for namespace, key in [entry for entry in self._stored_at if self._is_expired(*entry)]:
+            self._discard(namespace, key)
+
+
+    def _discard(self, namespace: str, key: str) -> None:
+        """Remove a snapshot from both tiers. Must be called with the lock held."""
+        self._memory.pop((namespace, key), None)
+        self._forget(namespace, key)
+        if (namespace, key) in self._disk:
+            self._drop_file(namespace, key)
+
+
+    def _shrink_memory(self) -> List[Tuple[str, str, StateSnapshot]]:
+        """Evict least recently used snapshots from memory and return them. Must be called with the lock held."""
+        used = sum(snapshot.size_bytes for snapshot in self._memory.values())
+        evicted = []
+        while used > self.max_bytes and self._memory:
+            (namespace, key), snapshot = self._memory.popitem(last=False)
+            used -= snapshot.size_bytes
+            if self.disk_dir is None:
+                self._forget(namespace, key)
+            else:
+                evicted.append((namespace, key, snapshot))
+        return evicted
+
+
+    def _shrink_disk(self) -> None:
+        """Delete least recently used snapshot files. Must be called with the lock held."""
+        while sum(self._disk.values()) > self.disk_max_bytes:
+            namespace, key = next(iter(self._disk))
+            self._drop_file(namespace, key)
+            if (namespace, key) not in self._memory:
+                self._forget(namespace, key)
+
+
+    def _spill(self, evicted: List[Tuple[str, str, StateSnapshot]]) -> None:
+        """Write snapshots evicted from memory to the disk tier."""
+        for namespace, key, snapshot in evicted:
+            with self._lock:
+                if (namespace, key) in self._disk:
+                    self._disk.move_to_end((namespace, key))
+                    continue
+            size = None
+            if snapshot.size_bytes <= self.disk_max_bytes:
+                try:
+                    size = self._write(namespace, key, snapshot)
+                except OSError as e:
+                    print(f"[AgentSmith LLM] Could not write llama state snapshot to disk: {e}")
+            with self._lock:
+                if size is None:
+                    if (namespace, key) not in self._memory:
+                        self._forget(namespace, key)
+                    continue
+                self._disk[(namespace, key)] = size
+                if self._tokens.get((namespace, key)) is not snapshot.tokens:
+                    self._drop_file(namespace, key)  # replaced or discarded while it was being written
+                    continue
+                self._shrink_disk()
+
+
+    def _path(self, namespace: str, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{namespace}-{key}.state")
+
+
+    def _write(self, namespace: str, key: str, snapshot: StateSnapshot) -> int:
+        """Write a snapshot as [token count, tokens..., state] and return the file size."""
+        path = self._path(namespace, key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.asarray([len(snapshot.tokens), *snapshot.tokens], dtype=np.int32).tobytes())
+            f.write(snapshot.data)
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+
+    def _read(self, namespace: str, key: str, tokens_only: bool = False) -> Optional[StateSnapshot]:
+        try:
+            with open(self._path(namespace, key), "rb") as f:
+                n_tokens = int(np.frombuffer(f.read(4), dtype=np.int32)[0])
+                tokens = tuple(int(token) for token in np.frombuffer(f.read(4 * n_tokens), dtype=np.int32))
+                data = b"" if tokens_only else f.read()
+        except (OSError, ValueError, IndexError):
+            return None
+        return StateSnapshot(tokens, data)
+
+
+    def _drop_file(self, namespace: str, key: str) -> None:
+        """Remove a snapshot from the disk tier. Must be called with the lock held."""
+        self._disk.pop((namespace, key), None)
+        try:
+            os.remove(self._path(namespace, key))
+        except OSError:
+            pass
+
+
+    def _scan_disk(self) -> None:
+        """Index the snapshots left on disk by a previous run, oldest first."""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            if not name.endswith(".state") or "-" not in name:
+                continue
+            namespace, key = name[:-len(".state")].split("-", 1)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, namespace, key, stat.st_size))
+
+        for mtime, namespace, key, size in sorted(entries):
+            snapshot = self._read(namespace, key, tokens_only=True)
+            if snapshot is None:
+                self._drop_file(namespace, key)
+                continue
+            self._disk[(namespace, key)] = size
+            self._tokens[(namespace, key)] = snapshot.tokens
+            self._stored_at[(namespace, key)] = mtime
+        self._purge_expired()
+        self._shrink_disk()
+
+
+_caches: Dict[str, LlamaStateCache] = {}
+_caches_lock = threading.Lock()
+
+
+def _process_cache(name: str, max_bytes: int, disk_dir: str, disk_max_bytes: int, ttl: float = 0) -> Optional[LlamaStateCache]:
+    if max_bytes <= 0:
+        return None
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = LlamaStateCache(max_bytes, disk_dir, disk_max_bytes, ttl)
+        return _caches[name]
+
+
+def get_prefix_cache(partition: str = "main") -> Optional[LlamaStateCache]:
+    """
+    Get the prompt prefix cache of the process, or None when it is disabled.
+    Every inference process keeps its disk tier in its own partition directory.
+    """
+    return _process_cache(
+        "prefix", LLAMA_PREFIX_CACHE_MAX_BYTES, os.path.join(LLAMA_PREFIX_CACHE_DIR, partition), LLAMA_PREFIX_CACHE_DISK_BYTES
+    )
+
+
+def get_session_cache(partition: str = "main") -> Optional[LlamaStateCache]:
+    """Get the conversation snapshot cache of the process, or None when it is disabled."""
+    return _process_cache(
+        "session",
+        LLAMA_SESSION_CACHE_MAX_BYTES,
+        os.path.join(LLAMA_SESSION_CACHE_DIR, partition),
+        LLAMA_SESSION_CACHE_DISK_BYTES,
+        ttl=LLAMA_SESSION_CACHE_TTL,
+    )
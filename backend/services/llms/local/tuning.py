@@ -0,0 +1,168 @@
+import os
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from core.config import LLAMA_BATCH_MAX_SEQUENCES, LLAMA_TUNE_PROMPT_TOKENS, LLAMA_TUNE_DECODE_TOKENS, LLAMA_TUNE_MAX_N_CTX, LLAMA_TUNE_MIN_DECODE_RATIO
+
+# llama_cpp is only imported by the benchmark itself, which runs on the inference workers
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+
+
+# Text the benchmark prompts are made of, only its token count matters
+FILLER = (
+    "The committee reviewed the quarterly figures, compared them with the forecast and asked the regional teams "
+    "to explain every deviation larger than five percent before the next meeting. "
+)
+
+BATCH_CANDIDATES = [64, 128, 256, 512, 1024]
+CONTEXT_CANDIDATES = [1024, 2048, 4096, 8192, 16384, 32768]
+
+
+def thread_candidates(cpu_count: Optional[int] = None) -> List[int]:
+    """Thread counts worth trying on a host: the powers of two below its CPU count, half of it and all of it."""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    candidates = {cpu_count, max(1, cpu_count // 2)}
+    n = 1
+    while n < cpu_count:
+        candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+def _tokens(llm: "Llama", n_tokens: int) -> List[int]:
+    filler = llm.tokenize(FILLER.encode("utf-8"), add_bos=False)
+    return [llm.token_bos()] + (filler * (n_tokens // len(filler) + 1))[:n_tokens - 1]
+
+
+def _measure(llm: "Llama", n_prompt: int, n_decode: int) -> Tuple[float, float]:
+    """Prefill n_prompt tokens then decode n_decode tokens one at a time. Returns (prefill tokens/s, decode tokens/s)."""
+    tokens = _tokens(llm, n_prompt + n_decode)
+    llm.reset()
+    start = time.perf_counter()
+    llm.eval(tokens[:n_prompt])
+    prefill = n_prompt / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for token in tokens[n_prompt:]:
+        llm.eval([token])
+    decode = n_decode / (time.perf_counter() - start) if n_decode else 0.0
+    return prefill, decode
+
+
+def _check(is_cancelled: Optional[Callable[[], bool]]) -> None:
+    if is_cancelled is not None and is_cancelled():
+        raise RuntimeError("The benchmark was cancelled")
+
+
+def _load(model_path: str, verbose: bool, **params) -> "Llama":
+    from llama_cpp import Llama
+    llm = Llama(model_path=model_path, verbose=verbose, **params)
+    _measure(llm, 32, 4)  # warm up: page the weights in and let the threads spin up
+    return llm
+
+
+def tune_model(
+    model_path: str,
+    n_threads: Optional[List[int]] = None,
+    n_batch: Optional[List[int]] = None,
+    n_ctx: Optional[List[int]] = None,
+    prompt_tokens: int = LLAMA_TUNE_PROMPT_TOKENS,
+    decode_tokens: int = LLAMA_TUNE_DECODE_TOKENS,
+    min_decode_ratio: float = LLAMA_TUNE_MIN_DECODE_RATIO,
+    max_sequences: int = LLAMA_BATCH_MAX_SEQUENCES,
+    verbose: bool = False,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+) -> dict:
+    """
+    Measure the prefill and decode speed of a GGUF model on this host and pick its load parameters.
+
+    The stages run one after the other, each with the best settings of the previous ones:
+        threads: every thread count, n_threads is the fastest to decode and n_threads_batch the fastest to prefill
+        batch: every batch size up to the prompt, n_batch (and n_ubatch) is the fastest to prefill, the batch
+            scheduler then submits up to n_batch tokens to a llama_decode call
+        context: growing context windows, decoding with the context 3/4 full, n_ctx is the largest that keeps
+            min_decode_ratio of the decode speed of the smallest one, or the largest that could be allocated.
+            n_ctx is the window of a sequence, so every window is allocated the way the batch scheduler does,
+            for max_sequences sequences at once
+    The model is loaded apart from the resident model cache, its weights are shared with a loaded copy through mmap.
+    The measurements compete with any other inference of the host, the benchmark is meant to run while it is idle.
+    Args:
+        model_path (str): The path of the GGUF file.
+        n_threads (Optional[List[int]]): Thread counts to try, defaults to thread_candidates().
+        n_batch (Optional[List[int]]): Batch sizes to try, defaults to BATCH_CANDIDATES.
+        n_ctx (Optional[List[int]]): Context windows to try, defaults to CONTEXT_CANDIDATES up to LLAMA_TUNE_MAX_N_CTX.
+        prompt_tokens (int): Tokens prefilled by the threads and batch runs.
+        decode_tokens (int): Tokens decoded by every run.
+        min_decode_ratio (float): Share of the decode speed a larger context window must keep.
+        max_sequences (int): Sequences the batch scheduler decodes together, each with a context window of n_ctx.
+        verbose (bool): Let llama.cpp log the loads.
+        is_cancelled (Optional[Callable[[], bool]]): Checked before every run, the benchmark stops once it returns True.
+    Returns:
+        dict: {"load_params": {...}, "runs": [{"stage": ..., "n_threads": ..., "prefill_tps": ..., ...}], "cpu_count": ..., "seconds": ...}
+    Raises:
+        RuntimeError: If the benchmark was cancelled.
+    """
+    import llama_cpp
+    started = time.perf_counter()
+    runs = []
+    n_threads = sorted(set(n_threads or thread_candidates()))
+    base_ctx = max(CONTEXT_CANDIDATES[0], prompt_tokens + decode_tokens)
+
+    llm = _load(model_path, verbose, n_ctx=base_ctx, n_threads=n_threads[-1], n_threads_batch=n_threads[-1])
+    try:
+        n_ctx_train = llm._model.n_ctx_train()
+        speeds: Dict[int, Tuple[float, float]] = {}
+        for threads in n_threads:
+            _check(is_cancelled)
+            llama_cpp.llama_set_n_threads(llm.ctx, threads, threads)
+            speeds[threads] = _measure(llm, prompt_tokens, decode_tokens)
+            runs.append({"stage": "threads", "n_threads": threads, "prefill_tps": speeds[threads][0], "decode_tps": speeds[threads][1]})
+    finally:
+        llm.close()
+    best = {
+        "n_threads": max(speeds, key=lambda threads: speeds[threads][1]),
+        "n_threads_batch": max(speeds, key=lambda threads: speeds[threads][0]),
+    }
+
+    batch_speeds: Dict[int, float] = {}
+    for batch in sorted(set(b for b in (n_batch or BATCH_CANDIDATES) if b <= prompt_tokens)):
+        _check(is_cancelled)
+        llm = _load(model_path, verbose, n_ctx=base_ctx, n_batch=batch, n_ubatch=batch, **best)
+        try:
+            batch_speeds[batch] = _measure(llm, prompt_tokens, 0)[0]
+        finally:
+            llm.close()
+        runs.append({"stage": "batch", "n_batch": batch, "prefill_tps": batch_speeds[batch]})
+    if batch_speeds:
+        batch = max(batch_speeds, key=batch_speeds.get)
+        best.update(n_batch=batch, n_ubatch=batch)
+
+    limit = n_ctx_train or float("inf")
+    if n_ctx is None:
+        limit = min(limit, LLAMA_TUNE_MAX_N_CTX)
+    contexts = sorted(set(c for c in (n_ctx or CONTEXT_CANDIDATES) if c <= limit))
+    best["n_ctx"] = contexts[0] if contexts else base_ctx
+    reference = None
+    for context in contexts:
+        _check(is_cancelled)
+        try:
+            llm = _load(model_path, verbose, **{**best, "n_ctx": context * max_sequences})
+        except (ValueError, RuntimeError) as e:
+            # the KV cache of this context window does not fit, larger ones will not either
+            print(f"[AgentSmith LLM] Could not load {os.path.basename(model_path)} with a context of {context} tokens: {e}")
+            break
+        try:
+            decode = _measure(llm, context * 3 // 4 - decode_tokens, decode_tokens)[1]
+        finally:
+            llm.close()
+        runs.append({"stage": "context", "n_ctx": context, "decode_tps": decode})
+        reference = reference or decode
+        if decode < reference * min_decode_ratio:
+            break
+        best["n_ctx"] = context
+
+    return {
+        "load_params": best,
+        "runs": [{key: round(value, 1) if isinstance(value, float) else value for key, value in run.items()} for run in runs],
+        "cpu_count": os.cpu_count(),
+        "seconds": round(time.perf_counter() - started, 1),
+    }
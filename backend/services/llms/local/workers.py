@@ -0,0 +1,333 @@
+import asyncio
+import atexit
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from multiprocessing.connection import Connection, wait
+from typing import AsyncGenerator, Callable, Dict, List, Optional
+from core.config import LLAMA_INFERENCE_WORKERS, LLAMA_WORKER_THREADS, LLAMA_REQUEST_TIMEOUT
+from services.llms.local.engine import LocalInferenceEngine
+
+
+# sink(kind, payload) receives the events of a single request
+Sink = Callable[[str, object], None]
+
+
+class BaseInferenceBackend(ABC):
+    """Runs local inference requests (see LocalInferenceEngine) and streams their events back to the caller."""
+
+    @abstractmethod
+    def submit(self, request: dict, sink: Sink) -> str:
+        """Submit a request and return its id. The sink is called from a background thread."""
+        ...
+
+
+    @abstractmethod
+    def cancel(self, request_id: str) -> None:
+        """Stop a running generation at its next token."""
+        ...
+
+
+    def call(self, request: dict, timeout: float = LLAMA_REQUEST_TIMEOUT) -> object:
+        """
+        Run a request to completion and return the payload of its "done" event.
+        Raises:
+            TimeoutError: If no event arrives for timeout seconds, the request is cancelled.
+        """
+        events = queue.Queue()
+        request_id = self.submit(request, lambda kind, payload: events.put((kind, payload)))
+        while True:
+            kind, payload = self._next_event(events, request_id, timeout)
+            if kind == "done":
+                return payload
+            if kind == "error":
+                raise RuntimeError(payload)
+
+
+    def complete(self, request: dict, timeout: float = LLAMA_REQUEST_TIMEOUT) -> str:
+        """
+        Run a generate request to completion and return the generated text.
+        Raises:
+            TimeoutError: If no token arrives for timeout seconds, the generation is cancelled.
+        """
+        tokens = []
+        events = queue.Queue()
+        request_id = self.submit(request, lambda kind, payload: events.put((kind, payload)))
+        while True:
+            kind, payload = self._next_event(events, request_id, timeout)
+            if kind == "token":
+                tokens.append(payload)
+            elif kind == "done":
+                return "".join(tokens)
+            else:
+                raise RuntimeError(payload)
+
+
+    def _next_event(self, events: queue.Queue, request_id: str, timeout: float) -> tuple:
+        try:
+            return events.get(timeout=timeout if timeout > 0 else None)
+        except queue.Empty:
+            self.cancel(request_id)
+            raise TimeoutError(f"Local inference request {request_id} sent no event for {timeout} seconds")
+
+
+    async def stream(self, request: dict) -> AsyncGenerator[str, None]:
+        """Stream the tokens of a generate request. Closing the generator cancels the generation."""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        request_id = self.submit(request, lambda kind, payload: loop.call_soon_threadsafe(events.put_nowait, (kind, payload)))
+        finished = False
+        try:
+            while True:
+                kind, payload = await events.get()
+                if kind == "token":
+                    yield payload
+                elif kind == "done":
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise RuntimeError(payload)
+        finally:
+            if not finished:
+                self.cancel(request_id)
+
+
+class InProcessInferenceBackend(BaseInferenceBackend):
+    """Runs local inference on threads of the API process."""
+
+    def __init__(self, max_threads: int = LLAMA_WORKER_THREADS):
+        from services.llms.local.model_cache import model_cache
+        self.engine = LocalInferenceEngine(model_cache, max_threads=max_threads)
+
+
+    def submit(self, request: dict, sink: Sink) -> str:
+        request_id = uuid.uuid4().hex
+        self.engine.submit({**request, "id": request_id}, lambda _, kind, payload: sink(kind, payload))
+        return request_id
+
+
+    def cancel(self, request_id: str) -> None:
+        self.engine.cancel(request_id)
+
+
+def _worker_main(conn: Connection, max_threads: int, index: int) -> None:
+    """Entry point of an inference worker process."""
+    from services.llms.local.model_cache import model_cache
+
+    send_lock = threading.Lock()
+
+    def emit(request_id: str, kind: str, payload: object) -> None:
+        with send_lock:
+            conn.send((request_id, kind, payload))
+
+    engine = LocalInferenceEngine(model_cache, max_threads=max_threads, partition=f"worker-{index}")
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return  # the API process went away
+        if request["op"] == "cancel":
+            engine.cancel(request["id"])
+        else:
+            engine.submit(request, emit)
+
+
+class _Worker:
+    def __init__(self, index: int, max_threads: int):
+        self.index = index
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, max_threads, index),
+            name=f"llama-inference-worker-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.send_lock = threading.Lock()
+
+
+    def send(self, message: dict) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class InferenceWorkerPool(BaseInferenceBackend):
+    """
+    Pool of worker processes that own the loaded llama.cpp models.
+
+    Requests are routed to a worker by (path, model), so every model is loaded by a single worker, and travel
+    over a pipe per worker. A background thread dispatches the events coming back from the workers and watches
+    their processes: if a worker crashes (e.g. killed by the OOM killer), its in-flight requests fail with an
+    error and a fresh worker takes its place, while the API process keeps serving. Should the dispatcher itself
+    fail, every pending request, and every later one, fails with an error instead of waiting forever.
+    """
+
+    def __init__(self, n_workers: int = LLAMA_INFERENCE_WORKERS, max_threads: int = LLAMA_WORKER_THREADS):
+        self.max_threads = max_threads
+        self._workers: List[_Worker] = [_Worker(index, max_threads) for index in range(n_workers)]
+        self._sinks: Dict[str, Sink] = {}
+        self._owners: Dict[str, int] = {}  # request id -> worker index
+        self._lock = threading.Lock()
+        self._closed = False
+        self._failure: Optional[str] = None  # why the dispatcher stopped, if it failed
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="llama-inference-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+
+    def submit(self, request: dict, sink: Sink) -> str:
+        request_id = uuid.uuid4().hex
+        worker = self._worker_for(request)
+        with self._lock:
+            self._sinks[request_id] = sink
+            self._owners[request_id] = worker.index
+        if self._failure is not None:
+            self._finish(request_id, "error", self._failure)
+            return request_id
+        try:
+            worker.send({**request, "id": request_id})
+        except (BrokenPipeError, OSError) as e:
+            self._finish(request_id, "error", f"Local inference worker unavailable: {e}")
+        return request_id
+
+
+    def cancel(self, request_id: str) -> None:
+        with self._lock:
+            index = self._owners.get(request_id)
+        if index is None:
+            return
+        try:
+            self._workers[index].send({"op": "cancel", "id": request_id})
+        except (BrokenPipeError, OSError):
+            pass
+
+
+    def call(self, request: dict, timeout: float = LLAMA_REQUEST_TIMEOUT) -> object:
+        """Run an admin request. Requests without a model (e.g. list or unload all) go to every worker."""
+        if request.get("model") is not None:
+            return super().call(request, timeout)
+        results = []
+        for worker in list(self._workers):
+            results.extend(super().call({**request, "worker": worker.index}, timeout))
+        return results
+
+
+    def close(self) -> None:
+        self._closed = True
+        for worker in self._workers:
+            worker.conn.close()
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()
+
+
+    def _worker_for(self, request: dict) -> _Worker:
+        if request.get("worker") is not None:
+            return self._workers[request["worker"]]
+        key = f"{request['path']}/{request.get('model')}".encode()
+        return self._workers[zlib.crc32(key) % len(self._workers)]
+
+
+    def _finish(self, request_id: str, kind: str, payload: object) -> None:
+        with self._lock:
+            sink = self._sinks.pop(request_id, None)
+            self._owners.pop(request_id, None)
+        if sink is not None:
+            self._deliver(request_id, sink, kind, payload)
+
+
+    @staticmethod
+    def _deliver(request_id: str, sink: Sink, kind: str, payload: object) -> None:
+        """Call a sink, a failing one (e.g. whose event loop is closed) only loses its own request."""
+        try:
+            sink(kind, payload)
+        except Exception as e:
+            print(f"[AgentSmith LLM] Could not deliver the {kind} event of local inference request {request_id}: {e}")
+
+
+    def _fail_pending(self, message: str) -> None:
+        with self._lock:
+            pending = list(self._sinks)
+        for request_id in pending:
+            self._finish(request_id, "error", message)
+
+
+    def _dispatch_loop(self) -> None:
+        try:
+            while not self._closed:
+                self._dispatch()
+        except Exception as e:
+            print(f"[AgentSmith LLM] Inference dispatcher failed: {e}")
+            self._failure = f"Local inference dispatcher failed: {e}"
+        finally:
+            self._fail_pending(self._failure or "Local inference backend closed")
+
+
+    def _dispatch(self) -> None:
+        """Wait for the events and exits of the workers once, and deliver them."""
+        workers = {worker.conn: worker for worker in self._workers}
+        sentinels = {worker.process.sentinel: worker for worker in self._workers}
+        try:
+            ready = wait(list(workers) + list(sentinels), timeout=1.0)
+        except (OSError, ValueError) as e:
+            # a pipe closed under the wait, e.g. by a restart, the wait set is rebuilt from the current workers
+            if not self._closed:
+                print(f"[AgentSmith LLM] Waiting on the inference workers failed: {e}")
+                for worker in list(self._workers):
+                    if worker.conn.closed or not worker.process.is_alive():
+                        self._restart(worker)
+                time.sleep(0.1)
+            return
+
+        # drain the pipes before handling dead workers, so their last events are still delivered
+        for conn in [obj for obj in ready if obj in workers]:
+            try:
+                request_id, kind, payload = conn.recv()
+            except (EOFError, OSError):
+                continue
+            if kind == "token":
+                with self._lock:
+                    sink = self._sinks.get(request_id)
+                if sink is not None:
+                    self._deliver(request_id, sink, kind, payload)
+            else:
+                self._finish(request_id, kind, payload)
+
+        for sentinel in [obj for obj in ready if obj in sentinels]:
+            if not self._closed:
+                self._restart(sentinels[sentinel])
+
+
+    def _restart(self, worker: _Worker) -> None:
+        worker.process.join(timeout=1)
+        exitcode = worker.process.exitcode
+        print(f"[AgentSmith LLM] Inference worker {worker.index} exited with code {exitcode}, restarting")
+        worker.conn.close()
+        with self._lock:
+            orphaned = [request_id for request_id, index in self._owners.items() if index == worker.index]
+        for request_id in orphaned:
+            self._finish(request_id, "error", f"Local inference worker crashed (exit code {exitcode})")
+        self._workers[worker.index] = _Worker(worker.index, self.max_threads)
+
+
+_backend: Optional[BaseInferenceBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_inference_backend() -> BaseInferenceBackend:
+    """Get the process-wide local inference backend, starting the worker processes on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if LLAMA_INFERENCE_WORKERS > 0:
+                _backend = InferenceWorkerPool()
+                atexit.register(_backend.close)
+            else:
+                _backend = InProcessInferenceBackend()
+        return _backend
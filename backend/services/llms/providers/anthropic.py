@@ -1,17 +1,30 @@
-from services.llms.base import BaseAPILLM
+from services.llms.base import BaseAPILLM, LLMProviderError, record_usage
 from anthropic import AuthenticationError as AnthropicAuthError
-from anthropic import Anthropic, APIError
+from anthropic import Anthropic, AsyncAnthropic, APIError
 from anthropic.types import Message
-from typing import Optional, AsyncGenerator
+from typing import Dict, List, Optional, AsyncGenerator
+from core.config import PROMPT_CACHE_ENABLED
+
+
+CACHE_CONTROL = {"type": "ephemeral"}
 
 
 class AnthropicAPILLM(BaseAPILLM):
-    """Anthropic API LLM."""
-    def __init__(self, api_key: Optional[str] = None):
-        super().__init__("anthropic", api_key)
+    """
+    Anthropic API LLM.
+    The chat messages are sent as native turns, with prompt cache breakpoints on the system prompt and on the last
+    message: the next turn of the chat reads everything up to its new messages from the prompt cache.
+
+    Args:
+        prompt_cache (bool): Mark the prompts as cacheable, defaults to PROMPT_CACHE_ENABLED.
+    """
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, prompt_cache: bool = PROMPT_CACHE_ENABLED):
+        super().__init__("anthropic", api_key, base_url)
+        self.prompt_cache = prompt_cache
         self.template = self.env.get_template("llms/api/anthropic.jinja")
         if api_key is not None:
-            self.client = Anthropic(api_key=self.api_key)
+            self.client = Anthropic(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+            self.async_client = AsyncAnthropic(api_key=self.api_key, base_url=self.base_url, max_retries=0)
 
 
     def get_completion(
@@ -21,16 +34,20 @@ class AnthropicAPILLM(BaseAPILLM):
         model: str = "claude-3-5-sonnet-20240620",
         temperature: float = 0.7,
         max_tokens: int = 8000,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,
     ) -> str:
         """
         Get a non-streaming completion from the Anthropic model.
 
         Args:
             system_prompt (str): The system-level prompt (instructions for the model).
-            user_prompt (str): The user message prompt.
+            user_prompt (str): The user message prompt, when there are no messages.
             model (str): The model name.
             temperature (float): Sampling temperature.
             max_tokens (int): Maximum tokens to generate.
+            messages (Optional[List[Dict[str, str]]]): The chat messages, oldest first.
+            usage (Optional[dict]): Filled with the token usage of the request.
 
         Returns:
             str: The generated text from the model.
@@ -38,14 +55,52 @@ class AnthropicAPILLM(BaseAPILLM):
         try:
             response: Message = self.client.messages.create(
                 model=model,
-                system=system_prompt,
-                messages=[{"role": "user", "content": user_prompt}],
+                **self._prompt(system_prompt, user_prompt, messages),
+                max_tokens=max_tokens,
+                temperature=temperature,
+            )
+            self._record_usage(usage, response.usage)
+            return response.content[0].text
+        except APIError as e:
+            raise LLMProviderError.from_api_error("Anthropic API error", e)
+
+
+    async def aget_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: str = "claude-3-5-sonnet-20240620",
+        temperature: float = 0.7,
+        max_tokens: int = 8000,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,
+    ) -> str:
+        """
+        Get a non-streaming completion from the Anthropic model using the async client.
+
+        Args:
+            system_prompt (str): The system-level prompt (instructions for the model).
+            user_prompt (str): The user message prompt, when there are no messages.
+            model (str): The model name.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Maximum tokens to generate.
+            messages (Optional[List[Dict[str, str]]]): The chat messages, oldest first.
+            usage (Optional[dict]): Filled with the token usage of the request.
+
+        Returns:
+            str: The generated text from the model.
+        """
+        try:
+            response: Message = await self.async_client.messages.create(
+                model=model,
+                **self._prompt(system_prompt, user_prompt, messages),
                 max_tokens=max_tokens,
                 temperature=temperature,
             )
+            self._record_usage(usage, response.usage)
             return response.content[0].text
         except APIError as e:
-            raise RuntimeError(f"Anthropic API error: {e}")
+            raise LLMProviderError.from_api_error("Anthropic API error", e)
 
 
     async def stream_completion(
@@ -55,35 +110,67 @@ class AnthropicAPILLM(BaseAPILLM):
         model: str = "claude-3-5-sonnet-20240620",
         temperature: float = 0.7,
         max_tokens: int = 8000,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,
     ) -> AsyncGenerator[str, None]:
         """
         Stream completion from the Anthropic model, yielding tokens as they arrive.
 
         Args:
             system_prompt (str): The system-level prompt.
-            user_prompt (str): The user message prompt.
+            user_prompt (str): The user message prompt, when there are no messages.
             model (str): The model name.
             temperature (float): Sampling temperature.
             max_tokens (int): Maximum tokens to generate.
+            messages (Optional[List[Dict[str, str]]]): The chat messages, oldest first.
+            usage (Optional[dict]): Filled with the token usage of the request once the stream ends.
 
         Yields:
             str: Partial response tokens as they arrive.
         """
         try:
-            
-            with self.client.messages.stream(
+            async with self.async_client.messages.stream(
                 model=model,
-                system=system_prompt,
-                messages=[{"role": "user", "content": user_prompt}],
+                **self._prompt(system_prompt, user_prompt, messages),
                 max_tokens=max_tokens,
                 temperature=temperature,
             ) as stream:
-                for event in stream:
-                    if event.type == "content_block_delta":
+                async for event in stream:
+                    if event.type == "content_block_delta" and event.delta.type == "text_delta":
                         yield event.delta.text
+                    elif event.type == "message_stop":
+                        self._record_usage(usage, event.message.usage)
 
         except APIError as e:
-            raise RuntimeError(f"Anthropic streaming API error: {e}")
+            raise LLMProviderError.from_api_error("Anthropic streaming API error", e)
+
+
+    def _prompt(self, system_prompt: str, user_prompt: str, messages: Optional[List[Dict[str, str]]]) -> dict:
+        """
+        The system and messages of a request. The messages API wants the chat to start with a user message, a window
+        of a longer chat that starts with a reply starts at its next user message.
+        With the prompt cache, the system prompt and the last message are cache breakpoints: the system prompt is
+        shared by the requests of an agent or chatbot, and the prompt up to the last message is the prefix of the
+        next turn of the chat.
+        """
+        chat = self.chat_messages(system_prompt, user_prompt, messages)[1:]
+        while len(chat) > 1 and chat[0]["role"] != "user":
+            chat = chat[1:]
+        if not self.prompt_cache:
+            return {"system": system_prompt, "messages": chat}
+        *history, last = chat
+        request = {"messages": [*history, {"role": last["role"], "content": [{"type": "text", "text": last["content"], "cache_control": CACHE_CONTROL}]}]}
+        if system_prompt:
+            request["system"] = [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+        return request
+
+
+    @staticmethod
+    def _record_usage(usage: Optional[dict], response_usage) -> None:
+        # input_tokens leaves out the prompt tokens read from or written to the prompt cache
+        cached = response_usage.cache_read_input_tokens or 0
+        created = response_usage.cache_creation_input_tokens or 0
+        record_usage(usage, response_usage.input_tokens + cached + created, response_usage.output_tokens, cached, created)
 
 
     @staticmethod
@@ -1,16 +1,19 @@
-from services.llms.base import BaseAPILLM
-from huggingface_hub import InferenceClient
-from typing import Optional, AsyncGenerator
+from services.llms.base import BaseAPILLM, LLMProviderError, record_usage
+from huggingface_hub import InferenceClient, AsyncInferenceClient
+from huggingface_hub.errors import HfHubHTTPError, InferenceTimeoutError
+from typing import Dict, List, Optional, AsyncGenerator
+from contextlib import aclosing
 import requests
 
 
 class HuggingFaceAPILLM(BaseAPILLM):
     """Hugging Face API LLM."""
-    def __init__(self, api_key: Optional[str] = None):
-        super().__init__(name="huggingface", api_key=api_key)
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        super().__init__(name="huggingface", api_key=api_key, base_url=base_url)
         self.template = self.env.get_template("llms/api/hugging_face.jinja")
         if api_key is not None:
-            self.client = InferenceClient(api_key=self.api_key)
+            self.client = InferenceClient(api_key=self.api_key, base_url=self.base_url)
+            self.async_client = AsyncInferenceClient(api_key=self.api_key, base_url=self.base_url)
 
 
     def get_completion(
@@ -19,23 +22,57 @@ class HuggingFaceAPILLM(BaseAPILLM):
         user_prompt: str,
         model: str = "mistralai/Mistral-7B-Instruct-v0.3",
         temperature: float = 0.7,
-        max_tokens: int = 2048,) -> str:
+        max_tokens: int = 2048,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,) -> str:
         """
         Get a non-streaming completion from Hugging Face Inference API.
+        The chat messages, if any, are sent as native turns after the system prompt.
         """
 
-        response = self.client.chat_completion(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=1.0,
-            stream=False,
-        )
+        try:
+            response = self.client.chat_completion(
+                messages=self.chat_messages(system_prompt, user_prompt, messages),
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=1.0,
+                stream=False,
+            )
+        except (HfHubHTTPError, InferenceTimeoutError) as e:
+            raise LLMProviderError.from_api_error("Hugging Face API error", e)
+
+        self._record_usage(usage, response.usage)
+        return response.choices[0].message.content
+
+
+    async def aget_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: str = "mistralai/Mistral-7B-Instruct-v0.3",
+        temperature: float = 0.7,
+        max_tokens: int = 2048,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,) -> str:
+        """
+        Get a non-streaming completion from Hugging Face Inference API using the async client.
+        The chat messages, if any, are sent as native turns after the system prompt.
+        """
 
+        try:
+            response = await self.async_client.chat_completion(
+                messages=self.chat_messages(system_prompt, user_prompt, messages),
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=1.0,
+                stream=False,
+            )
+        except (HfHubHTTPError, InferenceTimeoutError) as e:
+            raise LLMProviderError.from_api_error("Hugging Face API error", e)
+
+        self._record_usage(usage, response.usage)
         return response.choices[0].message.content
 
 
@@ -46,28 +83,76 @@ class HuggingFaceAPILLM(BaseAPILLM):
         model: str = "mistralai/Mistral-7B-Instruct-v0.3",
         temperature: float = 0.7,
         max_tokens: int = 2048,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,
     ) -> AsyncGenerator[str, None]:
         """
         Stream chat completions from Hugging Face API as an async generator.
+        The usage dict, if any, is filled once the stream ends.
         """
-        stream = self.client.chat_completion(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=1.0,
-            stream=True,
-        )
+        try:
+            stream = await self.async_client.chat_completion(
+                messages=self.chat_messages(system_prompt, user_prompt, messages),
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=1.0,
+                stream=True,
+                stream_options={"include_usage": True} if usage is not None else None,
+            )
+
+            async with aclosing(stream):
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta:
+                        delta = chunk.choices[0].delta
+                        if delta.content:
+                            yield delta.content
+                    if getattr(chunk, "usage", None) is not None:
+                        self._record_usage(usage, chunk.usage)
+        except (HfHubHTTPError, InferenceTimeoutError) as e:
+            raise LLMProviderError.from_api_error("Hugging Face streaming API error", e)
+
+
+    @staticmethod
+    def _record_usage(usage: Optional[dict], response_usage) -> None:
+        # the inference providers cache prompt prefixes on their own, if at all, and do not report cached tokens
+        if response_usage is not None:
+            record_usage(usage, response_usage.prompt_tokens, response_usage.completion_tokens)
+
+
+    # texts per feature-extraction request, the serverless inference endpoints time out on larger ones
+    max_embedding_batch = 32
+
+    def embed(self, texts: List[str], model: str = "sentence-transformers/all-MiniLM-L6-v2") -> List[List[float]]:
+        """
+        Embed texts with the feature-extraction task of the Hugging Face Inference API.
+        """
+        try:
+            vectors = self.client.feature_extraction(texts, model=model)
+        except (HfHubHTTPError, InferenceTimeoutError) as e:
+            raise LLMProviderError.from_api_error("Hugging Face embeddings API error", e)
+        return self._pooled(vectors)
+
+
+    async def aembed(self, texts: List[str], model: str = "sentence-transformers/all-MiniLM-L6-v2") -> List[List[float]]:
+        """
+        Embed texts with the feature-extraction task of the Hugging Face Inference API using the async client.
+        """
+        try:
+            vectors = await self.async_client.feature_extraction(texts, model=model)
+        except (HfHubHTTPError, InferenceTimeoutError) as e:
+            raise LLMProviderError.from_api_error("Hugging Face embeddings API error", e)
+        return self._pooled(vectors)
+
+
+    @staticmethod
+    def _pooled(vectors) -> List[List[float]]:
+        # models without a pooling layer return one vector per token, they are mean-pooled into one per text
+        if vectors.ndim == 3:
+            vectors = vectors.mean(axis=1)
+        return vectors.tolist()
+
 
-        for chunk in stream:
-            if chunk.choices and chunk.choices[0].delta:
-                delta = chunk.choices[0].delta
-                if delta.content:
-                    yield delta.content
-    
     @staticmethod
     def validate_key(api_key: str) -> bool:
         """
@@ -1,16 +1,21 @@
-from services.llms.base import BaseAPILLM
-from openai import OpenAI, OpenAIError, APIError, ChatCompletion
-from typing import Optional, AsyncGenerator
+from services.llms.base import BaseAPILLM, LLMProviderError, record_usage
+from openai import OpenAI, AsyncOpenAI, OpenAIError, APIError, ChatCompletion
+from typing import Dict, List, Optional, AsyncGenerator
 
 
 class OpenAIAPILLM(BaseAPILLM):
-    """OpenAI API LLM."""
+    """
+    OpenAI API LLM.
+    OpenAI caches the prompt prefixes of 1024 tokens and more on its own, the chat messages are sent as native turns
+    after the system prompt so every turn of a chat starts with the prompt of the previous one.
+    """
 
-    def __init__(self, api_key: Optional[str] = None):
-        super().__init__(name="openai", api_key=api_key)
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        super().__init__(name="openai", api_key=api_key, base_url=base_url)
         self.template = self.env.get_template("llms/api/openai.jinja")
         if api_key is not None:
-            self.client = OpenAI(api_key=self.api_key)
+            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
 
 
     def get_completion(
@@ -20,16 +25,20 @@ class OpenAIAPILLM(BaseAPILLM):
         model: str = "gpt-4o",
         temperature: float = 0.7,
         max_tokens: int = 2048,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,
     ) -> str:
         """
         Get a non-streaming completion from OpenAI.
 
         Args:
             system_prompt (str): Instructions for the assistant.
-            user_prompt (str): The user message.
+            user_prompt (str): The user message, when there are no messages.
             model (str): OpenAI model name.
             temperature (float): Sampling temperature.
             max_tokens (int): Max tokens to generate.
+            messages (Optional[List[Dict[str, str]]]): The chat messages, oldest first.
+            usage (Optional[dict]): Filled with the token usage of the request.
 
         Returns:
             str: The model-generated response.
@@ -37,16 +46,52 @@ class OpenAIAPILLM(BaseAPILLM):
         try:
             response: ChatCompletion = self.client.chat.completions.create(
                 model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
+                messages=self.chat_messages(system_prompt, user_prompt, messages),
                 temperature=temperature,
                 max_tokens=max_tokens,
             )
+            self._record_usage(usage, response.usage)
             return response.choices[0].message.content.strip()
         except APIError as e:
-            raise RuntimeError(f"OpenAI API error: {e}")
+            raise LLMProviderError.from_api_error("OpenAI API error", e)
+
+
+    async def aget_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: str = "gpt-4o",
+        temperature: float = 0.7,
+        max_tokens: int = 2048,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,
+    ) -> str:
+        """
+        Get a non-streaming completion from OpenAI using the async client.
+
+        Args:
+            system_prompt (str): Instructions for the assistant.
+            user_prompt (str): The user message, when there are no messages.
+            model (str): OpenAI model name.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Max tokens to generate.
+            messages (Optional[List[Dict[str, str]]]): The chat messages, oldest first.
+            usage (Optional[dict]): Filled with the token usage of the request.
+
+        Returns:
+            str: The model-generated response.
+        """
+        try:
+            response: ChatCompletion = await self.async_client.chat.completions.create(
+                model=model,
+                messages=self.chat_messages(system_prompt, user_prompt, messages),
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+            self._record_usage(usage, response.usage)
+            return response.choices[0].message.content.strip()
+        except APIError as e:
+            raise LLMProviderError.from_api_error("OpenAI API error", e)
 
 
     async def stream_completion(
@@ -56,37 +101,87 @@ class OpenAIAPILLM(BaseAPILLM):
         model: str = "gpt-4o",
         temperature: float = 0.7,
         max_tokens: int = 2048,
+        messages: Optional[List[Dict[str, str]]] = None,
+        usage: Optional[dict] = None,
     ) -> AsyncGenerator[str, None]:
         """
         Stream a completion from OpenAI, yielding parts of the message as they arrive.
 
         Args:
             system_prompt (str): Instructions for the assistant.
-            user_prompt (str): The user message.
+            user_prompt (str): The user message, when there are no messages.
             model (str): OpenAI model name.
             temperature (float): Sampling temperature.
             max_tokens (int): Max tokens to generate.
+            messages (Optional[List[Dict[str, str]]]): The chat messages, oldest first.
+            usage (Optional[dict]): Filled with the token usage of the request once the stream ends.
 
         Yields:
             str: Partial responses (tokens or phrases).
         """
         try:
-            stream = self.client.chat.completions.create(
+            stream = await self.async_client.chat.completions.create(
                 model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
+                messages=self.chat_messages(system_prompt, user_prompt, messages),
                 temperature=temperature,
                 max_tokens=max_tokens,
                 stream=True,
+                # the usage comes in a last chunk without choices, only asked for when the caller wants it
+                **({"stream_options": {"include_usage": True}} if usage is not None else {}),
             )
 
-            async for chunk in stream:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            # closing the stream closes its HTTP response, a consumer that goes away stops the generation
+            async with stream:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+                    if chunk.usage is not None:
+                        self._record_usage(usage, chunk.usage)
+        except APIError as e:
+            raise LLMProviderError.from_api_error("OpenAI streaming API error", e)
+
+
+    @staticmethod
+    def _record_usage(usage: Optional[dict], response_usage) -> None:
+        if response_usage is None:
+            return
+        details = response_usage.prompt_tokens_details
+        record_usage(
+            usage,
+            response_usage.prompt_tokens,
+            response_usage.completion_tokens,
+            cached_tokens=details.cached_tokens if details else 0,
+        )
+
+
+    # inputs accepted by a single request of the embeddings API
+    max_embedding_batch = 2048
+
+    def embed(self, texts: List[str], model: str = "text-embedding-3-small") -> List[List[float]]:
+        """
+        Embed texts with an OpenAI embeddings model.
+
+        Args:
+            texts (List[str]): The texts to embed, at most max_embedding_batch.
+            model (str): OpenAI embeddings model name.
+
+        Returns:
+            List[List[float]]: One embedding per text, in the order of the texts.
+        """
+        try:
+            response = self.client.embeddings.create(model=model, input=texts)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except APIError as e:
+            raise LLMProviderError.from_api_error("OpenAI embeddings API error", e)
+
+
+    async def aembed(self, texts: List[str], model: str = "text-embedding-3-small") -> List[List[float]]:
+        """Embed texts with an OpenAI embeddings model using the async client."""
+        try:
+            response = await self.async_client.embeddings.create(model=model, input=texts)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
         except APIError as e:
-            raise RuntimeError(f"OpenAI streaming API error: {e}")
+            raise LLMProviderError.from_api_error("OpenAI embeddings API error", e)
 
 
     @staticmethod
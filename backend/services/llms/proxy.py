@@ -0,0 +1,29 @@
+from typing import AsyncGenerator
+
+
+class LLMProxy:
+    """
+    Wraps an LLM client and forwards everything it does not override to it, so a wrapped client can be used
+    wherever the client itself is used (e.g. to add caching around the completion methods).
+
+    Attributes:
+        llm: The wrapped LLM client.
+    """
+    def __init__(self, llm):
+        self.llm = llm
+
+
+    def __getattr__(self, name: str):
+        return getattr(self.llm, name)
+
+
+    def get_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        return self.llm.get_completion(system_prompt, user_prompt, **kwargs)
+
+
+    async def aget_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        return await self.llm.aget_completion(system_prompt, user_prompt, **kwargs)
+
+
+    def stream_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> AsyncGenerator[str, None]:
+        return self.llm.stream_completion(system_prompt, user_prompt, **kwargs)
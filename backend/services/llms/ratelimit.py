@@ -0,0 +1,306 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import aclosing
+from typing import AsyncGenerator, Dict, List, Optional
+from core.config import (
+    RATE_LIMIT_RPM, RATE_LIMIT_TPM, RATE_LIMIT_MAX_QUEUE, RATE_LIMIT_MAX_RETRIES, RATE_LIMIT_BACKOFF_BASE, RATE_LIMIT_BACKOFF_MAX,
+)
+from services.llms.base import LLMProviderError
+from services.llms.proxy import LLMProxy
+from services.llms.tokenizer import tokenizer_service
+
+
+class RateLimitQueueFull(RuntimeError):
+    """The rate limit queue of an alias is full, the request is refused instead of waiting."""
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at per_minute, holding up to one minute of capacity.
+    A reservation may overdraw the bucket, its caller then waits until the debt is refilled, so callers are served
+    in the order they reserved. A per_minute of 0 never limits.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+
+    def wait_for(self, amount: float, now: float) -> float:
+        """Seconds a reservation of amount would wait, without making it."""
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill(now)
+        # a single request larger than the bucket waits for a full bucket, it would never fit otherwise
+        debt = min(amount, self.per_minute) - self.level
+        return max(0.0, debt * 60 / self.per_minute)
+
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take amount from the bucket and return the seconds to wait before using it."""
+        wait = self.wait_for(amount, now)
+        if self.per_minute > 0:
+            self.level -= min(amount, self.per_minute)
+        return wait
+
+
+    def refund(self, amount: float, now: float) -> None:
+        """Give back a reservation that was not used."""
+        if self.per_minute > 0:
+            self._refill(now)
+            self.level = min(self.per_minute, self.level + min(amount, self.per_minute))
+
+
+class AliasLimiter:
+    """
+    Requests/min and tokens/min limits of an alias, with a bounded queue of the requests waiting for capacity.
+
+    Args:
+        rpm (int): Requests per minute, 0 for no limit.
+        tpm (int): Prompt and completion tokens per minute, 0 for no limit.
+        max_queue (int): Requests that may wait for capacity at once, further ones are refused.
+    """
+
+    def __init__(self, rpm: int, tpm: int, max_queue: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.queue_depth = 0
+        self._stats = {"requests": 0, "queued": 0, "rejected": 0, "retries": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        self._lock = threading.Lock()
+
+
+    @property
+    def counts_tokens(self) -> bool:
+        return self.tokens.per_minute > 0
+
+
+    def configure(self, rpm: int, tpm: int, max_queue: int) -> None:
+        with self._lock:
+            for bucket, per_minute in ((self.requests, rpm), (self.tokens, tpm)):
+                if bucket.per_minute != per_minute:
+                    bucket.per_minute = per_minute
+                    bucket.level = min(bucket.level, per_minute)
+            self.max_queue = max_queue
+
+
+    def _reserve(self, tokens: int) -> float:
+        now = time.monotonic()
+        with self._lock:
+            self._stats["requests"] += 1
+            wait = max(self.requests.wait_for(1, now), self.tokens.wait_for(tokens, now))
+            if wait > 0:
+                if self.queue_depth >= self.max_queue:
+                    self._stats["rejected"] += 1
+                    raise RateLimitQueueFull(f"Rate limit queue is full ({self.max_queue} requests waiting)")
+                self.queue_depth += 1
+                self._stats["queued"] += 1
+            self.requests.reserve(1, now)
+            self.tokens.reserve(tokens, now)
+            return wait
+
+
+    def _refund(self, tokens: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.requests.refund(1, now)
+            self.tokens.refund(tokens, now)
+
+
+    def _release(self, waited: float) -> None:
+        with self._lock:
+            self.queue_depth -= 1
+            self._stats["wait_seconds"] += waited
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait, without blocking the event loop, until the limits allow a request of tokens."""
+        wait = self._reserve(tokens)
+        if wait <= 0:
+            return
+        start = time.monotonic()
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # the caller went away while queued, its reservation must not delay the requests queued after it
+            self._refund(tokens)
+            raise
+        finally:
+            self._release(time.monotonic() - start)
+
+
+    def acquire_sync(self, tokens: int) -> None:
+        wait = self._reserve(tokens)
+        if wait <= 0:
+            return
+        try:
+            time.sleep(wait)
+        finally:
+            self._release(wait)
+
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self._stats["retries"] += 1
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rpm": int(self.requests.per_minute),
+                "tpm": int(self.tokens.per_minute),
+                "queue_depth": self.queue_depth,
+                "max_queue": self.max_queue,
+                **self._stats,
+                "avg_wait_seconds": self._stats["wait_seconds"] / self._stats["queued"] if self._stats["queued"] else 0.0,
+            }
+
+
+class RateLimiters:
+    """The limiters of the remote aliases. A limiter outlives the client of its alias, so a rebuilt client keeps its budget."""
+
+    def __init__(self):
+        self._limiters: Dict[str, AliasLimiter] = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, alias: str, rpm: int, tpm: int, max_queue: int) -> AliasLimiter:
+        with self._lock:
+            limiter = self._limiters.get(alias)
+            if limiter is None:
+                limiter = self._limiters[alias] = AliasLimiter(rpm, tpm, max_queue)
+            else:
+                limiter.configure(rpm, tpm, max_queue)
+            return limiter
+
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {alias: limiter.stats() for alias, limiter in limiters.items()}
+
+
+rate_limiters = RateLimiters()
+
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """Full-jitter exponential backoff, never shorter than the Retry-After the provider sent."""
+    delay = random.uniform(0, min(RATE_LIMIT_BACKOFF_MAX, RATE_LIMIT_BACKOFF_BASE * 2 ** attempt))
+    return max(delay, getattr(error, "retry_after", None) or 0.0)
+
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, LLMProviderError) and error.retryable
+
+
+class RateLimitedLLM(LLMProxy):
+    """
+    Remote LLM client whose requests go through the rate limiter of its alias and are retried, with jittered
+    exponential backoff, on retryable provider errors (429s, 5xx, timeouts). Streams are only retried until
+    their first token.
+
+    Args:
+        llm: The wrapped LLM client.
+        alias (str): The LLM alias.
+        limiter (AliasLimiter): The limiter of the alias.
+        max_retries (int): Retries of a failed request.
+    """
+    def __init__(self, llm, alias: str, limiter: AliasLimiter, max_retries: int = RATE_LIMIT_MAX_RETRIES):
+        super().__init__(llm)
+        self.alias = alias
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+
+    def _cost(self, system_prompt: str, user_prompt: str, kwargs: dict) -> int:
+        """Tokens a request counts against the tokens/min limit: its prompt and its completion budget."""
+        if not self.limiter.counts_tokens:
+            return 0
+        encoder = tokenizer_service.encoder(self.llm, kwargs.get("model"))
+        return encoder.count(system_prompt) + encoder.count(user_prompt) + (kwargs.get("max_tokens") or 0)
+
+
+    def _should_retry(self, attempt: int, error: Exception) -> bool:
+        if attempt >= self.max_retries or not is_retryable(error):
+            return False
+        self.limiter.record_retry()
+        print(f"[AgentSmith LLM] {self.alias} request failed ({error}), retrying")
+        return True
+
+
+    def get_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        cost = self._cost(system_prompt, user_prompt, kwargs)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire_sync(cost)
+            try:
+                return self.llm.get_completion(system_prompt, user_prompt, **kwargs)
+            except Exception as e:
+                if not self._should_retry(attempt, e):
+                    raise
+                time.sleep(backoff_delay(attempt, e))
+
+
+    async def aget_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        cost = await asyncio.to_thread(self._cost, system_prompt, user_prompt, kwargs)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(cost)
+            try:
+                return await self.llm.aget_completion(system_prompt, user_prompt, **kwargs)
+            except Exception as e:
+                if not self._should_retry(attempt, e):
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, e))
+
+
+    async def stream_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> AsyncGenerator[str, None]:
+        cost = await asyncio.to_thread(self._cost, system_prompt, user_prompt, kwargs)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(cost)
+            streamed = False
+            try:
+                async with aclosing(self.llm.stream_completion(system_prompt, user_prompt, **kwargs)) as stream:
+                    async for token in stream:
+                        streamed = True
+                        yield token
+                return
+            except Exception as e:
+                if streamed or not self._should_retry(attempt, e):
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, e))
+
+
+    async def aembed(self, texts: List[str], model: str) -> List[List[float]]:
+        """A batch of embeddings counts as one request, and its texts against the tokens/min limit."""
+        cost = 0
+        if self.limiter.counts_tokens:
+            encoder = tokenizer_service.encoder(self.llm, model)
+            cost = await asyncio.to_thread(lambda: sum(encoder.count(text) for text in texts))
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(cost)
+            try:
+                return await self.llm.aembed(texts, model)
+            except Exception as e:
+                if not self._should_retry(attempt, e):
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, e))
+
+
+def rate_limited(llm, alias: str, settings: Optional[dict] = None) -> RateLimitedLLM:
+    """Wrap the client of a remote alias with the limits of its "rate_limit" settings, or the default ones."""
+    settings = settings or {}
+    limiter = rate_limiters.get(
+        alias,
+        rpm=settings.get("rpm") if settings.get("rpm") is not None else RATE_LIMIT_RPM,
+        tpm=settings.get("tpm") if settings.get("tpm") is not None else RATE_LIMIT_TPM,
+        max_queue=settings.get("max_queue") if settings.get("max_queue") is not None else RATE_LIMIT_MAX_QUEUE,
+    )
+    return RateLimitedLLM(llm, alias, limiter)
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from core.config import LLM_CLIENT_CLOSE_GRACE
+from services.llms.base import BaseLLM
+
+
+class LLMClientRegistry:
+    """
+    Process-wide registry of instantiated LLM clients.
+
+    Clients are keyed by (alias, provider), so the SDK clients and their keep-alive HTTP connection pools
+    are reused across requests and a decrypted API key only lives in the memory of its client.
+    Entries are invalidated by the LLM CRUD functions whenever an alias is updated or deleted, and so are the
+    caches that registered an invalidation listener. Every invalidation bumps the generation of the alias, and a
+    client built from settings read before it is not registered. The connection pools of an invalidated client are closed
+    once the requests still using it had close_grace seconds to finish.
+
+    Args:
+        close_grace (float): Seconds an invalidated client is left open.
+    """
+
+    def __init__(self, close_grace: float = LLM_CLIENT_CLOSE_GRACE):
+        self.close_grace = close_grace
+        self._clients: Dict[Tuple[str, str], BaseLLM] = {}
+        self._providers: Dict[Tuple[str, bool], str] = {}  # (alias, is_remote) -> provider
+        self._generations: Dict[Tuple[str, bool], int] = {}  # (alias, is_remote) -> invalidations so far
+        self._listeners: List[Callable[[str, bool], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None  # the event loop the async SDK clients are used on
+        self._lock = threading.Lock()
+
+
+    def add_invalidation_listener(self, listener: Callable[[str, bool], None]) -> None:
+        """Call listener(alias, is_remote) whenever an alias is invalidated."""
+        self._listeners.append(listener)
+
+
+    def get(self, alias: str, is_remote: bool) -> Optional[BaseLLM]:
+        """
+        Get the cached client of an alias.
+        Args:
+            alias (str): The LLM alias.
+            is_remote (bool): Whether the alias is a remote or a local LLM.
+        Returns:
+            Optional[BaseLLM]: The cached client, or None if the alias has not been instantiated yet.
+        """
+        with self._lock:
+            provider = self._providers.get((alias, is_remote))
+            if provider is None:
+                return None
+            return self._clients.get((alias, provider))
+
+
+    def generation(self, alias: str, is_remote: bool) -> int:
+        """The generation of an alias, to read before its settings and pass to put with the client built from them."""
+        with self._lock:
+            return self._generations.get((alias, is_remote), 0)
+
+
+    def put(self, alias: str, provider: str, is_remote: bool, client: BaseLLM, generation: Optional[int] = None) -> BaseLLM:
+        """
+        Register the client of an alias. If another request registered one first, that one is kept and returned.
+        Args:
+            generation (Optional[int]): The generation of the alias when its settings were read. If the alias was
+                invalidated since, the client is built from stale settings: it is returned for the request that built
+                it, but not registered, and closed after the grace period.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self._lock:
+            self._loop = loop or self._loop
+            stale = generation is not None and generation < self._generations.get((alias, is_remote), 0)
+            if not stale:
+                self._providers[(alias, is_remote)] = provider
+                return self._clients.setdefault((alias, provider), client)
+        self._close(alias, client)
+        return client
+
+
+    def invalidate(self, alias: str, is_remote: bool) -> None:
+        """Drop the cached client of an alias, the next request rebuilds it from the DB."""
+        client = None
+        with self._lock:
+            self._generations[(alias, is_remote)] = self._generations.get((alias, is_remote), 0) + 1
+            provider = self._providers.pop((alias, is_remote), None)
+            if provider is not None:
+                client = self._clients.pop((alias, provider), None)
+        if client is not None:
+            self._close(alias, client)
+        for listener in self._listeners:
+            listener(alias, is_remote)
+
+
+    def clear(self) -> None:
+        with self._lock:
+            clients = list(self._clients.items())
+            self._providers.clear()
+            self._clients.clear()
+        for (alias, _), client in clients:
+            self._close(alias, client)
+
+
+    def _close(self, alias: str, client: BaseLLM) -> None:
+        """
+        Close the connection pools of an evicted client after the grace period. The async SDK clients are bound to
+        the event loop they were used on, they are closed on it; without one, only the sync client was used.
+        """
+        async def close_later():
+            await asyncio.sleep(self.close_grace)
+            try:
+                await client.aclose()
+            except Exception as e:
+                print(f"[AgentSmith LLM] Could not close the previous client of {alias}: {e}")
+
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(close_later(), loop)
+            return
+        try:
+            client.close()
+        except Exception as e:
+            print(f"[AgentSmith LLM] Could not close the previous client of {alias}: {e}")
+
+
+llm_registry = LLMClientRegistry()
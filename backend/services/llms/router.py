@@ -0,0 +1,299 @@
+import threading
+import time
+from collections import deque
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Callable, Deque, Dict, List, Optional, Tuple
+import numpy as np
+from core.config import ROUTER_STATS_WINDOW, ROUTER_BREAKER_FAILURES, ROUTER_BREAKER_COOLDOWN
+from services.llms.registry import llm_registry
+
+
+# Keyword arguments only local LLMs understand, they are dropped for remote targets
+LOCAL_ONLY_KWARGS = ("conversation_id",)
+
+# How much a target's error rate inflates its latency score
+ERROR_RATE_PENALTY = 4.0
+
+
+@dataclass(frozen=True)
+class RouterTarget:
+    alias: str
+    is_remote: bool
+    model: str
+
+
+@dataclass
+class TargetHealth:
+    """Rolling latency and error window of a target, and its circuit breaker."""
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=ROUTER_STATS_WINDOW))  # seconds to the full response
+    ttfts: Deque[float] = field(default_factory=lambda: deque(maxlen=ROUTER_STATS_WINDOW))  # seconds to the first streamed token
+    outcomes: Deque[bool] = field(default_factory=lambda: deque(maxlen=ROUTER_STATS_WINDOW))
+    consecutive_failures: int = 0
+    opened_at: Optional[float] = None  # when the breaker tripped, None while it is closed
+    probing: bool = False  # a half-open breaker lets a single request through
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+
+    def percentile(self, q: float, stream: bool) -> Optional[float]:
+        samples = self.ttfts if stream else self.latencies
+        return float(np.percentile(samples, q)) if samples else None
+
+
+class RouterHealth:
+    """
+    Process-wide health of the router targets. A backend used by several routers shares its stats and breaker,
+    which are reset when its alias is updated or deleted.
+    """
+
+    def __init__(self):
+        self._targets: Dict[RouterTarget, TargetHealth] = {}
+        self._lock = threading.Lock()
+
+
+    def _health(self, target: RouterTarget) -> TargetHealth:
+        """Must be called with the lock held."""
+        return self._targets.setdefault(target, TargetHealth())
+
+
+    def score(self, target: RouterTarget, stream: bool) -> float:
+        """
+        Expected latency of a target, inflated by its error rate. Untried targets score 0, so they get tried,
+        targets that only failed rank last.
+        """
+        with self._lock:
+            health = self._health(target)
+            p50, p95 = health.percentile(50, stream), health.percentile(95, stream)
+            if p50 is None:
+                return float("inf") if health.error_rate > 0 else 0.0
+            return (p50 + p95) / 2 * (1 + ERROR_RATE_PENALTY * health.error_rate)
+
+
+    def acquire(self, target: RouterTarget) -> bool:
+        """Whether the breaker of a target lets a request through."""
+        with self._lock:
+            health = self._health(target)
+            if health.opened_at is None:
+                return True
+            if time.monotonic() - health.opened_at < ROUTER_BREAKER_COOLDOWN or health.probing:
+                return False
+            health.probing = True
+            return True
+
+
+    def is_available(self, target: RouterTarget) -> bool:
+        """Whether the breaker of a target is closed, or open for longer than the cooldown."""
+        with self._lock:
+            health = self._health(target)
+            return health.opened_at is None or time.monotonic() - health.opened_at >= ROUTER_BREAKER_COOLDOWN
+
+
+    def record_latency(self, target: RouterTarget, latency: float, stream: bool) -> None:
+        with self._lock:
+            health = self._health(target)
+            (health.ttfts if stream else health.latencies).append(latency)
+
+
+    def record_success(self, target: RouterTarget) -> None:
+        with self._lock:
+            health = self._health(target)
+            health.outcomes.append(True)
+            health.consecutive_failures = 0
+            health.opened_at = None
+            health.probing = False
+
+
+    def record_failure(self, target: RouterTarget) -> None:
+        with self._lock:
+            health = self._health(target)
+            health.outcomes.append(False)
+            health.consecutive_failures += 1
+            if health.probing or health.consecutive_failures >= ROUTER_BREAKER_FAILURES:
+                print(f"[AgentSmith LLM] Circuit breaker opened for {target.alias} ({target.model})")
+                health.opened_at = time.monotonic()
+            health.probing = False
+
+
+    def release(self, target: RouterTarget) -> None:
+        """Give back a half-open probe that ended without an outcome (e.g. the caller went away)."""
+        with self._lock:
+            self._health(target).probing = False
+
+
+    def invalidate(self, alias: str, is_remote: bool) -> None:
+        with self._lock:
+            for target in [target for target in self._targets if target.alias == alias and target.is_remote == is_remote]:
+                del self._targets[target]
+
+
+    def stats(self, target: RouterTarget) -> dict:
+        with self._lock:
+            health = self._health(target)
+            if health.opened_at is None:
+                breaker = "closed"
+            elif time.monotonic() - health.opened_at < ROUTER_BREAKER_COOLDOWN:
+                breaker = "open"
+            else:
+                breaker = "half_open"
+            return {
+                "alias": target.alias,
+                "type": "remote" if target.is_remote else "local",
+                "model": target.model,
+                "requests": len(health.outcomes),
+                "error_rate": health.error_rate,
+                "latency_p50": health.percentile(50, stream=False),
+                "latency_p95": health.percentile(95, stream=False),
+                "ttft_p50": health.percentile(50, stream=True),
+                "ttft_p95": health.percentile(95, stream=True),
+                "breaker": breaker,
+            }
+
+
+router_health = RouterHealth()
+llm_registry.add_invalidation_listener(router_health.invalidate)
+
+
+class AllTargetsFailed(RuntimeError):
+    pass
+
+
+class RouterLLM:
+    """
+    LLM client that spreads the requests of a router alias over its target aliases.
+
+    Targets are tried in order of their rolling p50/p95 latency, inflated by their error rate; targets whose
+    circuit breaker is open are skipped. A failed request fails over to the next target, as long as nothing was
+    streamed to the caller yet. The model of each target replaces the model of the request.
+
+    Args:
+        alias (str): The router alias.
+        targets (List[RouterTarget]): The target aliases, in order of preference on equal scores.
+        resolve (Callable[[RouterTarget], object]): Builds the LLM client of a target.
+    """
+    name = "router"
+
+    def __init__(self, alias: str, targets: List[RouterTarget], resolve: Callable[[RouterTarget], object]):
+        self.alias = alias
+        self.targets = targets
+        self._resolve = resolve
+
+
+    def ranked_targets(self, stream: bool = False) -> List[RouterTarget]:
+        """The targets, best first, without those whose breaker is open."""
+        ranked = sorted(
+            enumerate(self.targets), key=lambda item: (router_health.score(item[1], stream), item[0])
+        )
+        return [target for _, target in ranked if router_health.is_available(target)]
+
+
+    def primary(self) -> Tuple[object, str]:
+        """The client and model of the best target, e.g. to count tokens or to generate code."""
+        target = (self.ranked_targets() or self.targets)[0]
+        return self._resolve(target), target.model
+
+
+    @staticmethod
+    def _target_kwargs(target: RouterTarget, kwargs: dict) -> dict:
+        kwargs = {**kwargs, "model": target.model}
+        if target.is_remote:
+            for name in LOCAL_ONLY_KWARGS:
+                kwargs.pop(name, None)
+        return kwargs
+
+
+    def _candidates(self, stream: bool):
+        """Yield the targets whose breaker lets the request through, best first."""
+        for target in self.ranked_targets(stream):
+            if router_health.acquire(target):
+                yield target
+
+
+    def get_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        errors = []
+        for target in self._candidates(stream=False):
+            start = time.perf_counter()
+            try:
+                text = self._resolve(target).get_completion(system_prompt, user_prompt, **self._target_kwargs(target, kwargs))
+            except Exception as e:
+                router_health.record_failure(target)
+                errors.append(f"{target.alias}: {e}")
+                continue
+            except BaseException:
+                router_health.release(target)
+                raise
+            router_health.record_latency(target, time.perf_counter() - start, stream=False)
+            router_health.record_success(target)
+            return text
+        raise AllTargetsFailed(f"All targets of router {self.alias} failed: {'; '.join(errors) or 'no target available'}")
+
+
+    async def aget_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> str:
+        errors = []
+        for target in self._candidates(stream=False):
+            start = time.perf_counter()
+            try:
+                text = await self._resolve(target).aget_completion(system_prompt, user_prompt, **self._target_kwargs(target, kwargs))
+            except Exception as e:
+                router_health.record_failure(target)
+                errors.append(f"{target.alias}: {e}")
+                continue
+            except BaseException:
+                router_health.release(target)
+                raise
+            router_health.record_latency(target, time.perf_counter() - start, stream=False)
+            router_health.record_success(target)
+            return text
+        raise AllTargetsFailed(f"All targets of router {self.alias} failed: {'; '.join(errors) or 'no target available'}")
+
+
+    async def stream_completion(self, system_prompt: str, user_prompt: str, **kwargs) -> AsyncGenerator[str, None]:
+        errors = []
+        for target in self._candidates(stream=True):
+            start = time.perf_counter()
+            streamed = False
+            try:
+                stream = self._resolve(target).stream_completion(system_prompt, user_prompt, **self._target_kwargs(target, kwargs))
+                async with aclosing(stream):
+                    async for token in stream:
+                        if not streamed:
+                            streamed = True
+                            router_health.record_latency(target, time.perf_counter() - start, stream=True)
+                        yield token
+            except Exception as e:
+                router_health.record_failure(target)
+                if streamed:
+                    raise  # the caller already has part of the answer, it can not be replayed from another target
+                errors.append(f"{target.alias}: {e}")
+                continue
+            except BaseException:
+                router_health.release(target)  # the caller went away, the request says nothing about the target
+                raise
+            router_health.record_success(target)
+            return
+        raise AllTargetsFailed(f"All targets of router {self.alias} failed: {'; '.join(errors) or 'no target available'}")
+
+
+    def stats(self) -> List[dict]:
+        return [router_health.stats(target) for target in self.targets]
+
+
+    def list_models(self) -> list[str]:
+        return [target.model for target in self.targets]
+
+
+    def list_embeddings_models(self) -> list[str]:
+        return []
+
+
+    def to_code(self, model: Optional[str] = None) -> str:
+        """The code of the best target, the generated flow calls that target directly."""
+        llm, target_model = self.primary()
+        return llm.to_code(target_model)
+
+
+    def get_tunable_parameters(self, model: Optional[str] = None) -> dict:
+        llm, target_model = self.primary()
+        return llm.get_tunable_parameters(target_model)
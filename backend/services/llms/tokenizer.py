@@ -0,0 +1,231 @@
+import hashlib
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from core.config import DEFAULT_CONTEXT_WINDOW
+
+
+# Context windows of the remote model families, matched by the longest model name prefix
+CONTEXT_WINDOWS: Dict[str, int] = {
+    "gpt-4.1": 1_047_576,
+    "gpt-4o": 128_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4": 8_192,
+    "gpt-3.5-turbo": 16_385,
+    "o1": 200_000,
+    "o3": 200_000,
+    "o4": 200_000,
+    "claude": 200_000,
+}
+
+# Tokens the chat format adds around every message (role, separators) and to prime the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+# Token counts an encoder remembers, keyed by a digest of the text so the texts themselves are not kept
+COUNT_CACHE_SIZE = 8192
+
+_count_lock = threading.Lock()
+
+
+class ContextWindowExceeded(ValueError):
+    """The prompt and the requested completion do not fit in the context window of the model."""
+
+    def __init__(self, prompt_tokens: int, max_tokens: int, context_window: int):
+        super().__init__(
+            f"Prompt of {prompt_tokens} tokens plus {max_tokens} completion tokens exceeds "
+            f"the context window of {context_window} tokens"
+        )
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.context_window = context_window
+
+
+class Encoder(ABC):
+    """Counts the tokens of a text with the tokenizer of a model."""
+
+    exact: bool = True  # False when the model tokenizer is unavailable and tokens are estimated
+
+    @abstractmethod
+    def encode(self, text: str) -> List[int]:
+        ...
+
+
+    def count(self, text: str) -> int:
+        # chat histories are resent on every turn, their messages are counted once
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with _count_lock:
+            counts: "OrderedDict[bytes, int]" = self.__dict__.setdefault("_counts", OrderedDict())
+            count = counts.get(digest)
+            if count is not None:
+                counts.move_to_end(digest)
+                return count
+        count = len(self.encode(text))
+        with _count_lock:
+            counts[digest] = count
+            while len(counts) > COUNT_CACHE_SIZE:
+                counts.popitem(last=False)
+        return count
+
+
+class TiktokenEncoder(Encoder):
+    def __init__(self, model: Optional[str], exact: bool = True):
+        import tiktoken
+        try:
+            self._encoding = tiktoken.encoding_for_model(model or "")
+        except KeyError:
+            self._encoding = tiktoken.get_encoding("o200k_base")
+        self.exact = exact
+
+
+    def encode(self, text: str) -> List[int]:
+        return self._encoding.encode(text, disallowed_special=())
+
+
+class CharacterEstimateEncoder(Encoder):
+    """Estimates about four characters per token, for when no tokenizer can be loaded (e.g. offline)."""
+
+    exact = False
+
+    def encode(self, text: str) -> List[int]:
+        return [0] * -(-len(text) // 4)
+
+
+class HuggingFaceEncoder(Encoder):
+    def __init__(self, model: str):
+        from transformers import AutoTokenizer
+        # never downloads on the request path, a tokenizer missing from the local Hugging Face cache is estimated
+        self._tokenizer = AutoTokenizer.from_pretrained(model, local_files_only=True)
+
+
+    def encode(self, text: str) -> List[int]:
+        return self._tokenizer.encode(text, add_special_tokens=False)
+
+
+class GGUFEncoder(Encoder):
+    """Tokenizes with the vocabulary of a GGUF file, loaded without its weights."""
+
+    def __init__(self, model_path: str):
+        from llama_cpp import Llama
+        self._llm = Llama(model_path=model_path, vocab_only=True, verbose=False)
+
+
+    def encode(self, text: str) -> List[int]:
+        return self._llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+
+class TokenizerService:
+    """
+    Cached per-model encoders: tiktoken for OpenAI, the Hugging Face tokenizer of the model for Hugging Face,
+    and the GGUF vocabulary for llama.cpp models. Anthropic does not publish its tokenizer, its counts (and
+    those of models whose tokenizer can not be loaded) are tiktoken estimates.
+
+    Args:
+        max_encoders (int): Encoders kept loaded, least recently used ones are dropped first.
+    """
+
+    def __init__(self, max_encoders: int = 16):
+        self.max_encoders = max_encoders
+        self._encoders: "OrderedDict[Tuple[str, str], Encoder]" = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def encoder(self, llm, model: Optional[str]) -> Encoder:
+        """
+        Get the encoder of a model of an LLM client.
+        Args:
+            llm: The LLM client, its provider name selects the tokenizer.
+            model (Optional[str]): The model name, or the GGUF file of a local LLM.
+        Returns:
+            Encoder: The encoder.
+        """
+        provider = llm.name
+        name = os.path.join(os.path.abspath(llm.path), model) if provider == "llama-cpp" else (model or "")
+        key = (provider, name)
+        with self._lock:
+            encoder = self._encoders.get(key)
+            if encoder is not None:
+                self._encoders.move_to_end(key)
+                return encoder
+
+        encoder = self._load(provider, name)
+        with self._lock:
+            encoder = self._encoders.setdefault(key, encoder)
+            while len(self._encoders) > self.max_encoders:
+                self._encoders.popitem(last=False)
+        return encoder
+
+
+    @staticmethod
+    def _load(provider: str, name: str) -> Encoder:
+        try:
+            if provider == "openai":
+                return TiktokenEncoder(name)
+            if provider == "huggingface":
+                return HuggingFaceEncoder(name)
+            if provider == "llama-cpp":
+                return GGUFEncoder(name)
+        except Exception as e:
+            print(f"[AgentSmith LLM] Could not load the tokenizer of {name}, estimating token counts: {e}")
+        try:
+            return TiktokenEncoder(None, exact=False)
+        except Exception:
+            return CharacterEstimateEncoder()
+
+
+    @staticmethod
+    def context_window(llm, model: Optional[str]) -> int:
+        """The context window of a model, in tokens."""
+        if llm.name == "llama-cpp":
+            return llm.model_load_params(model).get("n_ctx") or DEFAULT_CONTEXT_WINDOW
+        matches = [prefix for prefix in CONTEXT_WINDOWS if (model or "").startswith(prefix)]
+        return CONTEXT_WINDOWS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_WINDOW
+
+
+    def count_messages(self, encoder: Encoder, system_prompt: str, messages: List[Tuple[str, str]]) -> int:
+        """Tokens of a system prompt and (role, content) messages, including the chat format overhead."""
+        tokens = encoder.count(system_prompt) + MESSAGE_OVERHEAD_TOKENS + REPLY_OVERHEAD_TOKENS
+        for role, content in messages:
+            tokens += encoder.count(role) + encoder.count(content) + MESSAGE_OVERHEAD_TOKENS
+        return tokens
+
+
+    def fit_messages(
+        self,
+        llm,
+        model: Optional[str],
+        system_prompt: str,
+        messages: List[Tuple[str, str]],
+        max_tokens: int,
+        trim: bool = True,
+    ) -> Tuple[List[Tuple[str, str]], int]:
+        """
+        Fit a chat in the context window of a model, leaving room for max_tokens of completion.
+        Args:
+            llm: The LLM client.
+            model (Optional[str]): The model.
+            system_prompt (str): The system prompt, always kept.
+            messages (List[Tuple[str, str]]): The (role, content) messages, oldest first.
+            max_tokens (int): The completion tokens to reserve.
+            trim (bool): Drop the oldest messages (never the last one) until the chat fits, instead of rejecting it.
+        Returns:
+            Tuple[List[Tuple[str, str]], int]: The messages that fit and their prompt tokens.
+        Raises:
+            ContextWindowExceeded: If the chat does not fit, even after trimming.
+        """
+        encoder = self.encoder(llm, model)
+        budget = self.context_window(llm, model) - max_tokens
+        prompt_tokens = self.count_messages(encoder, system_prompt, messages)
+        start = 0
+        while trim and prompt_tokens > budget and start < len(messages) - 1:
+            role, content = messages[start]
+            prompt_tokens -= encoder.count(role) + encoder.count(content) + MESSAGE_OVERHEAD_TOKENS
+            start += 1
+        if prompt_tokens > budget:
+            raise ContextWindowExceeded(prompt_tokens, max_tokens, budget + max_tokens)
+        return messages[start:], prompt_tokens
+
+
+tokenizer_service = TokenizerService()
@@ -2,14 +2,21 @@ from typing import List, Dict, Optional, AsyncGenerator
 import uuid
 import time
 import asyncio
-from schemas.sandbox.chatbot import Message
-from services.llms.factory import get_llm_client_by_alias
+from schemas.sandbox.chatbot import Message, ChatRequest
+from services.llms.factory import get_llm_client
+from services.llms.router import RouterLLM
+from services.llms.concurrency import alias_concurrency
+from services.llms.tokenizer import tokenizer_service
+from services.sandbox.chatbot.streaming import coalesce
+from services.sandbox.chatbot.sessions import chat_sessions
+from contextlib import aclosing
+from core.config import CONTEXT_OVERFLOW_POLICY
 from db.session import get_db
 from sqlalchemy.orm import Session
 
 class LLMService:
     def __init__(self):
-        self.llm_factory = get_llm_client_by_alias
+        self.llm_factory = get_llm_client
         self.db: Session = next(get_db())
 
     async def generate_chat_completion(
@@ -23,14 +30,18 @@ class LLMService:
         top_p: Optional[float] = 1.0,
         frequency_penalty: Optional[float] = 0.0,
         presence_penalty: Optional[float] = 0.0,
+        conversation_id: Optional[str] = None,
         stream: Optional[bool] = False,
+        session_id: Optional[str] = None,
     ) -> AsyncGenerator[Dict, None]:
         """
         Unified chat interface across multiple LLM backends.
+        With a session_id, messages are the new messages of the turn: the history comes from the chat session, as its
+        running summary and latest messages, and the turn is added to it once the reply is complete.
         """
         # Use llm_alias if provided, otherwise fall back to model-based selection
         is_remote = llm_type.lower() == 'remote'
-        llm = self.llm_factory(alias=llm_alias, db=self.db, is_remote=is_remote) # if llm_alias else None
+        llm = self.llm_factory(alias=llm_alias, db=self.db, llm_type=llm_type.lower()) # if llm_alias else None
         if not llm:
             raise ValueError(f"Could not initialize LLM with alias: {llm_alias}")
             
@@ -38,36 +49,78 @@ class LLMService:
         created = int(time.time())
         
         system_prompt = "You are a helpful assistant."
+        # a router is budgeted against its best target, the others get the same messages
+        budget_llm, budget_model = await asyncio.to_thread(llm.primary) if isinstance(llm, RouterLLM) else (llm, model)
+        model = model or llm_alias
+        history = None
+        if session_id:
+            encoder = await asyncio.to_thread(tokenizer_service.encoder, budget_llm, budget_model)
+            history = await asyncio.to_thread(chat_sessions.history, session_id, encoder)
+            if history.summary:
+                system_prompt = f"{system_prompt}\n\nSummary of the earlier conversation:\n{history.summary}"
+            new_messages = [(m.role, m.content) for m in messages]
+            messages = [Message(role=role, content=content) for role, content in history.messages] + list(messages)
+            # the session identifies the conversation, local models resume from the state of its previous turn
+            conversation_id = conversation_id or session_id
+        # drop (or refuse) the oldest turns that do not fit in the context window, next to the completion budget
+        fitted, prompt_tokens = await asyncio.to_thread(
+            tokenizer_service.fit_messages,
+            budget_llm,
+            budget_model,
+            system_prompt,
+            [(m.role, m.content) for m in messages],
+            max_tokens or 0,
+            CONTEXT_OVERFLOW_POLICY != "reject",
+        )
+        messages = messages[len(messages) - len(fitted):]
+        # the whole chat as one text, which the caches and rate limits key and count requests by
         user_prompt = "\n".join([f"{m.role}: {m.content}" for m in messages])
+        # the LLMs take the chat turn by turn, so the prompt of a turn extends the prompt of the previous one and the
+        # providers serve it from their prompt cache; local models resume the conversation from the state of the
+        # previous turn, routers pass the conversation id on to their local targets only
+        reported_usage = {}
+        chat_kwargs = {"messages": [m.model_dump() for m in messages], "usage": reported_usage}
+        if not is_remote:
+            chat_kwargs["conversation_id"] = conversation_id
 
         if stream:
-            async for token in llm.stream_completion(
+            chunks = []
+            # one chunk per frame of tokens rather than per token, fast local models emit hundreds of tokens a second;
+            # closed with this generator, so a consumer that goes away stops the LLM stream too
+            frames = coalesce(llm.stream_completion(
                 system_prompt=system_prompt,
                 user_prompt=user_prompt,
                 model=model,
                 temperature=temperature,
                 max_tokens=max_tokens,
-            ):
-                yield {
-                    "id": completion_id,
-                    "object": "chat.completion.chunk",
-                    "created": created,
-                    "model": model,
-                    "llm_type": llm_type,
-                    "choices": [
-                        {
-                            "delta": {"content": token},
-                            "index": 0,
-                            "finish_reason": None,
-                        }
-                    ],
-                }
+                **chat_kwargs,
+            ))
+            async with aclosing(frames):
+                async for text in frames:
+                    chunks.append(text)
+                    yield {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "llm_type": llm_type,
+                        "choices": [
+                            {
+                                "delta": {"content": text},
+                                "index": 0,
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+            if history is not None:
+                await chat_sessions.record_turn(session_id, history, new_messages + [("assistant", "".join(chunks))], llm, model, encoder)
             yield {
                 "id": completion_id,
                 "object": "chat.completion.chunk",
                 "created": created,
                 "model": model,
                 "llm_type": llm_type,
+                "usage": await self._usage(budget_llm, budget_model, prompt_tokens, "".join(chunks), reported_usage),
                 "choices": [
                     {
                         "delta": {},
@@ -78,13 +131,16 @@ class LLMService:
             }
 
         else:
-            text: str = llm.get_completion(
+            text: str = await llm.aget_completion(
                 system_prompt=system_prompt,
                 user_prompt=user_prompt,
                 model=model,
                 temperature=temperature,
                 max_tokens=max_tokens,
+                **chat_kwargs,
             )
+            if history is not None:
+                await chat_sessions.record_turn(session_id, history, new_messages + [("assistant", text)], llm, model, encoder)
 
             yield {
                 "id": completion_id,
@@ -92,11 +148,7 @@ class LLMService:
                 "created": created,
                 "model": model,
                 "llm_type": llm_type,
-                "usage": {
-                    "prompt_tokens": len(user_prompt.split()),
-                    "completion_tokens": len(text.split()),
-                    "total_tokens": len(user_prompt.split()) + len(text.split()),
-                },
+                "usage": await self._usage(budget_llm, budget_model, prompt_tokens, text, reported_usage),
                 "choices": [
                     {
                         "message": {"role": "assistant", "content": text},
@@ -107,6 +159,72 @@ class LLMService:
             }
 
 
+    async def generate_batch(self, requests: List[ChatRequest]) -> AsyncGenerator[Dict, None]:
+        """
+        Run chat requests concurrently, at most BATCH_ALIAS_CONCURRENCY at once per alias, and yield their results
+        in completion order as {"index", "response"} or {"index", "error"}.
+        """
+        async def run(index: int, request: ChatRequest) -> Dict:
+            try:
+                if not request.messages:
+                    raise ValueError("Messages cannot be empty")
+                if not request.model and request.llm_type != "router":
+                    raise ValueError("Model must be specified")
+                async with alias_concurrency.slot(request.llm_type, request.llm_alias):
+                    response = None
+                    async for chunk in self.generate_chat_completion(
+                        messages=request.messages,
+                        model=request.model,
+                        llm_alias=request.llm_alias,
+                        llm_type=request.llm_type,
+                        temperature=request.temperature,
+                        max_tokens=request.max_tokens,
+                        top_p=request.top_p,
+                        frequency_penalty=request.frequency_penalty,
+                        presence_penalty=request.presence_penalty,
+                        conversation_id=request.conversation_id,
+                        stream=False,
+                        session_id=request.session_id,
+                    ):
+                        response = chunk
+                return {"index": index, "response": response}
+            except Exception as e:
+                return {"index": index, "error": str(e)}
+
+        tasks = [asyncio.ensure_future(run(index, request)) for index, request in enumerate(requests)]
+        try:
+            for completed in asyncio.as_completed(tasks):
+                yield await completed
+        finally:
+            # the caller went away (e.g. the client disconnected), the requests still waiting are dropped
+            for task in tasks:
+                task.cancel()
+
+
+    @staticmethod
+    async def _usage(llm, model: str, prompt_tokens: int, text: str, reported: Dict) -> Dict:
+        """
+        Token usage of a completion: the one the provider reported, with the prompt tokens it served from its prompt
+        cache, or else the one counted with the tokenizer of the model (cached responses, local models).
+        """
+        if reported:
+            return {
+                "prompt_tokens": reported["prompt_tokens"],
+                "completion_tokens": reported["completion_tokens"],
+                "total_tokens": reported["prompt_tokens"] + reported["completion_tokens"],
+                "prompt_tokens_details": {
+                    "cached_tokens": reported["cached_tokens"],
+                    "cache_creation_tokens": reported["cache_creation_tokens"],
+                },
+            }
+        completion_tokens = await asyncio.to_thread(lambda: tokenizer_service.encoder(llm, model).count(text))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+
 
 # Mock LLM service - replace with actual implementation
 class MockLLMService:
@@ -121,6 +239,7 @@ class MockLLMService:
             top_p: Optional[float] = 1.0,
             frequency_penalty: Optional[float] = 0.0,
             presence_penalty: Optional[float] = 0.0,
+            conversation_id: Optional[str] = None,
             stream: Optional[bool] = False
     ) -> AsyncGenerator[Dict, None]:
         # This is a mock implementation
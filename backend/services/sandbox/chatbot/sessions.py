@@ -0,0 +1,198 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import sessionmaker
+from core.config import CHAT_HISTORY_MAX_TOKENS, CHAT_HISTORY_KEEP_TOKENS, CHAT_SUMMARY_MAX_TOKENS
+from crud.chat import get_session_by_id, add_messages, get_messages, update_summary
+from db.session import SessionLocal
+from services.llms.tokenizer import Encoder, MESSAGE_OVERHEAD_TOKENS
+
+
+SUMMARY_PROMPT = (
+    "You keep the running summary of a conversation between a user and an assistant. Update the summary with the new "
+    "turns: keep the facts, names, numbers, decisions, preferences and open questions the rest of the conversation may "
+    "rely on, drop greetings and small talk. Answer with the updated summary only."
+)
+
+
+class ChatSessionNotFound(LookupError):
+    def __init__(self, session_id: str):
+        super().__init__(f"Chat session {session_id} not found")
+
+
+@dataclass
+class ChatHistory:
+    """What a turn of a session is sent of its history."""
+    summary: Optional[str]
+    messages: List[Tuple[str, str]]  # the latest (role, content) messages after the summary, oldest first
+    tokens: int  # tokens of the messages
+    complete: bool  # whether every message after the summary is in messages
+
+
+class ChatSessionManager:
+    """
+    Keeps the history of the chat sessions server side, so the clients of a session only send its new messages.
+
+    Every turn is sent the running summary of the session and its latest messages, up to max_tokens of them. Once the
+    messages after the summary exceed max_tokens, a background task folds the older ones into the summary with the
+    LLM of the turn, until only keep_tokens of them are left out of it; a turn that arrives meanwhile is sent the
+    latest max_tokens of messages and the previous summary. Whatever the length of a session, a turn is sent at most
+    summary_tokens + max_tokens tokens of history, and a summary is written every max_tokens - keep_tokens tokens of
+    conversation rather than on every turn.
+
+    Args:
+        session_factory (sessionmaker): Opens the DB sessions of the manager.
+        max_tokens (int): Tokens of the latest messages sent verbatim with every turn.
+        keep_tokens (int): Tokens of the latest messages left out of the summary when it is updated.
+        summary_tokens (int): Completion tokens of the summary.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker = SessionLocal,
+        max_tokens: int = CHAT_HISTORY_MAX_TOKENS,
+        keep_tokens: int = CHAT_HISTORY_KEEP_TOKENS,
+        summary_tokens: int = CHAT_SUMMARY_MAX_TOKENS,
+    ):
+        self.session_factory = session_factory
+        self.max_tokens = max_tokens
+        self.keep_tokens = min(keep_tokens, max_tokens)
+        self.summary_tokens = summary_tokens
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+
+    def history(self, session_id: str, encoder: Encoder, page_size: int = 32) -> ChatHistory:
+        """
+        The summary and latest messages of a session, read newest first until max_tokens, so a session whose summary
+        lags behind is not read in full.
+        Raises:
+            ChatSessionNotFound: If the session does not exist.
+        """
+        with self.session_factory() as db:
+            session = get_session_by_id(db, session_id)
+            if session is None:
+                raise ChatSessionNotFound(session_id)
+            messages, tokens, end = [], 0, session.message_count
+            while end > session.summarized_upto:
+                page = get_messages(db, session_id, session.summarized_upto, end, limit=page_size, newest_first=True)
+                if not page:
+                    break
+                for message in page:
+                    count = self._count(encoder, message.role, message.content)
+                    if tokens + count > self.max_tokens:
+                        return ChatHistory(session.summary, messages[::-1], tokens, complete=False)
+                    messages.append((message.role, message.content))
+                    tokens += count
+                end = page[-1].index
+            return ChatHistory(session.summary, messages[::-1], tokens, complete=True)
+
+
+    async def record_turn(self, session_id: str, history: ChatHistory, messages: List[Tuple[str, str]], llm, model: Optional[str], encoder: Encoder) -> None:
+        """
+        Append the (role, content) messages of a turn, its new messages and the reply, to a session, and update its
+        summary in the background if its history no longer fits.
+        Args:
+            history (ChatHistory): The history the turn was sent.
+            llm: The LLM client of the turn, which also writes the summary.
+        """
+        session = await asyncio.to_thread(self._db, add_messages, session_id, messages)
+        if session is None:
+            raise ChatSessionNotFound(session_id)
+        tokens = history.tokens + sum(self._count(encoder, role, content) for role, content in messages)
+        if not history.complete or tokens > self.max_tokens:
+            self.summarize(session_id, llm, model, encoder)
+
+
+    def summarize(self, session_id: str, llm, model: Optional[str], encoder: Encoder) -> None:
+        """Update the summary of a session in the background, unless it is already being updated."""
+        if session_id in self._tasks:
+            return
+        task = asyncio.get_running_loop().create_task(self._summarize(session_id, llm, model, encoder))
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(session_id, None))
+
+
+    async def wait(self, session_id: str) -> None:
+        """Wait for the summary update of a session to finish."""
+        task = self._tasks.get(session_id)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+
+    async def stop(self, session_id: Optional[str] = None) -> None:
+        """Stop the summary update of a session, or every one in progress, the next turn of their session starts them again."""
+        tasks = [task for key, task in list(self._tasks.items()) if session_id in (None, key)]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    def _db(self, fn, *args, **kwargs):
+        with self.session_factory() as db:
+            return fn(db, *args, **kwargs)
+
+
+    @staticmethod
+    def _count(encoder: Encoder, role: str, content: str) -> int:
+        return encoder.count(role) + encoder.count(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+    async def _summarize(self, session_id: str, llm, model: Optional[str], encoder: Encoder) -> None:
+        threshold = self.max_tokens
+        try:
+            while True:
+                fold = await asyncio.to_thread(self._fold, session_id, encoder, threshold)
+                if fold is None:
+                    return
+                summary, start, end, messages = fold
+                turns = "\n\n".join(f"{role}: {content}" for role, content in messages)
+                text = await llm.aget_completion(
+                    system_prompt=SUMMARY_PROMPT,
+                    user_prompt=f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{turns}",
+                    model=model,
+                    temperature=0.1,
+                    max_tokens=self.summary_tokens,
+                )
+                if not await asyncio.to_thread(self._db, update_summary, session_id, text.strip(), start, end):
+                    return
+                # the first pass waits for max_tokens of history, the next ones catch up to keep_tokens
+                threshold = self.keep_tokens
+        except Exception as e:
+            print(f"[AgentSmith Chatbot] Could not summarize chat session {session_id}: {e}")
+
+
+    def _fold(self, session_id: str, encoder: Encoder, threshold: int) -> Optional[Tuple[Optional[str], int, int, List[Tuple[str, str]]]]:
+        """
+        The oldest messages after the summary of a session to fold into it, at most max_tokens of them so a lagging
+        summary is caught up in several passes, and the latest keep_tokens never.
+        Returns:
+            The (summary, first folded index, index after the last folded, messages), None if the messages after the
+            summary fit within threshold tokens.
+        """
+        with self.session_factory() as db:
+            session = get_session_by_id(db, session_id)
+            if session is None:
+                return None
+            messages = get_messages(db, session_id, session.summarized_upto)
+            counts = [self._count(encoder, message.role, message.content) for message in messages]
+            if sum(counts) <= threshold:
+                return None
+            kept, foldable = 0, len(messages)
+            while foldable > 0 and kept + counts[foldable - 1] <= self.keep_tokens:
+                kept += counts[foldable - 1]
+                foldable -= 1
+            folded, n = 0, 0
+            while n < foldable and (n == 0 or folded + counts[n] <= self.max_tokens):
+                folded += counts[n]
+                n += 1
+            if n == 0:
+                return None
+            return (
+                session.summary,
+                session.summarized_upto,
+                messages[n - 1].index + 1,
+                [(message.role, message.content) for message in messages[:n]],
+            )
+
+
+chat_sessions = ChatSessionManager()
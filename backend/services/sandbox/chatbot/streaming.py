@@ -0,0 +1,229 @@
+import asyncio
+import json
+import time
+from contextlib import aclosing, suppress
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Dict, Optional, TypeVar
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from core.config import STREAM_FRAME_INTERVAL, STREAM_FRAME_MAX_CHARS
+
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+T = TypeVar("T")
+
+
+class ClientDisconnected(Exception):
+    """The client closed the connection before the response started."""
+
+
+async def wait_for_disconnect(receive: Receive) -> None:
+    """Return once the client has closed the connection. The request body must have been read already."""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def unless_disconnected(request: Request, awaitable: Awaitable[T]) -> T:
+    """
+    Await awaitable, e.g. the first chunk of a stream, unless the client disconnects meanwhile: the awaitable is
+    then cancelled, so a local prompt prefill or a provider request nobody waits for any more stops, and
+    ClientDisconnected is raised.
+    """
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request.receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if task.done():
+        return task.result()
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task
+    raise ClientDisconnected()
+
+
+class EventStreamResponse(StreamingResponse):
+    """
+    Server-sent events response that stops as soon as the client disconnects.
+
+    Starlette only watches for the disconnect below ASGI 2.4, above it a disconnect surfaces at the next send, and
+    in both cases the body iterator is left to the garbage collector. Here the disconnect is awaited next to the
+    stream whatever the spec version, and the body iterator is always closed, which closes the LLM streams it
+    reads from: provider responses are closed and local generations are cancelled at their next token.
+    """
+
+    media_type = "text/event-stream"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        streaming = asyncio.ensure_future(self._stream(send))
+        watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await asyncio.wait({streaming, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (streaming, watcher):
+                task.cancel()
+            await asyncio.gather(streaming, watcher, return_exceptions=True)
+            await self.body_iterator.aclose()
+        if streaming.done() and not streaming.cancelled() and streaming.exception() is not None:
+            raise streaming.exception()
+        if self.background is not None:
+            await self.background()
+
+
+    async def _stream(self, send: Send) -> None:
+        try:
+            await self.stream_response(send)
+        except OSError:
+            pass  # the client went away during a send
+
+
+class _End:
+    """Marks the end of the token stream, with the error it failed with if any."""
+
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+async def coalesce(
+    tokens: AsyncIterator[str],
+    interval: float = STREAM_FRAME_INTERVAL,
+    max_chars: int = STREAM_FRAME_MAX_CHARS,
+) -> AsyncGenerator[str, None]:
+    """
+    Gather the tokens of a stream into frames: at most one frame per interval seconds, or sooner once it holds
+    max_chars characters. A token that arrives interval seconds or more after the previous frame is sent at once,
+    so slow streams (and the first token) get no extra latency while fast local models send a frame per interval
+    instead of one per token.
+    Args:
+        tokens (AsyncIterator[str]): The tokens, e.g. the stream_completion of an LLM client.
+        interval (float): Seconds between two frames, 0 sends every token as its own frame.
+        max_chars (int): Characters after which a frame is sent without waiting for the interval.
+    """
+    if interval <= 0:
+        async with aclosing(tokens) as stream:
+            async for token in stream:
+                yield token
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async with aclosing(tokens) as stream:
+                async for token in stream:
+                    queue.put_nowait(token)
+        except Exception as e:
+            queue.put_nowait(_End(e))
+        else:
+            queue.put_nowait(_End())
+
+    loop = asyncio.get_running_loop()
+    reader = loop.create_task(pump())
+    last_frame = float("-inf")
+    try:
+        end = None
+        while end is None:
+            item = await queue.get()
+            if isinstance(item, _End):
+                end = item
+                break
+            parts, size = [item], len(item)
+            while size < max_chars:
+                if not queue.empty():
+                    item = queue.get_nowait()
+                else:
+                    timeout = last_frame + interval - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if isinstance(item, _End):
+                    end = item
+                    break
+                parts.append(item)
+                size += len(item)
+            yield "".join(parts)
+            last_frame = loop.time()
+        if end.error is not None:
+            raise end.error
+    finally:
+        # the consumer went away or the stream ended, the upstream request must not outlive it
+        reader.cancel()
+        with suppress(asyncio.CancelledError):
+            await reader
+
+
+def chat_completion_chunk_to_dict(chunk: Dict) -> Dict:
+    """Convert a chat completion chunk to a dictionary."""
+    converted = {
+        "id": chunk.get("id", ""),
+        "object": chunk.get("object", "chat.completion.chunk"),
+        "created": chunk.get("created", int(time.time())),
+        "model": chunk.get("model", ""),
+        "choices": [
+            {
+                "delta": choice.get("delta", {}),
+                "index": choice.get("index", 0),
+                "finish_reason": choice.get("finish_reason")
+            }
+            for choice in chunk.get("choices", [])
+        ]
+    }
+    if "usage" in chunk:
+        converted["usage"] = chunk["usage"]
+    return converted
+
+
+class ChunkEncoder:
+    """
+    Encodes the chat completion chunks of a stream as SSE frames.
+
+    Only the content of the content chunks changes along a stream, so their JSON is built once and every frame
+    splices its JSON-encoded content in. Other chunks (the final one with the usage) are encoded in full.
+    """
+
+    _MARKER = "\x00content\x00"
+
+    def __init__(self):
+        self._fields = None
+        self._head = self._tail = b""
+
+
+    def encode(self, chunk: Dict) -> bytes:
+        content = self._content(chunk)
+        if content is None:
+            return b"data: " + dumps(chat_completion_chunk_to_dict(chunk)) + b"\n\n"
+        fields = (chunk.get("id"), chunk.get("object"), chunk.get("created"), chunk.get("model"))
+        if fields != self._fields:
+            converted = chat_completion_chunk_to_dict(chunk)
+            converted["choices"][0]["delta"] = {"content": self._MARKER}
+            self._head, self._tail = dumps(converted).split(dumps(self._MARKER))
+            self._head, self._tail = b"data: " + self._head, self._tail + b"\n\n"
+            self._fields = fields
+        return self._head + dumps(content) + self._tail
+
+
+    @staticmethod
+    def _content(chunk: Dict) -> Optional[str]:
+        """The content of a chunk that only carries content, None for any other chunk."""
+        choices = chunk.get("choices")
+        if "usage" in chunk or not choices or len(choices) != 1:
+            return None
+        choice = choices[0]
+        delta = choice.get("delta")
+        if choice.get("finish_reason") is not None or choice.get("index", 0) != 0 or not delta or delta.keys() != {"content"}:
+            return None
+        return delta["content"] if isinstance(delta["content"], str) else None
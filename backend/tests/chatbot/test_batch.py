@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import pytest
+
+
+class StubCompleter:
+    """Answers with the content of the request after as many milliseconds, failing on "fail", and records the peak concurrency of every alias."""
+
+    def __init__(self):
+        self.in_flight = {}
+        self.peak = {}
+
+    async def __call__(self, messages, llm_alias, **kwargs):
+        content = messages[0].content
+        self.in_flight[llm_alias] = self.in_flight.get(llm_alias, 0) + 1
+        self.peak[llm_alias] = max(self.peak.get(llm_alias, 0), self.in_flight[llm_alias])
+        try:
+            if content == "fail":
+                raise RuntimeError("stub failure")
+            await asyncio.sleep(int(content) / 1000)
+            yield {"choices": [{"message": {"role": "assistant", "content": content}}]}
+        finally:
+            self.in_flight[llm_alias] -= 1
+
+
+def test_batch_streams_ndjson_in_completion_order_with_per_item_errors(monkeypatch):
+    pytest.importorskip("llama_cpp")
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from api import chatbot
+    from db.session import get_db
+    from services.llms.concurrency import AliasConcurrency
+    from services.sandbox.chatbot import llm_service
+
+    complete = StubCompleter()
+    monkeypatch.setattr(chatbot.llm_service, "generate_chat_completion", complete)
+    monkeypatch.setattr(llm_service, "alias_concurrency", AliasConcurrency(limit=2))
+    app = FastAPI()
+    app.include_router(chatbot.router)
+    app.dependency_overrides[get_db] = lambda: None
+
+    delays = [200, 20, "fail", 120, 60, 10]
+    requests = [
+        {"messages": [{"role": "user", "content": str(delay)}], "llm_alias": "a" if i % 2 else "b", "llm_type": "remote", "model": "m"}
+        for i, delay in enumerate(delays)
+    ]
+    requests.append({"messages": [], "llm_alias": "a", "llm_type": "remote", "model": "m"})
+    response = TestClient(app).post("/playground/chatbot/chat/batch", json={"requests": requests})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    results = [json.loads(line) for line in response.text.splitlines()]
+    # every request answers once, by its index, the errors of one item do not fail the others
+    assert sorted(result["index"] for result in results) == list(range(len(requests)))
+    errors = {result["index"]: result["error"] for result in results if "error" in result}
+    assert errors == {2: "stub failure", 6: "Messages cannot be empty"}
+    # the answers come as they complete, not in request order
+    answered = [result["response"]["choices"][0]["message"]["content"] for result in results if "response" in result]
+    assert answered[-1] == "200" and answered.index("20") < answered.index("120")
+    # at most 2 requests of an alias ran at once
+    assert complete.peak == {"a": 2, "b": 2}
@@ -0,0 +1,56 @@
+import asyncio
+
+from models.chat import ChatSession, ChatMessage
+from crud.chat import create_session, get_session_by_id
+from services.llms.tokenizer import Encoder
+from services.sandbox.chatbot.sessions import ChatSessionManager
+
+
+class WordEncoder(Encoder):
+    def encode(self, text: str):
+        return text.split()
+
+
+class StubSummarizer:
+    """Summarizes by keeping a count of the turns it was given."""
+
+    def __init__(self):
+        self.prompts = []
+
+    async def aget_completion(self, system_prompt, user_prompt, model, temperature, max_tokens, **kwargs):
+        self.prompts.append(user_prompt)
+        await asyncio.sleep(0.001)
+        return f"summary {len(self.prompts)}"
+
+
+def test_session_history_stays_bounded_and_older_turns_are_summarized(make_session_factory):
+    session_factory = make_session_factory(ChatSession.__table__, ChatMessage.__table__)
+    manager = ChatSessionManager(session_factory, max_tokens=200, keep_tokens=100, summary_tokens=50)
+    encoder, llm = WordEncoder(), StubSummarizer()
+    with session_factory() as db:
+        session_id = create_session(db).id
+
+    async def run():
+        sent = []
+        for turn in range(60):
+            history = await asyncio.to_thread(manager.history, session_id, encoder)
+            sent.append(history)
+            messages = [("user", f"question {turn} " + "word " * 10), ("assistant", f"answer {turn} " + "word " * 20)]
+            await manager.record_turn(session_id, history, messages, llm, "stub", encoder)
+            await manager.wait(session_id)
+        return sent
+
+    sent = asyncio.run(run())
+
+    # the history sent with a turn never outgrows max_tokens, however long the session gets
+    assert max(history.tokens for history in sent) <= 200
+    assert sent[-1].summary is not None and sent[-1].messages
+    # the latest turn is always sent verbatim, the summary picks up where the messages stop
+    assert sent[-1].messages[-1][1].startswith("answer 58")
+    with session_factory() as db:
+        session = get_session_by_id(db, session_id)
+        assert session.message_count == 120
+        assert 0 < session.summarized_upto < session.message_count
+    # summaries are written every max_tokens - keep_tokens tokens of conversation, not on every turn
+    assert 5 <= len(llm.prompts) < 40
+    assert "question 0 " in llm.prompts[0] and "summary 1" in llm.prompts[1]
@@ -0,0 +1,162 @@
+import asyncio
+import json
+from contextlib import aclosing
+
+import pytest
+from starlette.requests import Request
+
+from services.sandbox.chatbot.streaming import (
+    ChunkEncoder, ClientDisconnected, EventStreamResponse, chat_completion_chunk_to_dict, coalesce, unless_disconnected,
+)
+
+
+async def timed_tokens(schedule):
+    """Yield (delay, token) pairs, sleeping delay seconds before each token."""
+    for delay, token in schedule:
+        await asyncio.sleep(delay)
+        yield token
+
+
+async def collect(stream):
+    return [frame async for frame in stream]
+
+
+def test_coalesce_batches_fast_tokens_and_sends_slow_ones_at_once():
+    fast = [(0, "a")] + [(0.001, "b")] * 20
+    frames = asyncio.run(collect(coalesce(timed_tokens(fast), interval=0.2)))
+    # the first token goes out alone, the burst after it shares a frame
+    assert frames == ["a", "b" * 20]
+
+    slow = [(0.05, token) for token in "xyz"]
+    assert asyncio.run(collect(coalesce(timed_tokens(slow), interval=0.01))) == ["x", "y", "z"]
+
+    capped = [(0, "a")] + [(0, "bb")] * 10
+    assert asyncio.run(collect(coalesce(timed_tokens(capped), interval=10, max_chars=6))) == ["a", "bbbbbb", "bbbbbb", "bbbbbb", "bb"]
+
+
+def test_coalesce_forwards_errors_and_closes_the_upstream_stream():
+    closed = []
+
+    async def failing():
+        try:
+            yield "a"
+            await asyncio.sleep(0.01)
+            raise RuntimeError("provider failed")
+        finally:
+            closed.append(True)
+
+    async def run():
+        frames = []
+        try:
+            async for frame in coalesce(failing(), interval=0.001):
+                frames.append(frame)
+        except RuntimeError as e:
+            return frames, str(e)
+
+    assert asyncio.run(run()) == (["a"], "provider failed")
+    assert closed == [True]
+
+    async def endless():
+        try:
+            while True:
+                yield "t"
+                await asyncio.sleep(0.001)
+        finally:
+            closed.append(True)
+
+    async def leave_early():
+        async with aclosing(coalesce(endless(), interval=0.005)) as frames:
+            async for _ in frames:
+                break
+
+    asyncio.run(leave_early())
+    assert closed == [True, True]
+
+
+def test_chunk_encoder_matches_the_full_encoding():
+    encoder = ChunkEncoder()
+    chunk = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 1, "model": "m", "llm_type": "local",
+             "choices": [{"delta": {"content": 'say "hi"\né'}, "index": 0, "finish_reason": None}]}
+    final = {**chunk, "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+             "choices": [{"delta": {}, "index": 0, "finish_reason": "stop"}]}
+    for c in (chunk, chunk, final):
+        frame = encoder.encode(c)
+        assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+        assert json.loads(frame[6:]) == chat_completion_chunk_to_dict(c)
+
+
+class CountingLLMStream:
+    """A token stream that records how many tokens it generated and when it was closed."""
+
+    def __init__(self, delay: float, first_delay: float = 0.0):
+        self.delay = delay
+        self.first_delay = first_delay
+        self.generated = 0
+        self.closed_at = None
+
+    async def stream(self):
+        try:
+            await asyncio.sleep(self.first_delay)
+            while True:
+                self.generated += 1
+                yield f"t{self.generated}"
+                await asyncio.sleep(self.delay)
+        finally:
+            self.closed_at = self.generated
+
+
+@pytest.mark.parametrize("spec_version, disconnect", [("2.3", "message"), ("2.4", "message"), ("2.4", "send_error")])
+def test_event_stream_stops_the_llm_within_a_token_of_the_disconnect(spec_version, disconnect):
+    llm = CountingLLMStream(delay=0.02)
+
+    async def run():
+        disconnected = asyncio.Event()
+        frames = []
+
+        async def body():
+            async with aclosing(coalesce(llm.stream(), interval=0.001)) as stream:
+                async for text in stream:
+                    yield text.encode()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] != "http.response.body" or not message["body"]:
+                return
+            if len(frames) == 3:
+                raise OSError("Connection reset by peer")
+            frames.append(message["body"])
+            if len(frames) == 3 and disconnect == "message":
+                disconnected.set()
+
+        response = EventStreamResponse(body())
+        await response({"type": "http", "asgi": {"spec_version": spec_version}}, receive, send)
+        generated = llm.generated
+        await asyncio.sleep(0.1)  # an LLM left running would generate 5 more tokens meanwhile
+        return frames, generated
+
+    frames, generated = asyncio.run(run())
+    assert frames == [b"t1", b"t2", b"t3"]
+    # the token in flight at the disconnect is the last one generated, and the stream was closed right away
+    assert generated <= 4 and llm.generated == generated and llm.closed_at == generated
+
+
+def test_waiting_for_the_first_token_stops_when_the_client_disconnects():
+    llm = CountingLLMStream(delay=0.01, first_delay=10)
+
+    async def run():
+        async def receive():
+            await asyncio.sleep(0.05)
+            return {"type": "http.disconnect"}
+
+        request = Request({"type": "http", "method": "POST", "headers": []}, receive)
+        stream = llm.stream()
+        started = asyncio.get_running_loop().time()
+        with pytest.raises(ClientDisconnected):
+            await unless_disconnected(request, anext(stream))
+        return asyncio.get_running_loop().time() - started
+
+    assert asyncio.run(run()) < 1
+    assert llm.generated == 0 and llm.closed_at == 0
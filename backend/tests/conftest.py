@@ -0,0 +1,17 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db.base import Base
+
+
+@pytest.fixture
+def make_session_factory(tmp_path):
+    """Opens the sessions of a SQLite database of the test with the given tables, e.g. make_session_factory(ChatSession.__table__)."""
+
+    def make(*tables) -> sessionmaker:
+        engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine, tables=list(tables))
+        return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    return make
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+from models.jobs import BulkJob, BulkJobItem
+from crud.jobs import create_job, get_job_by_id, iter_item_results
+from services.jobs.bulk import BulkJobRunner
+
+
+ITEMS = 50
+
+
+def make_job(session_factory) -> str:
+    items = [
+        (f"req-{i}", {"messages": [{"role": "user", "content": str(i)}], "llm_alias": "stub", "llm_type": "remote", "model": "stub"})
+        for i in range(ITEMS)
+    ]
+    with session_factory() as db:
+        return create_job(db, items, chunk_size=16).id
+
+
+class StubCompleter:
+    """Answers with the content of the request, failing the ones listed, after a short random-ish delay."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+
+    async def __call__(self, request: dict) -> dict:
+        content = request["messages"][0]["content"]
+        self.calls.append(content)
+        await asyncio.sleep(0.001 * (int(content) % 7))
+        if int(content) in self.fail:
+            raise RuntimeError("stub failure")
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+def test_bulk_job_runs_every_item_and_keeps_upload_order(make_session_factory):
+    session_factory = make_session_factory(BulkJob.__table__, BulkJobItem.__table__)
+    job_id = make_job(session_factory)
+    complete = StubCompleter(fail={3, 17})
+    runner = BulkJobRunner(session_factory, complete, max_in_flight=8, flush_size=5, flush_interval=0.05)
+
+    async def run():
+        runner.submit(job_id)
+        await runner.wait(job_id)
+
+    asyncio.run(run())
+
+    assert sorted(complete.calls, key=int) == [str(i) for i in range(ITEMS)]
+    with session_factory() as db:
+        job = get_job_by_id(db, job_id)
+        assert (job.status, job.completed_items, job.failed_items) == ("completed", ITEMS - 2, 2)
+        items = list(iter_item_results(db, job_id, page_size=7))
+    assert [item.custom_id for item in items] == [f"req-{i}" for i in range(ITEMS)]
+    assert items[3].status == "failed" and items[3].error == "stub failure"
+    assert json.dumps(items[4].response) == json.dumps({"choices": [{"message": {"role": "assistant", "content": "4"}}]})
+
+
+def test_bulk_job_resumes_without_rerunning_checkpointed_items(make_session_factory):
+    session_factory = make_session_factory(BulkJob.__table__, BulkJobItem.__table__)
+    job_id = make_job(session_factory)
+    first = StubCompleter()
+
+    async def interrupt():
+        runner = BulkJobRunner(session_factory, first, max_in_flight=4, flush_size=1, flush_interval=0.01)
+        runner.submit(job_id)
+        while len(first.calls) < ITEMS // 2:
+            await asyncio.sleep(0.001)
+        await runner.stop()  # like a shutdown, the job stays running and is resumed on the next start
+
+    asyncio.run(interrupt())
+    with session_factory() as db:
+        job = get_job_by_id(db, job_id)
+        assert job.status == "running"
+        checkpointed = {item.request["messages"][0]["content"] for item in iter_item_results(db, job_id) if item.status == "completed"}
+    assert checkpointed and len(checkpointed) < ITEMS
+
+    second = StubCompleter()
+
+    async def resume():
+        runner = BulkJobRunner(session_factory, second, max_in_flight=4, flush_size=1, flush_interval=0.01)
+        await runner.start()
+        await runner.wait(job_id)
+
+    asyncio.run(resume())
+    assert not checkpointed & set(second.calls)
+    assert checkpointed | set(second.calls) == {str(i) for i in range(ITEMS)}
+    with session_factory() as db:
+        job = get_job_by_id(db, job_id)
+        assert (job.status, job.completed_items, job.failed_items) == ("completed", ITEMS, 0)
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.llms.providers.openai import OpenAIAPILLM
+
+
+TOKENS = ["Hello", " from", " the", " stub", " server"]
+TOKEN_DELAY = 0.05
+CONCURRENT_REQUESTS = 200
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI compatible chat completions endpoint that answers slowly."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for token in TOKENS:
+                time.sleep(TOKEN_DELAY)
+                chunk = {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        time.sleep(TOKEN_DELAY * len(TOKENS))
+        payload = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(TOKENS)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": len(TOKENS), "total_tokens": len(TOKENS) + 1},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_stub_server() -> StubServer:
+    server = StubServer(("127.0.0.1", 0), StubOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_concurrent_streams():
+    server = start_stub_server()
+    llm = OpenAIAPILLM(api_key="test-key", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+
+    async def consume() -> str:
+        return "".join([token async for token in llm.stream_completion("system", "user", model="stub")])
+
+    async def run():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(consume() for _ in range(CONCURRENT_REQUESTS)))
+        return results, time.perf_counter() - start
+
+    try:
+        results, elapsed = asyncio.run(run())
+    finally:
+        server.shutdown()
+
+    # a blocking stream would serialize the requests: 200 * 0.25s
+    assert all(result == "".join(TOKENS) for result in results)
+    assert elapsed < CONCURRENT_REQUESTS * TOKEN_DELAY * len(TOKENS) / 10
+
+
+def test_concurrent_async_completions():
+    server = start_stub_server()
+    llm = OpenAIAPILLM(api_key="test-key", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+
+    async def run():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            llm.aget_completion("system", "user", model="stub") for _ in range(CONCURRENT_REQUESTS)
+        ))
+        return results, time.perf_counter() - start
+
+    try:
+        results, elapsed = asyncio.run(run())
+    finally:
+        server.shutdown()
+
+    assert results == ["".join(TOKENS)] * CONCURRENT_REQUESTS
+    assert elapsed < CONCURRENT_REQUESTS * TOKEN_DELAY * len(TOKENS) / 10
@@ -0,0 +1,52 @@
+import asyncio
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from services.llms.embeddings import EmbeddingCache, EmbeddingService
+
+
+class StubEmbedder:
+    """Embeds a text as [len(text), batch number], and records the batches it was sent."""
+
+    name = "stub"
+    max_embedding_batch = 4
+
+    def __init__(self):
+        self.batches = []
+
+    async def aembed(self, texts, model):
+        self.batches.append(list(texts))
+        await asyncio.sleep(0.01)
+        return [[float(len(text)), float(len(self.batches))] for text in texts]
+
+
+def make_service(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'embeddings.db'}")
+    return EmbeddingService(EmbeddingCache(sessionmaker(bind=engine)))
+
+
+def test_concurrent_requests_share_provider_batches(tmp_path):
+    service, llm = make_service(tmp_path), StubEmbedder()
+
+    async def run():
+        requests = [["a", "bb"], ["ccc"], ["bb", "dddd", "eeeee"]]
+        return await asyncio.gather(*(service.embed(llm, "stub", True, texts, "m") for texts in requests))
+
+    results = asyncio.run(run())
+    # 5 distinct texts in batches of at most 4, the duplicate "bb" is embedded once
+    assert sorted(len(batch) for batch in llm.batches) == [1, 4]
+    assert [[vector[0] for vector in vectors] for vectors, _ in results] == [[1, 2], [3], [2, 4, 5]]
+    assert results[0][0][1] == results[2][0][0]
+
+
+def test_embeddings_are_cached_across_restarts(tmp_path):
+    llm = StubEmbedder()
+    first = asyncio.run(make_service(tmp_path).embed(llm, "stub", True, ["x", "yy"], "m"))
+    assert first[1] == 0 and len(llm.batches) == 1
+
+    # a new service, like after a restart, reads them from the DB
+    again = asyncio.run(make_service(tmp_path).embed(llm, "stub", True, ["yy", "x", "zzz"], "m"))
+    assert again[1] == 2
+    assert llm.batches[1] == ["zzz"]
+    assert again[0][:2] == [first[0][1], first[0][0]]
@@ -0,0 +1,68 @@
+import struct
+
+from services.llms.local.gguf import read_gguf_metadata, is_embedding_model
+
+
+def gguf_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def write_gguf(path, metadata: dict) -> None:
+    """Write the header of a GGUF v3 file with string, uint32 and string-array values, and no tensors."""
+    body = b""
+    for key, value in metadata.items():
+        body += gguf_string(key)
+        if isinstance(value, str):
+            body += struct.pack("<I", 8) + gguf_string(value)
+        elif isinstance(value, int):
+            body += struct.pack("<II", 4, value)
+        else:
+            body += struct.pack("<IIQ", 9, 8, len(value)) + b"".join(gguf_string(item) for item in value)
+    path.write_bytes(b"GGUF" + struct.pack("<IQQ", 3, 0, len(metadata)) + body)
+
+
+def test_reads_the_header_and_detects_embedding_models(tmp_path):
+    write_gguf(tmp_path / "llama.gguf", {
+        "general.architecture": "llama",
+        "llama.context_length": 8192,
+        "tokenizer.ggml.tokens": ["<s>", "</s>", "hello"],
+        "general.name": "Llama",
+    })
+    write_gguf(tmp_path / "bge.gguf", {"general.architecture": "bert", "bert.context_length": 512})
+    write_gguf(tmp_path / "qwen3-embedding.gguf", {"general.architecture": "qwen3", "qwen3.pooling_type": 3})
+
+    metadata = read_gguf_metadata(str(tmp_path / "llama.gguf"))
+    assert metadata["llama.context_length"] == 8192
+    assert metadata["tokenizer.ggml.tokens"] == 3  # arrays are replaced by their length
+    assert metadata["general.name"] == "Llama"
+    assert [is_embedding_model(read_gguf_metadata(str(tmp_path / name))) for name in ("llama.gguf", "bge.gguf", "qwen3-embedding.gguf")] == [False, True, True]
+
+
+def test_model_index_reads_each_header_once(tmp_path, monkeypatch):
+    import services.llms.local.model_index as model_index
+
+    models = tmp_path / "models"
+    models.mkdir()
+    write_gguf(models / "llama.gguf", {"general.architecture": "llama", "llama.context_length": 8192, "general.file_type": 15})
+    write_gguf(models / "big-00001-of-00002.gguf", {"general.architecture": "qwen2", "split.no": 0, "split.count": 2})
+    write_gguf(models / "big-00002-of-00002.gguf", {"general.architecture": "qwen2", "split.no": 1, "split.count": 2})
+    (models / "README.md").write_text("not a model")
+    (models / "broken.gguf").write_bytes(b"GGUF")
+
+    index = model_index.GGUFModelIndex(str(tmp_path / "index.json"))
+    scanned = index.scan(str(models))
+    assert [model.file for model in scanned] == ["big-00001-of-00002.gguf", "llama.gguf"]
+    assert (scanned[1].quantization, scanned[1].context_length, scanned[1].split_count, scanned[0].split_count) == ("Q4_K_M", 8192, 1, 2)
+
+    # unchanged files are served from the index, also by an index loaded from its file after a restart
+    reads = []
+    read = model_index.read_gguf_metadata
+    monkeypatch.setattr(model_index, "read_gguf_metadata", lambda path: reads.append(path) or read(path))
+    restarted = model_index.GGUFModelIndex(str(tmp_path / "index.json"))
+    assert [model.file for model in restarted.scan(str(models))] == ["big-00001-of-00002.gguf", "llama.gguf"]
+    assert reads == []
+
+    write_gguf(models / "llama.gguf", {"general.architecture": "llama", "llama.context_length": 131072})
+    assert restarted.get(str(models / "llama.gguf")).context_length == 131072
+    assert reads == [str(models / "llama.gguf")]
@@ -0,0 +1,118 @@
+import asyncio
+import uuid
+
+from core.config import HEDGE_MIN_SAMPLES
+from services.llms.hedging import HedgedLLM
+
+
+class SlowLLM:
+    """Answers after a delay, and records whether it was cancelled before."""
+
+    def __init__(self, text: str, delay: float):
+        self.text = text
+        self.delay = delay
+        self.calls = 0
+        self.cancelled = 0
+
+    async def aget_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return self.text
+
+    async def stream_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+            for token in self.text.split():
+                yield token
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+
+
+def hedged(primary: SlowLLM, hedge: SlowLLM, max_rate: float = 1.0, latency: float = 0.02) -> HedgedLLM:
+    """A hedged client whose alias has seen enough requests of the given latency to hedge."""
+    llm = HedgedLLM(primary, f"alias-{uuid.uuid4().hex}", percentile=95, max_rate=max_rate, resolve_hedge=lambda: (hedge, {}))
+    for stream in (False, True):
+        llm.tracker.primary[stream].extend([latency] * HEDGE_MIN_SAMPLES)
+    return llm
+
+
+def test_a_slow_primary_is_hedged_and_cancelled_when_the_hedge_wins():
+    primary, hedge = SlowLLM("primary", 1.0), SlowLLM("hedge", 0.0)
+    llm = hedged(primary, hedge)
+
+    async def run():
+        text = await llm.aget_completion("system", "user")
+        await asyncio.sleep(0)
+        return text
+
+    assert asyncio.run(run()) == "hedge"
+    assert (primary.calls, hedge.calls, primary.cancelled) == (1, 1, 1)
+    stats = llm.tracker.stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
+    # the cancelled primary never answered, its elapsed time is not taken for its latency
+    assert list(llm.tracker.primary[False]) == [0.02] * HEDGE_MIN_SAMPLES
+
+
+def test_the_primary_wins_if_it_answers_first_and_the_hedge_is_cancelled():
+    primary, hedge = SlowLLM("primary", 0.1), SlowLLM("hedge", 1.0)
+    llm = hedged(primary, hedge)
+
+    async def run():
+        text = await llm.aget_completion("system", "user")
+        await asyncio.sleep(0)
+        return text
+
+    assert asyncio.run(run()) == "primary"
+    assert (hedge.calls, hedge.cancelled) == (1, 1)
+    stats = llm.tracker.stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 0)
+    assert len(llm.tracker.primary[False]) == HEDGE_MIN_SAMPLES + 1 and llm.tracker.primary[False][-1] >= 0.1
+
+
+def test_fast_requests_are_not_hedged():
+    primary, hedge = SlowLLM("primary", 0.0), SlowLLM("hedge", 0.0)
+    llm = hedged(primary, hedge, latency=1.0)
+
+    assert asyncio.run(llm.aget_completion("system", "user")) == "primary"
+    assert hedge.calls == 0 and llm.tracker.stats()["hedges"] == 0
+
+
+def test_hedges_are_capped_to_the_max_rate():
+    primary, hedge = SlowLLM("primary", 0.05), SlowLLM("hedge", 0.0)
+    # one request in four may be hedged
+    llm = hedged(primary, hedge, max_rate=0.25)
+
+    async def run():
+        answers = []
+        for _ in range(8):
+            # the slow answers of the capped requests would raise the trigger percentile
+            llm.tracker.primary[False].clear()
+            llm.tracker.primary[False].extend([0.02] * HEDGE_MIN_SAMPLES)
+            answers.append(await llm.aget_completion("system", "user"))
+        return answers
+
+    answers = asyncio.run(run())
+
+    assert answers.count("hedge") == 2 and hedge.calls == 2
+    stats = llm.tracker.stats()
+    assert (stats["requests"], stats["hedges"], stats["capped"]) == (8, 2, 6)
+
+
+def test_a_slow_stream_is_hedged_and_the_primary_stopped():
+    primary, hedge = SlowLLM("from the primary", 0.3), SlowLLM("from the hedge", 0.0)
+    llm = hedged(primary, hedge)
+
+    async def run():
+        tokens = [token async for token in llm.stream_completion("system", "user")]
+        await asyncio.sleep(0.4)
+        return tokens
+
+    assert asyncio.run(run()) == ["from", "the", "hedge"]
+    assert primary.cancelled == 1
+    assert llm.tracker.stats()["hedge_wins"] == 1
@@ -0,0 +1,59 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from services.llms.local.workers import BaseInferenceBackend, InferenceWorkerPool
+
+
+class SilentBackend(BaseInferenceBackend):
+    """Accepts every request and never answers, like a hung worker."""
+
+    def __init__(self):
+        self.cancelled = []
+
+    def submit(self, request: dict, sink) -> str:
+        return "request"
+
+    def cancel(self, request_id: str) -> None:
+        self.cancelled.append(request_id)
+
+
+class FailingDispatcherPool(InferenceWorkerPool):
+    """A pool without worker processes whose dispatcher fails once a request is pending."""
+
+    def __init__(self):
+        self.pending = threading.Event()
+        super().__init__(n_workers=0)
+
+    def _dispatch(self) -> None:
+        self.pending.wait()
+        raise RuntimeError("boom")
+
+    def _worker_for(self, request: dict):
+        return SimpleNamespace(index=0)
+
+
+def test_blocking_calls_give_up_and_cancel_after_the_timeout():
+    backend = SilentBackend()
+
+    with pytest.raises(TimeoutError):
+        backend.call({"op": "loaded"}, timeout=0.05)
+    with pytest.raises(TimeoutError):
+        backend.complete({"op": "generate"}, timeout=0.05)
+    assert backend.cancelled == ["request", "request"]
+
+
+def test_a_failed_dispatcher_fails_the_pending_and_later_requests():
+    pool = FailingDispatcherPool()
+    events = []
+    with pool._lock:
+        pool._sinks["pending"] = lambda kind, payload: events.append((kind, payload))
+    pool.pending.set()
+    pool._dispatcher.join(timeout=5)
+
+    assert events == [("error", "Local inference dispatcher failed: boom")]
+    with pytest.raises(RuntimeError, match="dispatcher failed"):
+        pool.call({"op": "load", "model": "m.gguf"}, timeout=5)
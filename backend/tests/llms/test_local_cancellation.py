@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+import uuid
+from contextlib import aclosing
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+import services.llms.local.llama_cpp as llama_cpp_llm
+from services.llms.local.workers import BaseInferenceBackend
+
+
+class TokenLoopBackend(BaseInferenceBackend):
+    """Generates a token every few milliseconds on a thread and checks for cancellation before each one, as the scheduler does."""
+
+    def __init__(self):
+        self.generated = 0
+        self._cancelled = set()
+
+    def submit(self, request: dict, sink) -> str:
+        request_id = uuid.uuid4().hex
+
+        def generate():
+            while request_id not in self._cancelled:
+                self.generated += 1
+                sink("token", f"t{self.generated}")
+                time.sleep(0.005)
+            sink("done", None)
+
+        threading.Thread(target=generate, daemon=True).start()
+        return request_id
+
+    def cancel(self, request_id: str) -> None:
+        self._cancelled.add(request_id)
+
+
+def test_closing_a_local_stream_cancels_the_generation(monkeypatch):
+    backend = TokenLoopBackend()
+    monkeypatch.setattr(llama_cpp_llm, "get_inference_backend", lambda: backend)
+    llm = llama_cpp_llm.LlamaCppLLM("/models")
+
+    async def read_three_tokens():
+        tokens = []
+        async with aclosing(llm.stream_completion("system", "user", "model.gguf")) as stream:
+            async for token in stream:
+                tokens.append(token)
+                if len(tokens) == 3:
+                    break
+        generated = backend.generated
+        await asyncio.sleep(0.1)  # a generation left running would produce 20 more tokens meanwhile
+        return tokens, generated
+
+    tokens, generated = asyncio.run(read_three_tokens())
+    assert tokens == ["t1", "t2", "t3"]
+    assert backend.generated <= generated + 1
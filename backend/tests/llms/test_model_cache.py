@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from services.llms.local import model_cache as model_cache_module
+from services.llms.local.model_cache import LlamaModelCache
+
+
+class FakeLlama:
+    def __init__(self, model_path, **params):
+        self.model_path = model_path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_a_model_pinned_by_get_is_never_evicted(monkeypatch, tmp_path):
+    monkeypatch.setattr(model_cache_module, "Llama", FakeLlama)
+    for name in ["a.gguf", "b.gguf", "c.gguf"]:
+        (tmp_path / name).write_bytes(b"0" * 100)
+    # room for a single model
+    cache = LlamaModelCache(max_bytes=150, idle_timeout=0)
+
+    a = cache.get(str(tmp_path), "a.gguf", pin=True)
+    assert a.in_use == 1
+    # a hit pins in the same critical section that finds the model
+    assert cache.get(str(tmp_path), "a.gguf", pin=True) is a and a.in_use == 2
+
+    b = cache.get(str(tmp_path), "b.gguf")
+    assert not a.llm.closed and [entry.model for entry in cache.loaded()] == ["a.gguf", "b.gguf"]
+
+    cache.unpin(a)
+    cache.unpin(a)
+    cache.get(str(tmp_path), "c.gguf")
+    assert a.llm.closed and b.llm.closed
+    assert [entry.model for entry in cache.loaded()] == ["c.gguf"]
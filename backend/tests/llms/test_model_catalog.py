@@ -0,0 +1,51 @@
+import time
+
+from services.llms.cache.catalog import ModelCatalogCache
+
+
+class FlakyLoader:
+    """Lists the models, then fails the way the providers do: with an empty list, or with an error."""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def wait_for_refresh(cache: ModelCatalogCache):
+    deadline = time.monotonic() + 5
+    while cache._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_failed_or_empty_refresh_keeps_the_cached_catalog():
+    cache = ModelCatalogCache(ttl=0, max_stale=60)
+    loader = FlakyLoader([["gpt-4o", "gpt-4o-mini"], [], RuntimeError("provider down"), ["gpt-4o"], ["gpt-4o"]])
+
+    assert cache.get("openai", True, "models", loader) == ["gpt-4o", "gpt-4o-mini"]
+    # stale: served while a refresh runs in the background, the empty and failed refreshes keep it
+    for _ in range(2):
+        assert cache.get("openai", True, "models", loader) == ["gpt-4o", "gpt-4o-mini"]
+        wait_for_refresh(cache)
+    assert cache.get("openai", True, "models", loader) == ["gpt-4o", "gpt-4o-mini"]
+    wait_for_refresh(cache)
+    assert loader.calls == 4
+    assert cache.get("openai", True, "models", loader) == ["gpt-4o"]
+    wait_for_refresh(cache)
+
+
+def test_empty_catalog_is_not_cached():
+    cache = ModelCatalogCache(ttl=60, max_stale=0)
+    loader = FlakyLoader([[], ["claude"]])
+
+    assert cache.get("anthropic", True, "models", loader) == []
+    # the empty answer was not stored, the next call fetches again
+    assert cache.get("anthropic", True, "models", loader) == ["claude"]
+    assert cache.get("anthropic", True, "models", loader) == ["claude"]
+    assert loader.calls == 2
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.llms.providers.anthropic import AnthropicAPILLM
+from services.llms.providers.openai import OpenAIAPILLM
+
+
+CHAT = [
+    {"role": "user", "content": "Here is a long contract, remember it."},
+    {"role": "assistant", "content": "Done."},
+    {"role": "user", "content": "Who signed it?"},
+]
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    """Answers like the OpenAI API, reports 1024 cached prompt tokens and records the request bodies."""
+
+    bodies = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.bodies.append(body)
+        usage = {"prompt_tokens": 1100, "completion_tokens": 2, "total_tokens": 1102, "prompt_tokens_details": {"cached_tokens": 1024}}
+        if not body.get("stream"):
+            self._send({
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "Alice"}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunks = [{"choices": [{"index": 0, "delta": {"content": "Alice"}, "finish_reason": "stop"}]}]
+        if body.get("stream_options", {}).get("include_usage"):
+            chunks.append({"choices": [], "usage": usage})
+        for chunk in chunks:
+            chunk.update({"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": body["model"]})
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def start_server() -> ThreadingHTTPServer:
+    RecordingHandler.bodies = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_openai_gets_the_chat_as_turns_and_reports_cached_tokens():
+    server = start_server()
+    llm = OpenAIAPILLM(api_key="test-key", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+
+    async def run():
+        usage, streamed_usage = {}, {}
+        text = await llm.aget_completion("system", "user: ...", model="stub", messages=CHAT, usage=usage)
+        tokens = [token async for token in llm.stream_completion("system", "user: ...", model="stub", messages=CHAT, usage=streamed_usage)]
+        return text, tokens, usage, streamed_usage
+
+    try:
+        text, tokens, usage, streamed_usage = asyncio.run(run())
+    finally:
+        server.shutdown()
+
+    assert text == "Alice" and tokens == ["Alice"]
+    for body in RecordingHandler.bodies:
+        assert body["messages"] == [{"role": "system", "content": "system"}, *CHAT]
+    assert usage == streamed_usage == {"prompt_tokens": 1100, "completion_tokens": 2, "cached_tokens": 1024, "cache_creation_tokens": 0}
+
+
+def test_anthropic_marks_the_system_prompt_and_the_chat_as_cacheable():
+    llm = AnthropicAPILLM()
+    # a window of a longer chat that starts with a reply
+    request = llm._prompt("system", "user: ...", CHAT[1:] + [{"role": "assistant", "content": "Alice"}, CHAT[2]])
+
+    assert request["system"] == [{"type": "text", "text": "system", "cache_control": {"type": "ephemeral"}}]
+    assert [message["role"] for message in request["messages"]] == ["user", "assistant", "user"]
+    assert request["messages"][-1]["content"] == [{"type": "text", "text": "Who signed it?", "cache_control": {"type": "ephemeral"}}]
+
+    usage = {}
+    llm._record_usage(usage, SimpleNamespace(input_tokens=12, output_tokens=2, cache_read_input_tokens=1024, cache_creation_input_tokens=30))
+    # input_tokens leaves out the cached prompt tokens, the prompt tokens include them
+    assert usage == {"prompt_tokens": 1066, "completion_tokens": 2, "cached_tokens": 1024, "cache_creation_tokens": 30}
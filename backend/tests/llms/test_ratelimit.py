@@ -0,0 +1,121 @@
+import asyncio
+import uuid
+
+import pytest
+
+from services.llms import ratelimit
+from services.llms.base import LLMProviderError
+from services.llms.ratelimit import AliasLimiter, RateLimitedLLM, RateLimitQueueFull, TokenBucket, backoff_delay
+
+
+def test_the_token_bucket_refills_continuously_and_overdrafts_wait():
+    bucket = TokenBucket(per_minute=60)
+    bucket.updated = 0.0
+
+    assert bucket.reserve(60, now=0.0) == 0.0
+    # one token per second, an overdraft of 3 waits 3 seconds
+    assert bucket.reserve(3, now=0.0) == pytest.approx(3.0)
+    assert bucket.wait_for(1, now=3.0) == pytest.approx(1.0)
+    assert bucket.wait_for(1, now=4.0) == pytest.approx(0.0)
+    # a request larger than the bucket waits for a full bucket rather than forever
+    assert bucket.wait_for(1000, now=4.0) == pytest.approx(59.0)
+
+    bucket.refund(3, now=4.0)
+    assert bucket.level == pytest.approx(4.0)
+    assert TokenBucket(per_minute=0).reserve(10**6, now=0.0) == 0.0
+
+
+def test_a_full_queue_refuses_and_a_cancelled_waiter_gives_back_its_reservation():
+    limiter = AliasLimiter(rpm=1, tpm=600, max_queue=1)
+
+    async def run():
+        await limiter.acquire(100)
+        # waits about a minute for the next request slot
+        waiter = asyncio.ensure_future(limiter.acquire(100))
+        await asyncio.sleep(0.01)
+        assert limiter.queue_depth == 1
+        with pytest.raises(RateLimitQueueFull):
+            await limiter.acquire(100)
+
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(run())
+
+    stats = limiter.stats()
+    assert (stats["queue_depth"], stats["queued"], stats["rejected"]) == (0, 1, 1)
+    # only the first request holds capacity
+    assert limiter.requests.level == pytest.approx(0.0, abs=0.01)
+    assert limiter.tokens.level == pytest.approx(500.0, abs=1)
+
+
+def test_a_full_queue_answers_429(monkeypatch):
+    pytest.importorskip("llama_cpp")
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from api import chatbot
+    from db.session import get_db
+
+    async def queue_full(**kwargs):
+        raise RateLimitQueueFull("Rate limit queue is full (1 requests waiting)")
+        yield
+
+    monkeypatch.setattr(chatbot.llm_service, "generate_chat_completion", queue_full)
+    app = FastAPI()
+    app.include_router(chatbot.router)
+    app.dependency_overrides[get_db] = lambda: None
+
+    response = TestClient(app).post("/playground/chatbot/chat", json={"messages": [{"role": "user", "content": "hi"}], "llm_alias": "a", "llm_type": "remote", "model": "m"})
+
+    assert response.status_code == 429
+
+
+class FlakyLLM:
+    """Fails with the given errors, then answers."""
+
+    name = "stub"
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def aget_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "answer"
+
+
+def test_retryable_errors_are_retried_after_the_backoff(monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_BACKOFF_BASE", 0.001)
+    sleeps = []
+    real_sleep = asyncio.sleep
+
+    async def recording_sleep(delay):
+        sleeps.append(delay)
+        await real_sleep(0)
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", recording_sleep)
+
+    limiter = AliasLimiter(rpm=0, tpm=0, max_queue=10)
+    stub = FlakyLLM([LLMProviderError("rate limited", status_code=429, retry_after=2.5), LLMProviderError("unavailable", status_code=503)])
+    llm = RateLimitedLLM(stub, f"alias-{uuid.uuid4().hex}", limiter, max_retries=4)
+
+    assert asyncio.run(llm.aget_completion("system", "user", model="m")) == "answer"
+    assert stub.calls == 3 and limiter.stats()["retries"] == 2
+    # the first retry waits for the Retry-After of the provider, the second for the jittered backoff
+    assert sleeps[0] == 2.5 and sleeps[1] <= 0.002
+
+    # client errors are not retried, and neither are the errors past max_retries
+    stub = FlakyLLM([LLMProviderError("bad request", status_code=400)])
+    with pytest.raises(LLMProviderError, match="bad request"):
+        asyncio.run(RateLimitedLLM(stub, "alias", limiter).aget_completion("system", "user", model="m"))
+    stub = FlakyLLM([LLMProviderError("unavailable", status_code=503)] * 3)
+    with pytest.raises(LLMProviderError, match="unavailable"):
+        asyncio.run(RateLimitedLLM(stub, "alias", limiter, max_retries=2).aget_completion("system", "user", model="m"))
+    assert stub.calls == 3
+
+
+def test_the_backoff_is_never_shorter_than_retry_after():
+    error = LLMProviderError("rate limited", status_code=429, retry_after=5)
+    assert all(backoff_delay(attempt, error) >= 5 for attempt in range(10))
+    assert all(0 <= backoff_delay(attempt, RuntimeError()) <= ratelimit.RATE_LIMIT_BACKOFF_MAX for attempt in range(10))
@@ -0,0 +1,77 @@
+import asyncio
+import uuid
+
+from models.llms import LLMRemote, LLMLocal
+from crud.llms import create_remote_llm, update_remote_llm_by_alias, delete_remote_llm_by_alias, create_local_llm, update_local_llm_by_alias
+from services.llms.registry import LLMClientRegistry, llm_registry
+
+
+class StubClient:
+    def __init__(self):
+        self.closed = False
+        self.aclosed = False
+
+    def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.aclosed = True
+
+
+def test_updating_or_deleting_an_alias_drops_and_closes_its_client(make_session_factory, tmp_path):
+    session_factory = make_session_factory(LLMRemote.__table__, LLMLocal.__table__)
+    alias, renamed = f"gpt-{uuid.uuid4().hex}", f"gpt-{uuid.uuid4().hex}"
+    invalidated = []
+    llm_registry.add_invalidation_listener(lambda alias, is_remote: invalidated.append((alias, is_remote)))
+
+    with session_factory() as db:
+        create_remote_llm(db, alias, "openai", "key")
+        create_local_llm(db, alias, "llama-cpp", str(tmp_path))
+
+        clients = [StubClient() for _ in range(3)]
+        llm_registry.put(alias, "openai", True, clients[0])
+        llm_registry.put(alias, "llama-cpp", False, clients[1])
+        update_remote_llm_by_alias(db, alias, renamed, "new-key")
+        assert llm_registry.get(alias, True) is None and clients[0].closed
+        # the local alias of the same name is untouched
+        assert llm_registry.get(alias, False) is clients[1] and not clients[1].closed
+
+        update_local_llm_by_alias(db, alias, "llama-cpp", str(tmp_path))
+        assert llm_registry.get(alias, False) is None and clients[1].closed
+
+        llm_registry.put(renamed, "openai", True, clients[2])
+        delete_remote_llm_by_alias(db, renamed)
+        assert llm_registry.get(renamed, True) is None and clients[2].closed
+
+    assert {(alias, True), (renamed, True), (alias, False)} <= set(invalidated)
+
+
+def test_async_clients_are_closed_on_their_event_loop_after_the_grace_period():
+    registry = LLMClientRegistry(close_grace=0.05)
+    client = StubClient()
+
+    async def run():
+        registry.put("alias", "openai", True, client)
+        registry.invalidate("alias", True)
+        await asyncio.sleep(0)
+        # requests still using the client have the grace period to finish
+        assert not client.aclosed
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+
+    assert client.aclosed
+
+
+def test_a_client_built_before_an_invalidation_is_not_registered():
+    registry = LLMClientRegistry(close_grace=0)
+    stale, fresh = StubClient(), StubClient()
+
+    generation = registry.generation("alias", True)
+    # the alias is updated while a request builds its client from the previous settings
+    registry.invalidate("alias", True)
+    assert registry.put("alias", "openai", True, stale, generation) is stale
+    assert registry.get("alias", True) is None and stale.closed
+
+    assert registry.put("alias", "openai", True, fresh, registry.generation("alias", True)) is fresh
+    assert registry.get("alias", True) is fresh and not fresh.closed
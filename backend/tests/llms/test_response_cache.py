@@ -0,0 +1,110 @@
+import asyncio
+import time
+from contextlib import aclosing
+
+from models.cache import LLMResponseCacheEntry
+from services.llms.cache import response
+from services.llms.cache.response import CachedLLM, ResponseCache
+
+
+class StubLLM:
+    """Streams a few tokens with a pause before each, and counts the requests that reached it."""
+
+    name = "stub"
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.calls = 0
+        self.closed = 0
+
+    async def aget_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return "one two three"
+
+    async def stream_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls += 1
+        try:
+            for token in ["one ", "two ", "three"]:
+                await asyncio.sleep(self.delay)
+                yield token
+        finally:
+            self.closed += 1
+
+
+def use_cache(monkeypatch, make_session_factory, **kwargs) -> ResponseCache:
+    cache = ResponseCache(session_factory=make_session_factory(LLMResponseCacheEntry.__table__), **kwargs)
+    monkeypatch.setattr(response, "response_cache", cache)
+    return cache
+
+
+def test_temperature_0_never_reaches_the_provider_twice(monkeypatch, make_session_factory):
+    use_cache(monkeypatch, make_session_factory)
+    stub = StubLLM()
+    llm = CachedLLM(stub, "alias", True)
+
+    async def stream():
+        return "".join([token async for token in llm.stream_completion("system", "user", model="m", temperature=0)])
+
+    async def run():
+        concurrent = await asyncio.gather(
+            *[llm.aget_completion("system", "user", model="m", temperature=0) for _ in range(5)],
+            *[stream() for _ in range(5)],
+        )
+        return concurrent + [await llm.aget_completion("system", "user", model="m", temperature=0), await stream()]
+
+    answers = asyncio.run(run())
+
+    assert stub.calls == 1
+    assert set(answers) == {"one two three"} and len(answers) == 12
+
+
+def test_a_paused_consumer_does_not_hold_back_the_other_callers(monkeypatch, make_session_factory):
+    use_cache(monkeypatch, make_session_factory)
+    stub = StubLLM()
+    llm = CachedLLM(stub, "alias", True)
+
+    async def run():
+        async with aclosing(llm.stream_completion("system", "user", model="m")) as first:
+            assert await anext(first) == "one "
+            # the first caller stops reading, the second one still gets the whole response as it is produced
+            second = "".join([token async for token in llm.stream_completion("system", "user", model="m")])
+            return second, [token async for token in first]
+
+    second, rest = asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+    assert second == "one two three" and rest == ["two ", "three"]
+    assert stub.calls == 1
+
+
+def test_the_provider_stream_is_closed_when_every_caller_left(monkeypatch, make_session_factory):
+    cache = use_cache(monkeypatch, make_session_factory)
+    stub = StubLLM()
+    llm = CachedLLM(stub, "alias", True)
+
+    async def run():
+        async with aclosing(llm.stream_completion("system", "user", model="m")) as stream:
+            await anext(stream)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+
+    assert stub.closed == 1
+    assert cache.stats()["stores"] == 0 and not cache._flights
+
+
+def test_expired_responses_are_purged_at_most_every_purge_interval(monkeypatch, make_session_factory):
+    cache = use_cache(monkeypatch, make_session_factory, purge_interval=3600)
+
+    def rows():
+        with cache.session_factory() as db:
+            return db.query(LLMResponseCacheEntry).count()
+
+    cache.store("a", "alias", "m", ["a"], ttl=0.01)
+    time.sleep(0.02)
+    cache.store("b", "alias", "m", ["b"], ttl=None)
+    assert rows() == 2  # the first store purged, the expired response waits for the next purge
+
+    cache.purge_interval = 0
+    cache.store("c", "alias", "m", ["c"], ttl=None)
+    assert rows() == 2
@@ -0,0 +1,118 @@
+import asyncio
+import uuid
+
+import pytest
+
+from core.config import ROUTER_BREAKER_FAILURES
+from services.llms import router
+from services.llms.router import AllTargetsFailed, RouterLLM, RouterTarget, router_health
+
+
+class StubLLM:
+    """Answers with its name after a delay, or fails while failing is set."""
+
+    def __init__(self, name: str, delay: float = 0.0, failing: bool = False):
+        self.name = name
+        self.delay = delay
+        self.failing = failing
+        self.calls = []
+
+    async def aget_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+        if self.failing:
+            raise RuntimeError(f"{self.name} is down")
+        return self.name
+
+    def get_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls.append(kwargs)
+        if self.failing:
+            raise RuntimeError(f"{self.name} is down")
+        return self.name
+
+
+def make_router(*clients: StubLLM) -> RouterLLM:
+    """A router over the clients, whose targets are new to the process-wide health stats."""
+    suffix = uuid.uuid4().hex
+    targets = [RouterTarget(f"{client.name}-{suffix}", True, f"model-{client.name}") for client in clients]
+    by_alias = {target.alias: client for target, client in zip(targets, clients)}
+    return RouterLLM("router", targets, lambda target: by_alias[target.alias])
+
+
+def test_failed_requests_fail_over_in_order_with_the_target_model():
+    first, second, third = StubLLM("first", failing=True), StubLLM("second"), StubLLM("third")
+    llm = make_router(first, second, third)
+
+    assert asyncio.run(llm.aget_completion("system", "user", model="ignored", conversation_id="c")) == "second"
+    assert third.calls == []
+    # the model of the target replaces the model of the request, local only kwargs do not reach remote targets
+    assert second.calls == [{"model": "model-second"}]
+
+    first.failing = second.failing = third.failing = True
+    with pytest.raises(AllTargetsFailed) as error:
+        llm.get_completion("system", "user")
+    assert all(client.name in str(error.value) for client in (first, second, third))
+
+
+def test_the_breaker_opens_half_opens_and_closes(monkeypatch):
+    primary = StubLLM("primary", failing=True)
+    llm = make_router(primary)
+    target = llm.targets[0]
+
+    for _ in range(ROUTER_BREAKER_FAILURES):
+        with pytest.raises(AllTargetsFailed):
+            llm.get_completion("system", "user")
+    assert router_health.stats(target)["breaker"] == "open"
+    # an open breaker skips the target
+    with pytest.raises(AllTargetsFailed, match="no target available"):
+        llm.get_completion("system", "user")
+    assert len(primary.calls) == ROUTER_BREAKER_FAILURES
+
+    # after the cooldown a single probe goes through, a failed probe opens the breaker again
+    monkeypatch.setattr(router, "ROUTER_BREAKER_COOLDOWN", 0)
+    assert router_health.stats(target)["breaker"] == "half_open"
+    assert router_health.acquire(target) and not router_health.acquire(target)
+    router_health.release(target)
+    with pytest.raises(AllTargetsFailed):
+        llm.get_completion("system", "user")
+    monkeypatch.setattr(router, "ROUTER_BREAKER_COOLDOWN", 30)
+    assert router_health.stats(target)["breaker"] == "open"
+
+    # a successful probe closes it
+    monkeypatch.setattr(router, "ROUTER_BREAKER_COOLDOWN", 0)
+    primary.failing = False
+    assert llm.get_completion("system", "user") == "primary"
+    monkeypatch.setattr(router, "ROUTER_BREAKER_COOLDOWN", 30)
+    assert router_health.stats(target)["breaker"] == "closed"
+
+
+def test_an_interrupted_request_gives_back_its_probe(monkeypatch):
+    primary = StubLLM("primary")
+    llm = make_router(primary)
+    target = llm.targets[0]
+    monkeypatch.setattr(router, "ROUTER_BREAKER_COOLDOWN", 0)
+    for _ in range(ROUTER_BREAKER_FAILURES):
+        router_health.record_failure(target)
+
+    def interrupted(system_prompt, user_prompt, **kwargs):
+        raise KeyboardInterrupt
+    primary.get_completion = interrupted
+
+    with pytest.raises(KeyboardInterrupt):
+        llm.get_completion("system", "user")
+    # the probe was released, the next request may probe the target
+    assert router_health.acquire(target)
+
+
+def test_targets_are_ranked_by_latency_and_errors():
+    slow, fast, flaky = StubLLM("slow"), StubLLM("fast"), StubLLM("flaky")
+    llm = make_router(slow, fast, flaky)
+    for target, latency in zip(llm.targets, [0.5, 0.01, 0.01]):
+        router_health.record_latency(target, latency, stream=False)
+        router_health.record_success(target)
+    # as fast as the fast target, but it failed one request in two
+    router_health.record_failure(llm.targets[2])
+
+    assert [target.alias.split("-")[0] for target in llm.ranked_targets()] == ["fast", "flaky", "slow"]
+    assert asyncio.run(llm.aget_completion("system", "user")) == "fast"
+    assert slow.calls == flaky.calls == []
@@ -0,0 +1,223 @@
+import ctypes
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from services.llms.local import scheduler
+from services.llms.local.scheduler import BatchScheduler, Sequence
+from services.llms.local.speculative import PromptLookupDrafter
+from services.llms.local.state_cache import LlamaStateCache
+
+
+N_VOCAB = 64
+EOG = 0
+
+
+class FakeBatch:
+    """The llama_batch of the scheduler, as Python lists."""
+
+    def __init__(self, n_tokens, embd, n_seq_max, verbose):
+        self.batch = SimpleNamespace(
+            token=[0] * n_tokens, pos=[0] * n_tokens, n_seq_id=[0] * n_tokens, seq_id=[[0] for _ in range(n_tokens)],
+            logits=[False] * n_tokens, n_tokens=0,
+        )
+
+    def reset(self):
+        self.batch.n_tokens = 0
+
+    def n_tokens(self):
+        return self.batch.n_tokens
+
+    def close(self):
+        pass
+
+
+class FakeContext:
+    """
+    A model that always continues a token with the next one. Its KV cache holds the tokens of every sequence, and a
+    token evaluated anywhere but right after the cached tokens of its sequence fails the decode.
+    """
+
+    def __init__(self, model, params, verbose):
+        self.ctx = self
+        self.kv = {}  # sequence -> tokens
+        self.decodes = []  # per llama_decode: the (sequence, position, token) evaluated
+        self._logits = {}
+
+    def kv_cache_seq_rm(self, seq, start, end):
+        if start < 0:
+            self.kv[seq] = []
+        else:
+            del self.kv.setdefault(seq, [])[start:]
+
+    def decode(self, fake_batch):
+        batch, evaluated, self._logits = fake_batch.batch, [], {}
+        for i in range(batch.n_tokens):
+            seq, pos, token = batch.seq_id[i][0], batch.pos[i], batch.token[i]
+            kv = self.kv.setdefault(seq, [])
+            if pos != len(kv):
+                raise RuntimeError(f"token at position {pos} of sequence {seq}, which holds {len(kv)} tokens")
+            kv.append(token)
+            evaluated.append((seq, pos, token))
+            if batch.logits[i]:
+                row = (ctypes.c_float * N_VOCAB)()
+                row[(token + 1) % N_VOCAB] = 1.0
+                self._logits[i] = row
+        self.decodes.append(evaluated)
+
+    def get_logits_ith(self, i):
+        return ctypes.cast(self._logits[i], ctypes.POINTER(ctypes.c_float))
+
+    def close(self):
+        pass
+
+
+class FakeLlama:
+    verbose = False
+    context_params = None
+    _model = SimpleNamespace(vocab=None)
+
+    def n_vocab(self):
+        return N_VOCAB
+
+    def detokenize(self, tokens):
+        return b"".join(b"%d " % token for token in tokens)
+
+
+@pytest.fixture
+def fake_llama(monkeypatch):
+    """Runs the scheduler on FakeContext, its states are the tokens of the KV cache of a sequence."""
+
+    def get_size(ctx, seq):
+        return 4 * len(ctx.kv.get(seq, []))
+
+    def get_data(ctx, buffer, size, seq):
+        data = b"".join(token.to_bytes(4, "little") for token in ctx.kv.get(seq, []))
+        ctypes.memmove(buffer, data, len(data))
+        return len(data)
+
+    def set_data(ctx, buffer, size, seq):
+        data = ctypes.string_at(buffer, size)
+        ctx.kv[seq] = [int.from_bytes(data[i:i + 4], "little") for i in range(0, size, 4)]
+        return size
+
+    monkeypatch.setattr(scheduler.llama_cpp, "llama_context_params", SimpleNamespace(from_buffer_copy=lambda _: SimpleNamespace(n_ubatch=512)), raising=False)
+    monkeypatch.setattr(scheduler.llama_cpp, "llama_token_is_eog", lambda vocab, token: token == EOG, raising=False)
+    monkeypatch.setattr(scheduler.llama_cpp, "llama_state_seq_get_size", get_size, raising=False)
+    monkeypatch.setattr(scheduler.llama_cpp, "llama_state_seq_get_data", get_data, raising=False)
+    monkeypatch.setattr(scheduler.llama_cpp, "llama_state_seq_set_data", set_data, raising=False)
+    monkeypatch.setattr(scheduler.internals, "LlamaContext", FakeContext, raising=False)
+    monkeypatch.setattr(scheduler.internals, "LlamaBatch", FakeBatch, raising=False)
+    return FakeLlama()
+
+
+def generate(batch_scheduler: BatchScheduler, prompts, max_tokens: int, **kwargs) -> list:
+    """Submit every prompt at once and return the text generated for each, or its error."""
+    texts = [[] for _ in prompts]
+    finished = threading.Semaphore(0)
+
+    def emit(request_id, kind, payload):
+        if kind == "token":
+            texts[int(request_id)].append(payload)
+        else:
+            if kind == "error":
+                texts[int(request_id)] = [f"error: {payload}"]
+            finished.release()
+
+    for i, prompt in enumerate(prompts):
+        batch_scheduler.submit(Sequence(
+            request_id=str(i), tokens=list(prompt), max_tokens=max_tokens, temperature=0, emit=emit,
+            is_cancelled=lambda: False, **kwargs,
+        ))
+    for _ in prompts:
+        assert finished.acquire(timeout=10)
+    return ["".join(text) for text in texts]
+
+
+def counting(start: int, n: int) -> str:
+    return "".join(f"{token % N_VOCAB} " for token in range(start, start + n))
+
+
+def test_concurrent_sequences_are_decoded_together_and_admitted_as_slots_free(fake_llama):
+    batch_scheduler = BatchScheduler(fake_llama, n_ctx=64, max_sequences=2, max_batch_tokens=8, prefill_chunk=4)
+    prompts = [[1] * length + [last] for length, last in ((1, 10), (9, 20), (5, 30), (13, 40), (3, 58))]
+
+    try:
+        texts = generate(batch_scheduler, prompts, max_tokens=6)
+    finally:
+        batch_scheduler.close()
+
+    # every sequence continues its own prompt, the one that reaches the end-of-generation token stops there
+    assert texts == [counting(11, 6), counting(21, 6), counting(31, 6), counting(41, 6), counting(59, 5)]
+    decodes = batch_scheduler._ctx.decodes
+    assert all(len(evaluated) <= 8 for evaluated in decodes)
+    assert max(len({seq for seq, _, _ in evaluated}) for evaluated in decodes) == 2
+    # a newly admitted prompt is prefilled in chunks, next to the token of the sequence that is generating
+    assert any(
+        sorted(tokens) == [1, 4]
+        for tokens in ([sum(1 for seq, _, _ in evaluated if seq == slot) for slot in (0, 1)] for evaluated in decodes)
+    )
+    assert batch_scheduler.active == 0
+
+
+def test_a_cached_prompt_prefix_is_restored_instead_of_evaluated(fake_llama):
+    prefix_cache = LlamaStateCache(max_bytes=10**6)
+    batch_scheduler = BatchScheduler(fake_llama, n_ctx=64, max_sequences=1, prefill_chunk=8, prefix_cache=prefix_cache)
+    prefix = [1] * 19 + [2]
+
+    try:
+        first = generate(batch_scheduler, [prefix + [5]], max_tokens=3, prefix_len=len(prefix))
+        assert prefix_cache.get(batch_scheduler._namespace, LlamaStateCache.prefix_key(prefix)).tokens == tuple(prefix)
+        n_decodes = len(batch_scheduler._ctx.decodes)
+        second = generate(batch_scheduler, [prefix + [7, 30]], max_tokens=3, prefix_len=len(prefix))
+    finally:
+        batch_scheduler.close()
+
+    assert (first, second) == ([counting(6, 3)], [counting(31, 3)])
+    # the second prompt only evaluates the tokens after the prefix
+    assert min(pos for evaluated in batch_scheduler._ctx.decodes[n_decodes:] for _, pos, _ in evaluated) == len(prefix)
+
+
+def test_the_next_turn_of_a_conversation_resumes_from_the_saved_state(fake_llama):
+    session_cache = LlamaStateCache(max_bytes=10**6)
+    batch_scheduler = BatchScheduler(fake_llama, n_ctx=64, max_sequences=1, prefill_chunk=8, session_cache=session_cache)
+    prompt = [1] * 19 + [2, 5]
+    key = batch_scheduler._session_key(SimpleNamespace(session_id="conversation"))
+
+    try:
+        first = generate(batch_scheduler, [prompt], max_tokens=3, session_id="conversation")
+        # the state is stored off the decode thread, once the reply was delivered
+        deadline = time.monotonic() + 5
+        while session_cache.get(batch_scheduler._namespace, key) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        snapshot = session_cache.get(batch_scheduler._namespace, key)
+        n_decodes = len(batch_scheduler._ctx.decodes)
+        second = generate(batch_scheduler, [prompt + [6, 7, 8, 40, 50]], max_tokens=3, session_id="conversation")
+    finally:
+        batch_scheduler.close()
+
+    assert (first, second) == ([counting(6, 3)], [counting(51, 3)])
+    # the last sampled token of a turn is never evaluated, the next turn evaluates it with its new tokens
+    assert snapshot.tokens == tuple(prompt + [6, 7])
+    assert [token for evaluated in batch_scheduler._ctx.decodes[n_decodes:] for _, _, token in evaluated][:3] == [8, 40, 50]
+
+
+def test_accepted_draft_tokens_speed_up_decoding_without_changing_the_output(fake_llama):
+    # the reply counts on from the prompt, which it quotes
+    prompt = list(range(1, 11)) + list(range(1, 6))
+    outputs, steps = [], []
+    for drafter in (None, PromptLookupDrafter(draft_tokens=4, ngram_max=3)):
+        batch_scheduler = BatchScheduler(fake_llama, n_ctx=64, max_sequences=1, drafter=drafter)
+        try:
+            outputs.append(generate(batch_scheduler, [prompt], max_tokens=8))
+        finally:
+            batch_scheduler.close()
+        steps.append(batch_scheduler.stats["steps"])
+
+    assert outputs == [[counting(6, 8)], [counting(6, 8)]]
+    assert batch_scheduler.stats["accepted"] > 0
+    assert steps[1] < steps[0]
@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+import numpy as np
+
+from services.llms.cache import semantic
+from services.llms.cache.semantic import SemanticCache, SemanticCachedLLM, SemanticEntry
+from services.llms.providers.openai import OpenAIAPILLM
+
+
+VOCABULARY = ["capital", "france", "paris", "germany", "weather", "today", "what", "is", "the", "of"]
+
+
+def embed(texts):
+    """Bag of words over a small vocabulary, prompts sharing most of their words are close."""
+    return [[text.lower().replace("?", "").split().count(word) for word in VOCABULARY] for text in texts]
+
+
+class StubLLM:
+    name = "stub"
+
+    def __init__(self):
+        self.calls = []
+
+    async def aget_completion(self, system_prompt, user_prompt, **kwargs):
+        self.calls.append((user_prompt, kwargs))
+        return f"answer {len(self.calls)}"
+
+
+def use_cache(monkeypatch, **kwargs) -> SemanticCache:
+    cache = SemanticCache(embedder=embed, **kwargs)
+    monkeypatch.setattr(semantic, "semantic_cache", cache)
+    return cache
+
+
+def test_similar_prompts_are_answered_from_the_cache_above_the_threshold(monkeypatch):
+    cache = use_cache(monkeypatch)
+    stub = StubLLM()
+    llm = SemanticCachedLLM(stub, "alias", True, threshold=0.9)
+
+    async def run():
+        return [
+            await llm.aget_completion("system", "What is the capital of France?", model="m", temperature=0),
+            await llm.aget_completion("system", "what is the capital of france", model="m", temperature=0),
+            # below the threshold
+            await llm.aget_completion("system", "What is the weather today?", model="m", temperature=0),
+            # other system prompt, temperature or max_tokens: other scope
+            await llm.aget_completion("other", "What is the capital of France?", model="m", temperature=0),
+            await llm.aget_completion("system", "What is the capital of France?", model="m", temperature=1),
+            await llm.aget_completion("system", "What is the capital of France?", model="m", temperature=0, max_tokens=5),
+            # the usage dict is filled by the provider and does not change the scope
+            await llm.aget_completion("system", "What is the capital of France?", model="m", temperature=0, usage={}),
+        ]
+
+    answers = asyncio.run(run())
+
+    assert answers == ["answer 1", "answer 1", "answer 2", "answer 3", "answer 4", "answer 5", "answer 1"]
+    assert len(stub.calls) == 5
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 5, 5)
+
+
+def test_least_recently_used_entries_are_evicted_and_expired_ones_dropped(monkeypatch):
+    cache = use_cache(monkeypatch, max_entries=2, ttl=60)
+    vectors = {prompt: cache.embed(prompt) for prompt in ["capital of france", "capital of germany", "weather today"]}
+    scope = cache.make_scope("alias", "stub", "m", "system")
+
+    for prompt in ["capital of france", "capital of germany"]:
+        cache.store(scope, "alias", "m", vectors[prompt], SemanticEntry(alias="alias", prompt=prompt, chunks=[prompt], latency=1.0))
+    # france is used last, germany is evicted by the third entry
+    assert cache.lookup(scope, "alias", vectors["capital of france"], 0.99).prompt == "capital of france"
+    cache.store(scope, "alias", "m", vectors["weather today"], SemanticEntry(alias="alias", prompt="weather today", chunks=[], latency=1.0))
+
+    assert cache.lookup(scope, "alias", vectors["capital of germany"], 0.99) is None
+    assert cache.lookup(scope, "alias", vectors["capital of france"], 0.99) is not None
+    assert cache.stats()["entries"] == 2
+
+    cache.ttl = 1
+    for entry in cache._scopes[scope].entries:
+        entry.created_at = time.time() - 2
+    assert cache.lookup(scope, "alias", vectors["capital of france"], 0.99) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_entries_are_dropped_when_the_alias_or_its_model_changes(monkeypatch):
+    cache = use_cache(monkeypatch)
+    vector = cache.embed("capital of france")
+    scopes = {alias: cache.make_scope(alias, "stub", "m", "system") for alias in ["a", "b"]}
+    for alias, scope in scopes.items():
+        cache.check_model(alias, "m", "v1")
+        cache.store(scope, alias, "m", vector, SemanticEntry(alias=alias, prompt="capital of france", chunks=["Paris"], latency=1.0))
+
+    cache.invalidate("a")
+    assert cache.lookup(scopes["a"], "a", vector, 0.9) is None
+    assert cache.lookup(scopes["b"], "b", vector, 0.9) is not None
+
+    # same fingerprint: kept, new fingerprint (e.g. the GGUF file was replaced): dropped
+    cache.check_model("b", "m", "v1")
+    assert cache.lookup(scopes["b"], "b", vector, 0.9) is not None
+    cache.check_model("b", "m", "v2")
+    assert cache.lookup(scopes["b"], "b", vector, 0.9) is None
+    assert np.isclose(np.linalg.norm(vector), 1.0)
+
+
+def test_flow_agent_nodes_call_the_alias_through_its_client():
+    llm = SemanticCachedLLM(OpenAIAPILLM(api_key="test-key"), "gpt", True)
+
+    code = llm.to_code("gpt-4o-mini")
+
+    assert 'AgentSmithLLM("gpt", "remote", "gpt-4o-mini")' in code
+    assert "get_llm_client" in code and "ChatOpenAI" not in code
+    compile(code, "flow.py", "exec")
+
+
+def test_a_long_chat_is_matched_on_its_latest_question_and_scoped_by_the_earlier_turns(monkeypatch):
+    # like the embedding models, only the first words of a text are read
+    cache = SemanticCache(embedder=lambda texts: embed([" ".join(text.split()[:8]) for text in texts]))
+    monkeypatch.setattr(semantic, "semantic_cache", cache)
+    stub = StubLLM()
+    llm = SemanticCachedLLM(stub, "alias", True, threshold=0.9)
+    opening = [{"role": "user", "content": "what is the capital of germany " + "today " * 300}, {"role": "assistant", "content": "Berlin"}]
+
+    async def ask(history, question):
+        messages = history + [{"role": "user", "content": question}]
+        user_prompt = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        return await llm.aget_completion("system", user_prompt, model="m", temperature=0, messages=messages)
+
+    async def run():
+        first = await ask(opening, "What is the capital of France?")
+        followed = opening + [{"role": "user", "content": "What is the capital of France?"}, {"role": "assistant", "content": first}]
+        return [
+            first,
+            # the next turn of the same chat starts like the previous one, but asks something else
+            await ask(followed, "What is the weather today?"),
+            # the same question after the same turns, rephrased
+            await ask(opening, "what is the capital of france"),
+            # the same question in another chat
+            await ask(opening[:1] + [{"role": "assistant", "content": "Munich"}], "What is the capital of France?"),
+        ]
+
+    answers = asyncio.run(run())
+
+    assert answers == ["answer 1", "answer 2", "answer 1", "answer 3"]
+    assert [entry.prompt for index in cache._scopes.values() for entry in index.entries].count("What is the capital of France?") == 2
@@ -0,0 +1,18 @@
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from services.llms.local.speculative import PromptLookupDrafter
+
+
+def test_prompt_lookup_proposes_what_followed_the_latest_occurrence_of_the_last_ngram():
+    drafter = PromptLookupDrafter(draft_tokens=3, ngram_max=3)
+
+    assert drafter.lookup([1, 2, 3, 4, 5, 9, 1, 2, 3], 3) == [4, 5, 9]
+    assert drafter.lookup([1, 2, 7, 1, 2, 8, 1, 2], 3) == [8, 1, 2]
+    # the longest n-gram is not found, shorter ones are tried
+    assert drafter.lookup([5, 6, 7, 9, 6, 7], 2) == [9, 6]
+    assert drafter.lookup([4, 8, 3, 8], 3) == [3, 8]
+    assert drafter.lookup([1, 2, 3, 4], 3) == []
+
+    assert drafter.propose({0: ([1, 2, 3, 1, 2], 2), 1: ([1, 2, 3], 2)}) == {0: [3, 1]}
@@ -0,0 +1,87 @@
+import os
+import time
+
+from services.llms.local.state_cache import LlamaStateCache
+
+
+def test_least_recently_used_snapshots_spill_to_disk_and_come_back_on_a_hit(tmp_path):
+    cache = LlamaStateCache(max_bytes=10, disk_dir=str(tmp_path), disk_max_bytes=1000)
+
+    cache.put("model", "a", [1, 2], b"aaaaaa")
+    cache.put("model", "b", [1, 3], b"bbbbbb")
+    assert cache.stats()["memory_entries"] == 1 and cache.stats()["disk_entries"] == 1
+
+    # a is read back from its file and promoted, b takes its place on disk
+    snapshot = cache.get("model", "a")
+    assert (snapshot.tokens, snapshot.data) == ((1, 2), b"aaaaaa")
+    assert list(cache._memory) == [("model", "a")]
+    assert cache.get("model", "b").data == b"bbbbbb"
+    assert cache.get("model", "c") is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # a snapshot larger than the memory budget is not kept
+    cache.put("model", "big", [1], b"x" * 11)
+    assert cache.get("model", "big") is None
+
+
+def test_the_disk_tier_drops_its_oldest_files_beyond_its_budget(tmp_path):
+    # a file holds the token count, the tokens and the state: 4 + 4 + 8 bytes here
+    cache = LlamaStateCache(max_bytes=8, disk_dir=str(tmp_path), disk_max_bytes=40)
+
+    for key in "abcd":
+        cache.put("model", key, [1], key.encode() * 8)
+
+    assert cache.stats()["disk_entries"] == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["model-b.state", "model-c.state"]
+    assert cache.get("model", "a") is None
+    assert cache.get("model", "c").data == b"cccccccc"
+
+
+def test_match_finds_the_longest_cached_prefix_of_a_prompt():
+    cache = LlamaStateCache(max_bytes=1000)
+    cache.put("model", "short", [1, 2, 3], b"short")
+    cache.put("model", "long", [1, 2, 3, 4, 5], b"long")
+    cache.put("model", "other", [1, 9], b"other")
+    cache.put("draft", "longer", [1, 2, 3, 4, 5, 6], b"draft")
+
+    assert cache.match("model", [1, 2, 3, 4, 5, 6, 7]).data == b"long"
+    # the prefix may not cover more than max_tokens of the prompt, nor the whole of a shorter one
+    assert cache.match("model", [1, 2, 3, 4, 5, 6, 7], max_tokens=4).data == b"short"
+    assert cache.match("model", [1, 2, 3, 4]).data == b"short"
+    assert cache.match("model", [2, 3, 4]) is None
+
+
+def test_snapshots_left_on_disk_are_found_by_the_next_process(tmp_path):
+    cache = LlamaStateCache(max_bytes=12, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    prefix = list(range(20))
+    cache.put("model", LlamaStateCache.prefix_key(prefix), prefix, b"prefix state")
+    cache.put("model", "in-memory", [99], b"other state!")
+    (tmp_path / "model-interrupted.state.tmp").write_bytes(b"partial")
+
+    restarted = LlamaStateCache(max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000)
+
+    # the tokens are indexed without reading the states, the half-written file of an interrupted write is removed
+    assert restarted.stats() == {"memory_entries": 0, "memory_bytes": 0, "disk_entries": 1, "disk_bytes": 4 * 21 + 12, "hits": 0, "misses": 0}
+    assert restarted.match("model", prefix + [20, 21]).data == b"prefix state"
+    assert not (tmp_path / "model-interrupted.state.tmp").exists()
+
+
+def test_expired_snapshots_are_skipped_and_purged_from_both_tiers(tmp_path):
+    cache = LlamaStateCache(max_bytes=8, disk_dir=str(tmp_path), disk_max_bytes=1000, ttl=60)
+    cache.put("model", "old", [1, 2], b"old turn")
+    cache.put("model", "spilled", [1, 3], b"spilled!")
+    cache.put("model", "recent", [1, 4], b"recent!!")
+    for key in ("old", "spilled"):
+        cache._stored_at[("model", key)] -= 120
+
+    assert cache.get("model", "old") is None
+    assert cache.match("model", [1, 3, 5]) is None
+    cache.put("model", "new", [1, 5], b"new turn")
+    assert not (tmp_path / "model-spilled.state").exists()
+    assert cache.get("model", "recent").data == b"recent!!"
+
+    # a file older than the TTL is not indexed by the next process
+    os.utime(tmp_path / "model-new.state", (time.time() - 120, time.time() - 120))
+    restarted = LlamaStateCache(max_bytes=8, disk_dir=str(tmp_path), disk_max_bytes=1000, ttl=60)
+    assert restarted.get("model", "new") is None
+    assert restarted.get("model", "recent").data == b"recent!!"
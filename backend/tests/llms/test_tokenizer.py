@@ -0,0 +1,70 @@
+import pytest
+
+from services.llms.tokenizer import (
+    MESSAGE_OVERHEAD_TOKENS,
+    REPLY_OVERHEAD_TOKENS,
+    ContextWindowExceeded,
+    Encoder,
+    TokenizerService,
+)
+
+
+class WordEncoder(Encoder):
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, text: str):
+        self.encoded += 1
+        return text.split()
+
+
+class StubLLM:
+    name = "stub"
+
+
+def make_service(monkeypatch, context_window: int):
+    encoder = WordEncoder()
+    service = TokenizerService()
+    monkeypatch.setattr(service, "_load", lambda provider, name: encoder)
+    monkeypatch.setattr(service, "context_window", lambda llm, model: context_window)
+    return service, encoder
+
+
+def chat(turns: int):
+    # every message is 1 token of role, 10 of content and the message overhead
+    return [("user" if i % 2 == 0 else "assistant", f"message {i} " + "word " * 8) for i in range(turns)]
+
+
+def test_the_oldest_messages_are_trimmed_until_the_chat_fits(monkeypatch):
+    per_message = 11 + MESSAGE_OVERHEAD_TOKENS
+    system_tokens = 2 + MESSAGE_OVERHEAD_TOKENS + REPLY_OVERHEAD_TOKENS
+    service, _ = make_service(monkeypatch, context_window=system_tokens + 3 * per_message + 100)
+
+    messages, tokens = service.fit_messages(StubLLM(), "m", "be brief", chat(10), max_tokens=100)
+
+    assert messages == chat(10)[-3:]
+    assert tokens == system_tokens + 3 * per_message
+
+
+def test_a_chat_that_does_not_fit_is_rejected(monkeypatch):
+    service, _ = make_service(monkeypatch, context_window=200)
+
+    # without trimming
+    with pytest.raises(ContextWindowExceeded) as error:
+        service.fit_messages(StubLLM(), "m", "be brief", chat(10), max_tokens=100, trim=False)
+    assert error.value.context_window == 200 and error.value.max_tokens == 100
+
+    # the last message is never trimmed
+    with pytest.raises(ContextWindowExceeded):
+        service.fit_messages(StubLLM(), "m", "be brief", [("user", "word " * 150)], max_tokens=100)
+
+
+def test_counts_are_cached_per_encoder(monkeypatch):
+    service, encoder = make_service(monkeypatch, context_window=10_000)
+
+    for _ in range(3):
+        service.fit_messages(StubLLM(), "m", "be brief", chat(4), max_tokens=100)
+
+    # the system prompt, the roles and the 4 contents are encoded once
+    assert encoder.encoded == 1 + 2 + 4
+    assert WordEncoder().count("one two") == 2
@@ -0,0 +1,71 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from services.llms.local import tuning
+from services.llms.local.tuning import thread_candidates, tune_model
+
+
+def test_thread_candidates_are_the_powers_of_two_half_and_all_of_the_cpus():
+    assert thread_candidates(1) == [1]
+    assert thread_candidates(8) == [1, 2, 4, 8]
+    assert thread_candidates(12) == [1, 2, 4, 6, 8, 12]
+    assert thread_candidates(6) == [1, 2, 3, 4, 6]
+
+
+class FakeLlama:
+    """Loads fail beyond a context of MAX_N_CTX tokens, like a KV cache that does not fit in memory."""
+
+    MAX_N_CTX = 16384
+    loads = []
+
+    def __init__(self, model_path, verbose=False, **params):
+        FakeLlama.loads.append(params)
+        if params["n_ctx"] > self.MAX_N_CTX:
+            raise ValueError("Failed to create llama_context")
+        self.params = params
+        self.ctx = self
+        self.threads = (params.get("n_threads"), params.get("n_threads_batch"))
+        self._model = SimpleNamespace(n_ctx_train=lambda: 32768)
+
+    def close(self):
+        pass
+
+
+def fake_measure(llm, n_prompt, n_decode):
+    """Decoding is fastest on 4 threads, prefilling on the most threads and with batches of 256 tokens."""
+    threads, threads_batch = llm.threads
+    return threads_batch * 1000 - abs(llm.params.get("n_batch", 512) - 256), 10.0 - abs(threads - 4)
+
+
+@pytest.fixture
+def fake_llama(monkeypatch):
+    FakeLlama.loads = []
+    monkeypatch.setitem(sys.modules, "llama_cpp", SimpleNamespace(
+        Llama=FakeLlama,
+        llama_set_n_threads=lambda llm, threads, threads_batch: setattr(llm, "threads", (threads, threads_batch)),
+    ))
+    monkeypatch.setattr(tuning, "_measure", fake_measure)
+
+
+def test_tune_model_picks_the_fastest_settings_and_the_largest_context_that_fits_every_sequence(fake_llama):
+    result = tune_model("model.gguf", n_threads=[1, 2, 4, 8], n_ctx=[1024, 2048, 4096, 8192], max_sequences=4)
+
+    assert result["load_params"] == {"n_threads": 4, "n_threads_batch": 8, "n_batch": 256, "n_ubatch": 256, "n_ctx": 4096}
+    # a context window is tried the way the batch scheduler allocates it, for every sequence at once
+    assert [params["n_ctx"] for params in FakeLlama.loads[-4:]] == [4096, 8192, 16384, 32768]
+    assert [run["n_ctx"] for run in result["runs"] if run["stage"] == "context"] == [1024, 2048, 4096]
+
+
+def test_a_cancelled_benchmark_stops_before_its_next_run(fake_llama):
+    checks = []
+
+    def is_cancelled():
+        checks.append(True)
+        return len(checks) > 5
+
+    with pytest.raises(RuntimeError, match="cancelled"):
+        tune_model("model.gguf", n_threads=[1, 2, 4, 8], is_cancelled=is_cancelled)
+    # the 4 thread runs share a load, the first batch run loaded once more before the cancellation
+    assert len(FakeLlama.loads) == 2